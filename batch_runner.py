@@ -0,0 +1,398 @@
+import argparse, contextlib, datetime, json, logging, multiprocessing, os, sqlite3, sys, traceback, utils
+from multiprocessing import connection
+
+# Pipelines, in order: a job starts when the jobs of the earlier pipelines of its session are done
+PIPELINES = ['middle_process', 'retinotopy', 'process_IOI']
+STATUSES = ['pending', 'running', 'done', 'failed']
+QUEUE_NAME = 'batch_queue.sqlite'
+PATH_LOGS = r'./logs'
+# Estimated cost of a session, in MB: its BLK bytes plus a fixed overhead for each BLK -opening, header, selection-
+BLK_OVERHEAD_MB = 1.
+SCHEMA = '''CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    pipeline TEXT NOT NULL,
+    stage INTEGER NOT NULL,
+    path_session TEXT NOT NULL,
+    options TEXT NOT NULL,
+    cost REAL NOT NULL,
+    n_blks INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    output TEXT,
+    log TEXT,
+    error TEXT,
+    started TEXT,
+    ended TEXT,
+    UNIQUE (pipeline, path_session, options))'''
+
+def get_cost(path_session):
+    '''
+    Estimated cost of processing a session, from count and size of the BLKs of its rawdata folder.
+    Returns (cost in MB, number of BLKs).
+    '''
+    path_rawdata = os.path.join(path_session, 'rawdata')
+    try:
+        sizes = [f.stat().st_size for f in os.scandir(path_rawdata) if f.name.upper().endswith('.BLK')]
+    except OSError:
+        sizes = []
+    return sum(sizes)/2**20 + BLK_OVERHEAD_MB*len(sizes), len(sizes)
+
+def get_session_paths(path_storage, exp_type = ['VSDI'], sessions = None, subs = None, experiments = None):
+    '''
+    Paths of the sessions of utils.get_sessions, flattened: exp -> sub -> sessions.
+    '''
+    exps = utils.get_sessions(path_storage, exp_type = exp_type, sessions = sessions, subs = subs, experiments = experiments)
+    return [p for subs_ in exps.values() for paths in subs_.values() for p in paths]
+
+class JobQueue:
+    '''
+    Persistent queue of jobs -a pipeline on a session, with its options- in a SQLite file. A job is pending, running,
+    done or failed: a failed run goes back to pending until max_attempts runs. Jobs are claimed by estimated cost,
+    the most expensive first, so that the long sessions do not end the batch alone. The queue survives the
+    interruptions: the jobs left running are pending again at the next start -see resume-.
+    One BatchRunner at a time for each queue.
+    '''
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connect() as db:
+            db.execute(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout = 60, isolation_level = None)
+        db.row_factory = sqlite3.Row
+        return contextlib.closing(db)
+
+    def add(self, pipeline, path_session, options = None, max_attempts = 2):
+        '''
+        Adds the job, if not queued yet -same pipeline, session and options-. Returns True if added.
+        '''
+        assert pipeline in PIPELINES, f'Insert a valid pipeline: {PIPELINES}'
+        cost, n_blks = get_cost(path_session)
+        with self.connect() as db:
+            cur = db.execute('INSERT OR IGNORE INTO jobs (pipeline, stage, path_session, options, cost, n_blks, max_attempts) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                             (pipeline, PIPELINES.index(pipeline), os.path.normpath(path_session), json.dumps(options or dict(), sort_keys = True), cost, n_blks, max_attempts))
+            return cur.rowcount > 0
+
+    def claim(self):
+        '''
+        Marks as running the most expensive pending job whose session has no earlier pipeline left, and returns it.
+        None if there is no such job.
+        '''
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            job = db.execute('''SELECT * FROM jobs j WHERE status = 'pending' AND NOT EXISTS
+                                (SELECT 1 FROM jobs k WHERE k.path_session = j.path_session AND k.stage < j.stage AND k.status != 'done')
+                                ORDER BY cost DESC, id LIMIT 1''').fetchone()
+            if job is not None:
+                db.execute("UPDATE jobs SET status = 'running', started = ?, ended = NULL WHERE id = ?", (now(), job['id']))
+            db.execute('COMMIT')
+        return None if job is None else dict(job)
+
+    def finish(self, job_id, error = None, log = None):
+        '''
+        The job is done -error None- or failed: pending again if attempts are left.
+        '''
+        with self.connect() as db:
+            if error is None:
+                db.execute("UPDATE jobs SET status = 'done', attempts = attempts + 1, error = NULL, log = ?, ended = ? WHERE id = ?", (log, now(), job_id))
+            else:
+                db.execute('''UPDATE jobs SET attempts = attempts + 1, error = ?, log = ?, ended = ?,
+                              status = CASE WHEN attempts + 1 < max_attempts THEN 'pending' ELSE 'failed' END WHERE id = ?''', (error, log, now(), job_id))
+
+    def release(self, job_id):
+        '''
+        Back to pending, without counting the attempt: e.g. the job was interrupted.
+        '''
+        with self.connect() as db:
+            db.execute("UPDATE jobs SET status = 'pending', started = NULL WHERE id = ?", (job_id,))
+
+    def set_output(self, job_id, output):
+        with self.connect() as db:
+            db.execute('UPDATE jobs SET output = ? WHERE id = ?', (output, job_id))
+
+    def resume(self):
+        '''
+        Jobs left running by an interrupted batch are pending again. Returns their number.
+        '''
+        with self.connect() as db:
+            return db.execute("UPDATE jobs SET status = 'pending', started = NULL WHERE status = 'running'").rowcount
+
+    def retry_failed(self, max_attempts = None):
+        '''
+        Failed jobs are pending again, with their attempts reset -and max_attempts updated, if given-.
+        '''
+        with self.connect() as db:
+            if max_attempts is None:
+                return db.execute("UPDATE jobs SET status = 'pending', attempts = 0 WHERE status = 'failed'").rowcount
+            return db.execute("UPDATE jobs SET status = 'pending', attempts = 0, max_attempts = ? WHERE status = 'failed'", (max_attempts,)).rowcount
+
+    def get_output(self, pipeline, path_session):
+        '''
+        Output of the last done job of pipeline on the session: e.g. the md_data folder of middle_process.
+        '''
+        with self.connect() as db:
+            row = db.execute("SELECT output FROM jobs WHERE pipeline = ? AND path_session = ? AND status = 'done' AND output IS NOT NULL ORDER BY ended DESC LIMIT 1",
+                             (pipeline, os.path.normpath(path_session))).fetchone()
+        return None if row is None else row['output']
+
+    def jobs(self, status = None):
+        with self.connect() as db:
+            if status is None:
+                rows = db.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+            else:
+                rows = db.execute('SELECT * FROM jobs WHERE status = ? ORDER BY id', (status,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def summary(self):
+        '''
+        Number of jobs for each status.
+        '''
+        with self.connect() as db:
+            counts = dict(db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {s: counts.get(s, 0) for s in STATUSES}
+
+def now():
+    return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+
+def get_log_path(path_logs, job):
+    '''
+    Log of a job run: one for each session, pipeline and attempt.
+    '''
+    name = '_'.join(os.path.normpath(job['path_session']).split(os.sep)[-3:])
+    return os.path.join(path_logs, f"{name}_{job['pipeline']}_job{job['id']:04d}_attempt{job['attempts']+1}.txt")
+
+def get_logger(name, stream):
+    '''
+    Logger of a job run, writing on the open log file stream: the same handle of its redirected prints.
+    '''
+    formatter = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(formatter)
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    logger.addHandler(handler)
+    return logger
+
+def get_path_md(queue, job, options):
+    '''
+    md_data folder -middle process output- for the retinotopy and process_IOI jobs: the path_md option, or the output
+    of the middle_process job of the session.
+    '''
+    path_md = options.pop('path_md', None) or queue.get_output('middle_process', job['path_session'])
+    if path_md is None:
+        raise ValueError(f"No middle process output for {job['path_session']}: queue a middle_process job, or give path_md")
+    return path_md
+
+def run_job(path_queue, job, path_log):
+    '''
+    Runs the job in a worker process: prints and logs of the pipeline go to path_log. The exit code is 0 if it succeeds.
+    '''
+    queue = JobQueue(path_queue)
+    options = json.loads(job['options'])
+    with open(path_log, 'a', buffering = 1) as f, contextlib.redirect_stdout(f), contextlib.redirect_stderr(f):
+        log = get_logger(f"batch_job{job['id']}", f)
+        log.info(f"Job {job['id']}: {job['pipeline']} on {job['path_session']}, options {options}")
+        start_time = datetime.datetime.now().replace(microsecond=0)
+        try:
+            if job['pipeline'] == 'middle_process':
+                import middle_process as md
+                session = md.Session(job['path_session'], logger = log, **options)
+                session.get_session()
+                queue.set_output(job['id'], session.set_md_folder())
+            elif job['pipeline'] == 'retinotopy':
+                import retinotopy
+                path_md = get_path_md(queue, job, options)
+                green_name = options.pop('green_name', 'green01.bmp')
+                retinotopy.RetinoSession(job['path_session'], path_md, green_name, logger = log, **options).get_retino_session()
+                queue.set_output(job['id'], path_md)
+            elif job['pipeline'] == 'process_IOI':
+                import process_IOI
+                path_md = get_path_md(queue, job, options)
+                process_IOI.RFWorkspace(path_md, **options).run_ioi_rf_analysis()
+                queue.set_output(job['id'], path_md)
+        except Exception:
+            log.error(traceback.format_exc())
+            sys.exit(1)
+        log.info(f"Job {job['id']} done in {datetime.datetime.now().replace(microsecond=0)-start_time}")
+
+class BatchRunner:
+    '''
+    Runs the jobs of the queue on n_workers processes, each job in a new process: memory and figures are released
+    at its end, and a crash -e.g. out of memory- fails only its session. The log of each run is in path_logs.
+    '''
+    def __init__(self, queue, n_workers = 1, path_logs = PATH_LOGS, log = None, poll = 5.):
+        self.queue = queue
+        self.n_workers = n_workers
+        self.path_logs = path_logs
+        self.log = log if log is not None else logging.getLogger('batch_runner')
+        self.poll = poll
+        self.running = dict()
+        os.makedirs(path_logs, exist_ok=True)
+
+    def start(self, job):
+        path_log = get_log_path(self.path_logs, job)
+        process = multiprocessing.get_context('spawn').Process(target = run_job, args = (self.queue.path, job, path_log), name = f"batch_job{job['id']}")
+        process.start()
+        self.running[process.sentinel] = (process, job, path_log)
+        self.log.info(f"Job {job['id']} started: {job['pipeline']} on {job['path_session']} -cost {job['cost']:.0f} MB, {job['n_blks']} BLKs-, log {path_log}")
+
+    def collect(self, sentinels):
+        for s in sentinels:
+            process, job, path_log = self.running.pop(s)
+            process.join()
+            if process.exitcode == 0:
+                self.queue.finish(job['id'], log = path_log)
+                self.log.info(f"Job {job['id']} done: {job['pipeline']} on {job['path_session']}")
+            else:
+                self.queue.finish(job['id'], error = f'Exit code {process.exitcode}', log = path_log)
+                self.log.info(f"Job {job['id']} failed -exit code {process.exitcode}-: see {path_log}")
+
+    def run(self):
+        '''
+        Runs the queue until no job can start: all done or failed, or waiting for a failed earlier pipeline.
+        On interruption the running jobs are stopped and pending again. If the batch is killed, its running jobs
+        are run again at the next start. Returns the summary of the queue.
+        '''
+        resumed = self.queue.resume()
+        if resumed:
+            self.log.info(f'{resumed} interrupted jobs are pending again')
+        try:
+            while True:
+                while len(self.running) < self.n_workers:
+                    job = self.queue.claim()
+                    if job is None:
+                        break
+                    self.start(job)
+                if not self.running:
+                    break
+                # Wake up at the end of a job, or to check jobs added meanwhile
+                self.collect(connection.wait(list(self.running), timeout = self.poll))
+        except KeyboardInterrupt:
+            self.log.info('Batch interrupted: running jobs are stopped')
+            for process, job, _ in self.running.values():
+                process.terminate()
+                process.join()
+                self.queue.release(job['id'])
+            self.running = dict()
+            raise
+        summary = self.queue.summary()
+        self.log.info(f'Batch over: {summary}')
+        blocked = summary['pending']
+        if blocked:
+            self.log.info(f'{blocked} jobs wait for a failed job of an earlier pipeline')
+        return summary
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Batch processing of the sessions of a storage, with a persistent job queue')
+
+    parser.add_argument('--queue',
+                        dest='path_queue',
+                        type=str,
+                        default = QUEUE_NAME,
+                        required=False,
+                        help='The SQLite file of the job queue: created if missing, resumed otherwise')
+
+    parser.add_argument('--path_storage',
+                        dest='path_storage',
+                        type=str,
+                        default = None,
+                        required=False,
+                        help='The storage path: sessions of utils.get_sessions are added to the queue')
+
+    parser.add_argument('--pipelines',
+                        dest='pipelines',
+                        type=str,
+                        nargs='+',
+                        default = ['middle_process'],
+                        choices = PIPELINES,
+                        required=False,
+                        help='Pipelines to run on each session, in order')
+
+    parser.add_argument('--exp_type',
+                        dest='exp_type',
+                        type=str,
+                        nargs='+',
+                        default = ['VSDI'],
+                        required=False,
+                        help='Experiment types: VSDI, BEHAV, IOI or ALL')
+
+    parser.add_argument('--experiments',
+                        dest='experiments',
+                        type=str,
+                        nargs='+',
+                        default = None,
+                        required=False)
+
+    parser.add_argument('--subs',
+                        dest='subs',
+                        type=str,
+                        nargs='+',
+                        default = None,
+                        required=False)
+
+    parser.add_argument('--sessions',
+                        dest='sessions',
+                        type=str,
+                        nargs='+',
+                        default = None,
+                        required=False)
+
+    parser.add_argument('--options',
+                        dest='options',
+                        type=str,
+                        default = '{}',
+                        required=False,
+                        help='JSON of the options of each pipeline: e.g. {"middle_process": {"spatial_bin": 3, "strategy": "mae"}}')
+
+    parser.add_argument('--workers',
+                        dest='n_workers',
+                        type=int,
+                        default = 1,
+                        required=False,
+                        help='Sessions processed at the same time')
+
+    parser.add_argument('--max_attempts',
+                        dest='max_attempts',
+                        type=int,
+                        default = 2,
+                        required=False,
+                        help='Runs of a job before it is failed')
+
+    parser.add_argument('--retry_failed',
+                        dest='retry_failed',
+                        action='store_true',
+                        help='Failed jobs of the queue are run again')
+
+    parser.add_argument('--path_logs',
+                        dest='path_logs',
+                        type=str,
+                        default = PATH_LOGS,
+                        required=False,
+                        help='Folder of the logs of the jobs')
+
+    parser.add_argument('--no-run',
+                        dest='run',
+                        action='store_false',
+                        help='Only the queue is filled')
+    parser.set_defaults(run=True)
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S', level=logging.INFO)
+    log = logging.getLogger('batch_runner')
+    queue = JobQueue(args.path_queue)
+    if args.path_storage is not None:
+        options = json.loads(args.options)
+        added = 0
+        for path_session in get_session_paths(args.path_storage, exp_type = args.exp_type, sessions = args.sessions, subs = args.subs, experiments = args.experiments):
+            for pipeline in args.pipelines:
+                added += queue.add(pipeline, path_session, options.get(pipeline), max_attempts = args.max_attempts)
+        log.info(f'{added} jobs added to the queue')
+    if args.retry_failed:
+        log.info(f'{queue.retry_failed(args.max_attempts)} failed jobs are pending again')
+    log.info(f'Queue {args.path_queue}: {queue.summary()}')
+    if args.run:
+        BatchRunner(queue, n_workers = args.n_workers, path_logs = args.path_logs, log = log).run()
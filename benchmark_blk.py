@@ -0,0 +1,232 @@
+import argparse, blk_file, contextlib, datetime, io, json, logging, os, platform, shutil, subprocess, synthetic_blk, tempfile, time, utils
+import middle_process as md
+import numpy as np
+
+# (frames, height, width) of the synthetic BLKs
+SIZES = {'small': (70, 100, 100),
+         'medium': (70, 270, 320),
+         'large': (70, 540, 640)}
+BENCHMARKS = ['get_head', 'get_data', 'get_signal', 'bin_signal', 'motion_index', 'signal_extraction']
+HISTORY_NAME = 'history.jsonl'
+
+def measure(func, repeats):
+    '''
+    Wall times in seconds -monotonic clock- of repeats calls of func. Its prints are discarded.
+    '''
+    times = list()
+    for _ in range(repeats):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter_ns()
+            func()
+            times.append((time.perf_counter_ns() - start)/1e9)
+    return times
+
+def get_result(benchmark, size, shape, times, nbytes, workers = 1):
+    median = float(np.median(times))
+    return {'benchmark': benchmark, 'size': size, 'shape': list(shape), 'workers': workers, 'repeats': len(times),
+            'seconds': times, 'median': median, 'min': float(np.min(times)), 'bytes': int(nbytes),
+            'mb_per_s': nbytes/2**20/median if median > 0 else None}
+
+def bench_blk(path_blk, size, shape, benchmarks, repeats, spatial_bin = 3, temporal_bin = 1):
+    '''
+    Benchmarks of the BlkFile methods on one BLK: the file is in the page cache after the first read.
+    get_data and get_signal are materialized -the payload is memory mapped-: they include the read.
+    '''
+    results = list()
+    header = blk_file.BlkHeader(path_blk)
+    nbytes = header['filesize'] - header['lenheader']
+    BLK = blk_file.BlkFile(path_blk, spatial_bin, temporal_bin, header = header)
+    if 'get_head' in benchmarks:
+        results.append(get_result('get_head', size, shape, measure(BLK.get_head, repeats), header['lenheader']))
+    if 'get_data' in benchmarks:
+        results.append(get_result('get_data', size, shape, measure(lambda: np.array(BLK.get_data()), repeats), nbytes))
+    if 'get_signal' in benchmarks:
+        results.append(get_result('get_signal', size, shape, measure(lambda: np.array(BLK.get_signal()), repeats), nbytes))
+    BLK.release()
+    _ = BLK.signal
+    if 'bin_signal' in benchmarks:
+        results.append(get_result('bin_signal', size, shape, measure(BLK.bin_signal, repeats), nbytes))
+    _ = BLK.binned_signal
+    if 'motion_index' in benchmarks:
+        results.append(get_result('motion_index', size, shape, measure(BLK.motion_index, repeats), BLK.binned_signal.nbytes))
+    BLK.release()
+    return results
+
+def bench_extraction(path_session, size, shape, workers, repeats, spatial_bin = 3, temporal_bin = 1):
+    '''
+    signal_extraction of all the trials of the blank condition, with each number of workers -thread pool-.
+    '''
+    log = logging.getLogger('benchmark_blk')
+    with contextlib.redirect_stdout(io.StringIO()):
+        session = md.Session(path_session, spatial_bin = spatial_bin, temporal_bin = temporal_bin, logger = log,
+                             data_vis_switch = False, profile = False)
+    blks = [b for b in session.all_blks if utils.parse_blk_name(b)[0] == session.blank_id]
+    nbytes = sum(os.path.getsize(os.path.join(path_session, 'rawdata', b)) for b in blks)
+    results = list()
+    for n_workers in workers:
+        header = dict(session.header, n_workers = n_workers, pool = 'thread')
+        run = lambda: md.signal_extraction(header, list(blks), None, False, None, session.blank_id, None, None, None, log = log, header_cache = session.header_cache)
+        results.append(get_result('signal_extraction', size, shape, measure(run, repeats), nbytes, workers = n_workers))
+    return results
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_baseline(path_out, baseline):
+    '''
+    The results of a previous run: the file baseline, or the last run of the history if baseline is 'last'.
+    '''
+    if baseline == 'last':
+        path_history = os.path.join(path_out, HISTORY_NAME)
+        if not os.path.exists(path_history):
+            return None
+        with open(path_history) as f:
+            lines = [l for l in f if l.strip()]
+        return json.loads(lines[-1]) if lines else None
+    with open(baseline) as f:
+        return json.load(f)
+
+def compare(run, baseline):
+    '''
+    Prints the median time of each benchmark against the baseline one: ratio < 1 is faster.
+    '''
+    ref = {(r['benchmark'], r['size'], r['workers']): r['median'] for r in baseline['results']}
+    print(f"Compared with run {baseline['run']} -commit {baseline.get('commit')}-")
+    for r in run['results']:
+        key = (r['benchmark'], r['size'], r['workers'])
+        if key in ref and ref[key] > 0:
+            print(f"{r['benchmark']:>18} {r['size']:>7} {r['workers']:>2} workers: {r['median']:.4f} s, {r['median']/ref[key]:.2f}x baseline")
+
+def run_benchmarks(sizes, workers, benchmarks, repeats, n_trials = 8, path_data = None, dtype = '<u2', subtype = 'vdaq'):
+    '''
+    Writes a synthetic session for each size in path_data -a temporary folder, removed at the end, if None- and runs
+    the benchmarks on it. Returns the run: metadata and list of results.
+    '''
+    run = {'run': datetime.datetime.now().strftime('%Y%m%d_%H%M%S'), 'commit': get_commit(),
+           'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+           'cpu_count': os.cpu_count(), 'dtype': dtype, 'subtype': subtype, 'n_trials': n_trials, 'results': list()}
+    tmp = path_data is None
+    path_data = tempfile.mkdtemp(prefix = 'benchmark_blk_') if tmp else path_data
+    try:
+        for size in sizes:
+            shape = SIZES[size]
+            path_session = os.path.join(path_data, 'exp-benchmark', 'sub-synthetic', f'ses-{size}')
+            if not os.path.exists(os.path.join(path_session, 'rawdata')):
+                synthetic_blk.make_session(path_session, n_conditions = 2, n_trials = n_trials, n_frames = shape[0], height = shape[1],
+                                           width = shape[2], dtype = dtype, subtype = subtype)
+            blks = sorted(os.listdir(os.path.join(path_session, 'rawdata')))
+            print(f'Size {size} {shape}')
+            run['results'] += bench_blk(os.path.join(path_session, 'rawdata', blks[0]), size, shape, benchmarks, repeats)
+            if 'signal_extraction' in benchmarks:
+                run['results'] += bench_extraction(path_session, size, shape, workers, repeats)
+            for r in run['results']:
+                if r['size'] == size:
+                    print(f"{r['benchmark']:>18} {r['workers']:>2} workers: median {r['median']:.4f} s, min {r['min']:.4f} s")
+    finally:
+        if tmp:
+            shutil.rmtree(path_data, ignore_errors = True)
+    return run
+
+def store_run(run, path_out):
+    '''
+    Writes the run as benchmark_<run>.json in path_out, and appends it to the history: one JSON line for each run.
+    '''
+    os.makedirs(path_out, exist_ok = True)
+    path = os.path.join(path_out, f"benchmark_{run['run']}.json")
+    with open(path, 'w') as f:
+        json.dump(run, f, indent = 1)
+    with open(os.path.join(path_out, HISTORY_NAME), 'a') as f:
+        f.write(json.dumps(run) + '\n')
+    return path
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of BLK reading and processing on synthetic data')
+
+    parser.add_argument('--sizes',
+                        dest='sizes',
+                        type=str,
+                        nargs='+',
+                        default = ['small', 'medium'],
+                        choices = list(SIZES),
+                        required=False,
+                        help='Sizes of the synthetic BLKs')
+
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        nargs='+',
+                        default = [1, 2, 4],
+                        required=False,
+                        help='Numbers of workers of signal_extraction')
+
+    parser.add_argument('--benchmarks',
+                        dest='benchmarks',
+                        type=str,
+                        nargs='+',
+                        default = BENCHMARKS,
+                        choices = BENCHMARKS,
+                        required=False,
+                        help='Benchmarks to run')
+
+    parser.add_argument('--repeats',
+                        dest='repeats',
+                        type=int,
+                        default = 5,
+                        required=False,
+                        help='Repetitions of each benchmark')
+
+    parser.add_argument('--n_trials',
+                        dest='n_trials',
+                        type=int,
+                        default = 8,
+                        required=False,
+                        help='Trials for each condition of the synthetic sessions')
+
+    parser.add_argument('--dtype',
+                        dest='dtype',
+                        type=str,
+                        default = '<u2',
+                        choices = [d.str for d in blk_file.DATATYPES.values()],
+                        required=False,
+                        help='Samples type of the synthetic BLKs')
+
+    parser.add_argument('--subtype',
+                        dest='subtype',
+                        type=str,
+                        default = 'vdaq',
+                        choices = list(synthetic_blk.SUBTYPES),
+                        required=False,
+                        help='Header subtype of the synthetic BLKs')
+
+    parser.add_argument('--path_data',
+                        dest='path_data',
+                        type=str,
+                        default = None,
+                        required=False,
+                        help='Folder of the synthetic sessions, kept and reused. A temporary folder by default')
+
+    parser.add_argument('--path_out',
+                        dest='path_out',
+                        type=str,
+                        default = 'benchmarks',
+                        required=False,
+                        help='Folder of the results and of the history')
+
+    parser.add_argument('--baseline',
+                        dest='baseline',
+                        type=str,
+                        default = None,
+                        required=False,
+                        help='Results file to compare with, or last for the last run of the history')
+
+    args = parser.parse_args()
+    baseline = None if args.baseline is None else load_baseline(args.path_out, args.baseline)
+    run = run_benchmarks(args.sizes, args.workers, args.benchmarks, args.repeats, n_trials = args.n_trials, path_data = args.path_data,
+                         dtype = args.dtype, subtype = args.subtype)
+    print('Results stored in ' + store_run(run, args.path_out))
+    if baseline is not None:
+        compare(run, baseline)
@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+
+CACHE_FOLDER = 'binned_cache'
+# Version of the cached content: a change of the binning code has to invalidate the entries
+CACHE_VERSION = 1
+GB = 2**30
+
+class BinnedCache:
+    '''
+    Cache of the binned signals of the BLKs, shared by the runs on a session: one .npy file for each entry, in the
+    folder path_cache. An entry is addressed by the hash of the BLK identity -name, size, modification time- and of
+    all the parameters the binned signal depends on: binning, bin mode, dtype, frame window, crop and detrend.
+    A run with a different strategy, chunks, tolerance or visualization finds the binned signals without raw I/O.
+    The folder is bounded to max_bytes: the least recently used entries are evicted -each hit refreshes the mtime-.
+    Sizes and LRU order of the entries are read from the folder once, at init, and then kept in memory: an insertion 
+    does not scan the folder. A cache sent to process workers is a copy that only writes its entries: index and 
+    eviction stay with the original, which reads the folder again once the workers are over -see sync-. Until then
+    the folder can exceed max_bytes by the entries of the workers.
+    Module level state is not used: the cache can be passed to process workers.
+    '''
+    def __init__(self, path_cache, max_bytes):
+        self.path_cache = path_cache
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path_cache, exist_ok=True)
+        self.load_entries()
+
+    def load_entries(self):
+        '''
+        Size of the entries by key, from the least to the most recently used, and their total.
+        '''
+        entries = list()
+        for f in os.scandir(self.path_cache):
+            if f.name.endswith('.npy'):
+                try:
+                    st = f.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, f.name[:-len('.npy')], st.st_size))
+        self.entries = collections.OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total = sum(self.entries.values())
+
+    def __getstate__(self):
+        # The index of a worker copy would be stale: it is not sent
+        state = self.__dict__.copy()
+        del state['lock']
+        state['entries'] = None
+        state['total'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_key(self, path_blk, params):
+        '''
+        Hash of BLK identity and binning parameters. None if the BLK cannot be stat.
+        '''
+        try:
+            st = os.stat(path_blk)
+        except OSError:
+            return None
+        identity = [CACHE_VERSION, os.path.basename(path_blk), st.st_size, st.st_mtime_ns, params]
+        return hashlib.sha1(json.dumps(identity, sort_keys=True).encode()).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path_cache, key + '.npy')
+
+    def contains(self, path_blk, params):
+        key = self.get_key(path_blk, params)
+        return (key is not None) and os.path.exists(self.entry_path(key))
+
+    def get(self, path_blk, params):
+        '''
+        The cached binned signal of the BLK, or None.
+        '''
+        key = self.get_key(path_blk, params)
+        if key is None:
+            return None
+        try:
+            data = np.load(self.entry_path(key), allow_pickle = False)
+        except (OSError, ValueError):
+            return None
+        # Most recently used, also for the next runs
+        if self.entries is not None:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = data.nbytes
+                    self.total += data.nbytes
+                self.entries.move_to_end(key)
+        try:
+            os.utime(self.entry_path(key))
+        except OSError:
+            pass
+        return data
+
+    def put(self, path_blk, params, data):
+        key = self.get_key(path_blk, params)
+        if (key is None) or (data.nbytes > self.max_bytes):
+            return
+        path = self.entry_path(key)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                np.save(f, data, allow_pickle = False)
+            os.replace(tmp, path)
+            size = os.path.getsize(path)
+        except OSError:
+            print('Binned signal not cached in ' + self.path_cache)
+            return
+        if self.entries is None:
+            return
+        with self.lock:
+            self.total += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def sync(self):
+        '''
+        Reads the index from the folder again, with the entries written by process workers, and evicts to max_bytes.
+        '''
+        with self.lock:
+            self.load_entries()
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries, until the folder is within max_bytes.
+        '''
+        with self.lock:
+            while (self.total > self.max_bytes) and (len(self.entries) > 0):
+                key, size = self.entries.popitem(last = False)
+                self.total -= size
+                try:
+                    os.remove(self.entry_path(key))
+                except OSError:
+                    continue
+
+def get_params(header, detrend):
+    '''
+    The parameters of the session header the binned signal depends on.
+    '''
+    return {'spatial_bin': header['spatial_bin'],
+            'temporal_bin': header['temporal_bin'],
+            'bin_mode': header.get('bin_mode', 'linear'),
+            'dtype': header.get('dtype', 'float64'),
+            'frame_window': header.get('frame_window', None),
+            'crop': header.get('crop', None),
+            'detrend': bool(detrend)}
+
+def get_cache(header):
+    '''
+    The cache of the session, in derivatives/binned_cache, if header['cache_gb'] > 0. None otherwise.
+    '''
+    cache_gb = header.get('cache_gb', 0) or 0
+    if cache_gb <= 0:
+        return None
+    return BinnedCache(os.path.join(header['path_session'], 'derivatives', CACHE_FOLDER), int(cache_gb*GB))
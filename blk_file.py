@@ -7,9 +7,263 @@
 import cv2 as cv
 from denoise import correction_windowframe
 import itertools as it
+import functools
 import io
 import numpy as np
+import os
+import queue
 import struct
+import threading
+import timing
+import utils
+
+# Sample types of the BLK payload, from the datatype header field. Little endian, as written by VDAQ.
+DATATYPES = {11: np.dtype('<u1'), # DAT_UCHAR
+             12: np.dtype('<u2'), # DAT_USHORT
+             13: np.dtype('<i4'), # DAT_LONG: 4 bytes long of the acquisition system
+             14: np.dtype('<f4')} # DAT_FLOAT
+
+def get_datatype(header):
+	"""Numpy dtype of the BLK samples, from the datatype header field.
+	Unknown datatypes fall back to unsigned short, the only type read before.
+	"""
+	return DATATYPES.get(header['datatype'], DATATYPES[12])
+
+# Fixed layout of the BLK header, as a list of (field, numpy type). Raw fields ('V') are kept as bytes.
+HEADER_COMMON = [('filesize', '<i8'),
+                 ('checksum_header', '<i2'),
+                 ('checksum_data', '<i2'),
+                 ('lenheader', '<i4'),
+                 ('versionid', '<f4'),
+                 ('filetype', '<i4'), # RAWBLOCK_FILE (11), DCBLOCK_FILE (12), SUM_FILE (13)
+                 ('filesubtype', '<i4'), # FROM_VDAQ (11), FROM_ORA (12), FROM_DYEDAQ (13)
+                 ('datatype', '<i4'), # DAT_UCHAR (11), DAT_USHORT (12), DAT_LONG (13), DAT_FLOAT (14)
+                 ('sizeof', '<i4'), # e.g. sizeof(long), sizeof(float)
+                 ('framewidth', '<i4'),
+                 ('frameheight', '<i4'),
+                 ('nframesperstim', '<i4'),
+                 ('nstimuli', '<i4'),
+                 ('initialxbinfactor', '<i4'), # from data acquisition
+                 ('initialybinfactor', '<i4'), # from data acquisition
+                 ('xbinfactor', '<i4'), # this file
+                 ('ybinfactor', '<i4'), # this file
+                 ('username', 'V32'),
+                 ('recordingdate', 'V16'),
+                 ('x1roi', '<i4'),
+                 ('y1roi', '<i4'),
+                 ('x2roi', '<i4'),
+                 ('y2roi', '<i4'),
+                 ('stimoffs', '<i4'),
+                 ('stimsize', '<i4'),
+                 ('frameoffs', '<i4'),
+                 ('framesize', '<i4'),
+                 ('refoffs', '<i4'),
+                 ('refsize', '<i4'),
+                 ('refwidth', '<i4'),
+                 ('refheight', '<i4'),
+                 ('whichblocks', '<u2', (16,)),
+                 ('whichframes', '<u2', (16,)),
+                 # DATA ANALYSIS
+                 ('loclip', '<i4'),
+                 ('hiclip', '<i4'),
+                 ('lopass', '<i4'),
+                 ('hipass', '<i4'),
+                 ('operationsperformed', 'V64'),
+                 # ORA-SPECIFIC
+                 ('magnification', '<f4'),
+                 ('gain', '<u2'),
+                 ('wavelength', '<u2'),
+                 ('exposuretime', '<i4'),
+                 ('nrepetitions', '<i4'),
+                 ('acquisitiondelay', '<i4'),
+                 ('interstiminterval', '<i4'),
+                 ('creationdate', 'V16'),
+                 ('datafilename', 'V64'),
+                 ('orareserved', 'V256')]
+
+HEADER_VDAQ = [('includesrefframe', '<i4'),
+               ('listofstimuli', 'V256'),
+               ('nvideoframesperdataframe', '<i4'),
+               ('ntrials', '<i4'),
+               ('scalefactor', '<i4'),
+               ('meanampgain', '<i4'),
+               ('meanampdc', '<i4'),
+               ('vdaqreserved', 'V256')]
+
+HEADER_DYEDAQ = [('includesrefframe', '<i4'), # 0 or 1
+                 ('temp', 'V128'),
+                 ('ntrials', '<i4'),
+                 ('scalefactor', '<i4'), # bin * trials
+                 ('cameragain', '<i2'), # 1, 2, 5, 10
+                 ('ampgain', '<i2'), # 1, 4, 10, 16, 40, 64, 100, 160, 400, 1000
+                 ('samplingrate', '<i2'), # 1/x: 1, 2, 4, ..., 2048
+                 ('average', '<i2'), # 1, 2, 4, ..., 128
+                 ('dyedaq_exposuretime', '<i2'), # 1, 2, 4, ..., 2048. Stored as exposuretime
+                 ('samplingaverage', '<i2'), # 1, 2, 4, ..., 128
+                 ('presentaverage', '<i2'),
+                 ('framesperstim', '<i2'),
+                 ('trialsperblock', '<i2'),
+                 ('sizeofanalogbufferinframes', '<i2'),
+                 ('cameratrials', '<i2'),
+                 ('filler', 'V106'),
+                 ('dyedaqreserved', 'V256')]
+
+HEADER_TAIL = [('user', 'V256'),
+               ('comment', 'V256'),
+               ('refscalefactor', '<i4')] # bin * trials for reference
+
+FROM_DYEDAQ = 13
+HEADER_DTYPES = {'vdaq': np.dtype(HEADER_COMMON + HEADER_VDAQ + HEADER_TAIL),
+                 'dyedaq': np.dtype(HEADER_COMMON + HEADER_DYEDAQ + HEADER_TAIL)}
+# Fields whose name in the header dictionary differs from the structured dtype
+HEADER_ALIASES = {'dyedaq_exposuretime': 'exposuretime'}
+
+def get_header_dtype(filesubtype):
+	"""Structured dtype of the header, for the given filesubtype: DyeDAQ or VDAQ (default) branch.
+	"""
+	if filesubtype == FROM_DYEDAQ:
+		return HEADER_DTYPES['dyedaq']
+	return HEADER_DTYPES['vdaq']
+
+class BlkHeader(dict):
+	"""Header of a BLK file, decoded from one buffered read with a numpy structured dtype.
+	It is a dictionary with the same keys -and values- of the field by field parsing, plus:
+	* headersize : int, the number of bytes of the parsed layout
+	* actuallength : int, the size of the file in bytes
+	Parameters
+	----------
+	filename : str
+	    The path of the BLK file
+	raw : bytes
+	    The first bytes of the file, if already read: the file is not opened. None as default
+	actuallength : int
+	    The size of the file, required with raw. None as default
+	"""
+	def __init__(self, filename, raw = None, actuallength = None):
+		super().__init__()
+		self.filename = filename
+		if raw is None:
+			with io.open(filename, 'rb') as fid:
+				raw = fid.read(max(i.itemsize for i in HEADER_DTYPES.values()))
+				actuallength = os.fstat(fid.fileno()).st_size
+		if len(raw) < HEADER_DTYPES['vdaq'].fields['filesubtype'][1] + 4:
+			raise ValueError(f'{filename} is not a BLK file: header truncated')
+		filesubtype = int(np.frombuffer(raw, dtype='<i4', count=1, offset=HEADER_DTYPES['vdaq'].fields['filesubtype'][1])[0])
+		dtype = get_header_dtype(filesubtype)
+		if len(raw) < dtype.itemsize:
+			raise ValueError(f'{filename} is not a BLK file: header truncated')
+		record = np.frombuffer(raw, dtype=dtype, count=1)[0]
+		for name in dtype.names:
+			value = record[name]
+			if value.dtype.kind == 'V':
+				value = value.tobytes()
+			elif value.shape:
+				value = int(value[0])
+			else:
+				value = value.item()
+			self[HEADER_ALIASES.get(name, name)] = value
+		# Compatibility with the field by field parsing
+		self['recordingdate'] = struct.unpack('16p', self['recordingdate'])
+		if filesubtype == FROM_DYEDAQ:
+			temp = np.frombuffer(self['temp'], dtype=np.uint8)
+			self['listofstimuli'] = self['temp'][0:np.max(np.nonzero(temp)[0], initial=-1)+1] # up to first non-zero stimulus
+		self['headersize'] = dtype.itemsize
+		self['actuallength'] = actuallength
+
+class HeaderCache:
+	"""Per-session cache of BLK headers.
+	An entry is keyed by absolute path, modification time and size of the file: a rewritten file is parsed again.
+	Headers are parsed with BlkHeader, without touching the pixel data.
+	"""
+	def __init__(self):
+		self.headers = dict()
+
+	def key(self, filename):
+		st = os.stat(filename)
+		return (os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+	def get(self, filename):
+		"""Header of filename, parsed only if not cached or changed on disk.
+		"""
+		k = self.key(filename)
+		if k not in self.headers:
+			self.headers[k] = BlkHeader(filename)
+		return self.headers[k]
+
+	def scan(self, filenames):
+		"""Headers of all the filenames -e.g. all the BLKs of a session-, in the same order.
+		"""
+		return [self.get(f) for f in filenames]
+
+# End of the files of a BlkPrefetcher
+PREFETCH_END = object()
+
+class BlkPrefetcher:
+	"""Readahead of BLK files: a background thread reads the next files into memory while the current one is processed.
+	At most depth files are kept read and not consumed, so the memory is bounded by depth+1 files.
+	Iterating over it yields (filename, buffer) pairs in the order of filenames: buffer is a bytearray with the whole
+	file, None if it cannot be read. Any other error of the thread is raised by the iteration.
+	Use it as a context manager, so the thread stops if the iteration is interrupted.
+	Parameters
+	----------
+	filenames : list
+	    The paths of the BLK files, in processing order
+	depth : int
+	    Number of files read ahead. 2 as default
+	"""
+	def __init__(self, filenames, depth = 2):
+		self.filenames = list(filenames)
+		self.queue = queue.Queue(maxsize = max(1, depth))
+		self.stop = threading.Event()
+		self.thread = threading.Thread(target = self.read_all, daemon = True)
+		self.thread.start()
+
+	def read_all(self):
+		# Any error of the thread goes to the consumer, and the end is always signalled: the iteration cannot hang
+		try:
+			for filename in self.filenames:
+				if self.stop.is_set():
+					return
+				try:
+					with io.open(filename, 'rb') as fid:
+						buffer = bytearray(os.fstat(fid.fileno()).st_size)
+						fid.readinto(buffer)
+				except OSError:
+					print('Cannot read file: ', filename)
+					buffer = None
+				self.put((filename, buffer))
+		except BaseException as e:
+			self.put(e)
+		finally:
+			self.put(PREFETCH_END)
+
+	def put(self, item):
+		# Blocks while depth files are waiting
+		while not self.stop.is_set():
+			try:
+				self.queue.put(item, timeout = 0.1)
+				return
+			except queue.Full:
+				pass
+
+	def __iter__(self):
+		while True:
+			item = self.queue.get()
+			if item is PREFETCH_END:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+
+	def close(self):
+		self.stop.set()
+		self.thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
 
 # Commit Try
 class BlkFile:
@@ -19,9 +273,11 @@ class BlkFile:
 	header : dict
 	    The header of the input BLK File
 	data : numpy array
-	    The data of the input BLK File without transformation
-	image : numpy array
-	    The data after transformation, in a 4D image format
+	    The data of the input BLK File without transformation. Lazy: read on first access
+	signal : numpy array
+	    The data after transformation, in a 2D + time format. Lazy: built on first access
+	binned_signal : numpy array
+	    The signal binned in space and time. Lazy: built on first access
 	p : str
 	    len of string
 	h : str
@@ -48,9 +304,11 @@ class BlkFile:
 	    Reads the data contained in the BLK file
 	get_4d_image( ... )
 	    Reads the data contained in the BLK file
+	release( ... )
+	    Drops the lazily computed arrays, keeping only the header
 	"""
 
-	def __init__(self, filename, spatial_binning, temporal_binning, header = None, motion_switch = False, detrend_switch = False, filename_particle = 'vsd_C'):
+	def __init__(self, filename, spatial_binning, temporal_binning, header = None, motion_switch = False, detrend_switch = False, filename_particle = 'vsd_C', bin_mode = 'linear', dtype = 'float64', frames = None, crop = None, buffer = None):
 		"""Initializes attributes
 		Default values for:
 		* p : '1p'
@@ -63,6 +321,12 @@ class BlkFile:
 		----------
 		filename : str
 		    The path of the external file, containing the raw image
+		frames : tuple
+		    (start, stop) frames to read, as a slice. None as default: all the frames
+		crop : tuple
+		    (y0, y1, x0, x1) field of view to read, in pixels of the frame. None as default: all the frame
+		buffer : bytes-like
+		    The whole content of the file, if already read -e.g. by BlkPrefetcher-: the file is not read again. None as default
 		"""
 		# Adaptation of data type size
 		self.p = self.sizeofunity(1,'p')
@@ -75,25 +339,79 @@ class BlkFile:
 		self.L = self.sizeofunity(8,'L')
 		self.detrend_switch = detrend_switch
 		self.filename=filename # String of filename
-		if header is None:
+		if (header is None) and (buffer is not None):
+			self.header = BlkHeader(filename, raw = buffer, actuallength = len(buffer))
+		elif header is None:
 			self.header=self.get_head() # Dictionary for metadata
 		else:
 			self.header = header
-		self.data=self.get_data() # Raw vsdi data
-		self.signal=self.get_signal() # Images for vsdi
+		# Data, signal, binned signal and motion index are computed on first access: see release()
+		self.release()
+		self.buffer = buffer # Content of the file, if already in memory
 		#self.image=self.get_image(detrend) # Images for vsdi
 		self.spatial_binning = spatial_binning # Binning value for space (both x and y)
 		self.temporal_binning = temporal_binning # Binning value for time
-		self.binned_signal = self.bin_signal()#bin_image(interpolation_mode = cv.INTER_CUBIC) #default is INTER_LINEAR	
+		self.bin_mode = bin_mode # Spatial binning: 'linear' interpolation or 'area' block mean
+		self.dtype = dtype # Precision of the binned signal: 'float64' or 'float32'
+		self.frames = frames # Frame window (start, stop): only these frames are read
+		self.crop = crop # Spatial window (y0, y1, x0, x1): only these rows are read
 		self.condition = int(self.filename.split(filename_particle)[1][0:2]) #Adding an extracting string directly from filename
+		self.motion_switch = motion_switch
 		if motion_switch:
-			self.motion_ind, self.motion_ind_max = self.motion_index() # Motion index: float
+			self._motion = self.motion_index() # Motion index: float
 		#self.df_fz = process.deltaf_up_fzero(self.binned_image, self.zero_frames, deblank = dblnk, blank_sign = blank_signal)
 		#self.time_course_sign = self.get_tc_signal(roi_mask = roi_mask) # Instantiation of dtrnd_roi_sign. numpy.array 1D
 		#self.roi_sign = self.get_roi_signal(roi_mask = roi_mask) # Instantiation of dtrnd_roi_sign. numpy.array 1D
 		#self.select_flag = False # Boolean flag for autoselection of trial/blk
 
 
+	@property
+	def data(self):
+		"""Raw vsdi data, read by get_data on first access"""
+		if self._data is None:
+			self._data = self.get_data()
+		return self._data
+
+	@property
+	def signal(self):
+		"""Images for vsdi, built by get_signal on first access"""
+		if self._signal is None:
+			self._signal = self.get_signal()
+		return self._signal
+
+	@property
+	def binned_signal(self):
+		"""Binned images, built by bin_signal on first access.
+		The cached array is returned: in-place changes are kept until release()
+		"""
+		if self._binned_signal is None:
+			self._binned_signal = self.bin_signal()#bin_image(interpolation_mode = cv.INTER_CUBIC) #default is INTER_LINEAR	
+		return self._binned_signal
+
+	@property
+	def motion_ind(self):
+		"""Motion index: float, computed by motion_index on first access"""
+		if self._motion is None:
+			self._motion = self.motion_index()
+		return self._motion[0]
+
+	@property
+	def motion_ind_max(self):
+		"""Maximum value of the motion index among the frames, computed by motion_index on first access"""
+		if self._motion is None:
+			self._motion = self.motion_index()
+		return self._motion[1]
+
+	def release(self):
+		"""Drops the cached data, signal, binned signal, motion index and file buffer.
+		They are computed again on next access: only the header is kept in memory.
+		"""
+		self._data = None
+		self._signal = None
+		self._binned_signal = None
+		self._motion = None
+		self.buffer = None
+
 	def sizeofunity(self,size,string):
 		"""Adaptation of data type size
 		
@@ -121,320 +439,51 @@ class BlkFile:
 
 	def get_head(self):
 		"""Reads each field of BLK file's header and save them into a dictionnary
+		The fixed layout is decoded from a single read: see BlkHeader.
 		Returns
 		-------
-		header : dict
+		header : BlkHeader
 		    The head of the BLK file, containings meta-datas
 		"""
-		from struct import unpack
-
-		fid = io.open(self.filename,'rb')
-
-		filesize = fid.read(8)
-		header = {}
-		header['filesize'] = unpack(self.l,filesize)[0]
-
-		checksum_header = fid.read(2)
-		header['checksum_header'] = unpack(self.h,checksum_header)[0]
-
-		checksum_data= fid.read(2)
-		header['checksum_data'] = unpack(self.h,checksum_data)[0]
-
-		lenheader = fid.read(4)
-		header['lenheader'] = unpack(self.i,lenheader)[0]
-
-		versionid = fid.read(4)
-		header['versionid'] = unpack(self.f,versionid)[0]
-
-		filetype = fid.read(4)
-		header['filetype'] = unpack(self.i,filetype)[0]
-        		# RAWBLOCK_FILE          (11)
-		        # DCBLOCK_FILE           (12)
-	        	# SUM_FILE               (13)
-
-		filesubtype = fid.read(4)
-		header['filesubtype'] = unpack(self.i,filesubtype)[0]
-		        # FROM_VDAQ              (11)
-		        # FROM_ORA               (12)
-		        # FROM_DYEDAQ            (13)
-
-		datatype = fid.read(4)
-		header['datatype'] = unpack(self.i,datatype)[0]
-		        # DAT_UCHAR     (11)
-		        # DAT_USHORT    (12)
-		        # DAT_LONG      (13)
-		        # DAT_FLOAT     (14)
-
-		sizeof = fid.read(4)
-		header['sizeof'] = unpack(self.i,sizeof)[0]
-		        # e.g. sizeof(long), sizeof(float)
-
-		framewidth = fid.read(4)
-		header['framewidth'] = unpack(self.i,framewidth)[0]
-
-		frameheight = fid.read(4)
-		header['frameheight'] = unpack(self.i,frameheight)[0]
-
-		nframesperstim = fid.read(4)
-		header['nframesperstim'] = unpack(self.i,nframesperstim)[0]
-
-		nstimuli = fid.read(4)
-		header['nstimuli'] = unpack(self.i,nstimuli)[0]
-
-		initialxbinfactor = fid.read(4)
-		header['initialxbinfactor'] = unpack(self.i,initialxbinfactor)[0]
-        		# from data acquisition
-
-		initialybinfactor = fid.read(4)
-		header['initialybinfactor'] = unpack(self.i,initialybinfactor)[0]
-        		# from data acquisition
-
-		xbinfactor = fid.read(4)
-		header['xbinfactor'] = unpack(self.i,xbinfactor)[0]
-        		# this file
-
-		ybinfactor = fid.read(4)
-		header['ybinfactor'] = unpack(self.i,ybinfactor)[0]
-        		# this file
-
-		header['username'] = fid.read(32)
-
-		recordingdate = fid.read(16)
-		header['recordingdate'] = unpack(str(int(self.p[0:-1])*16)+self.p[-1],recordingdate)
-
-		x1roi = fid.read(4)
-		header['x1roi'] = unpack(self.i,x1roi)[0]
-
-		y1roi = fid.read(4)
-		header['y1roi'] = unpack(self.i,y1roi)[0]
-
-		x2roi = fid.read(4)
-		header['x2roi'] = unpack(self.i,x2roi)[0]
-
-		y2roi = fid.read(4)
-		header['y2roi'] = unpack(self.i,y2roi)[0]
-
-		stimoffs = fid.read(4)
-		header['stimoffs'] = unpack(self.i,stimoffs)[0]
-
-		stimsize = fid.read(4)
-		header['stimsize'] = unpack(self.i,stimsize)[0]
-
-		frameoffs = fid.read(4)
-		header['frameoffs'] = unpack(self.i,frameoffs)[0]
-
-		framesize = fid.read(4)
-		header['framesize'] = unpack(self.i,framesize)[0]
-
-		refoffs = fid.read(4)
-		header['refoffs'] = unpack(self.i,refoffs)[0]
-
-		refsize = fid.read(4)
-		header['refsize'] = unpack(self.i,refsize)[0]
-
-		refwidth = fid.read(4)
-		header['refwidth'] = unpack(self.i,refwidth)[0]
-
-		refheight = fid.read(4)
-		header['refheight'] = unpack(self.i,refheight)[0]
-
-		whichblocks = fid.read(2*16)
-		header['whichblocks'] = unpack(str(int(self.H[0:-1])*16)+self.H[-1],whichblocks)[0]
-
-		whichframes = fid.read(2*16)
-		header['whichframes'] = unpack(str(int(self.H[0:-1])*16)+self.H[-1],whichframes)[0]
-
-		# DATA ANALYSIS
-		loclip = fid.read(4)
-		header['loclip'] = unpack(self.i,loclip)[0]
-
-		hiclip = fid.read(4)
-		header['hiclip'] = unpack(self.i,hiclip)[0]
-
-		lopass = fid.read(4)
-		header['lopass'] = unpack(self.i,lopass)[0]
-
-		hipass = fid.read(4)
-		header['hipass'] = unpack(self.i,hipass)[0]
-
-		header['operationsperformed'] = fid.read(64)
-
-		# ORA-SPECIFIC
-		magnification = fid.read(4)
-		header['magnification'] = unpack(self.f,magnification)[0]
-
-		gain = fid.read(2)
-		header['gain'] = unpack(self.H,gain)[0]
-
-		wavelength = fid.read(2)
-		header['wavelength'] = unpack(self.H,wavelength)[0]
-
-		exposuretime = fid.read(4)
-		header['exposuretime'] = unpack(self.i,exposuretime)[0]
-
-		nrepetitions = fid.read(4)
-		header['nrepetitions'] = unpack(self.i,nrepetitions)[0]
-
-		acquisitiondelay = fid.read(4)
-		header['acquisitiondelay'] = unpack(self.i,acquisitiondelay)[0]
-
-		interstiminterval = fid.read(4)
-		header['interstiminterval'] = unpack(self.i,interstiminterval)[0]
-
-		header['creationdate'] = fid.read(16)
-
-		header['datafilename'] = fid.read(64)
-
-		header['orareserved'] = fid.read(256)
-
-		if filesubtype == 11:
-			# dyedag secific
-			includesrefframe = fid.read(4) # 0 or 1
-			header['includesrefframe'] = unpack(self.i,includesrefframe)[0]
-			
-			temp = fid.read(128)
-			header['temp'] = temp
-			header['listofstimuli'] = temp[0:np.max(np.where(temp!=0))+1]  # up to first non-zero stimulus
-	
-			ntrials = fid.read(4)
-			header['ntrials'] = unpack(self.i,ntrials)[0]
-
-			scalefactor = fid.read(4)
-			header['scalefactor'] = unpack(self.i,scalefactor)[0] # bin * trials
-	
-			cameragain = fid.read(2)
-			header['cameragain'] = unpack(self.h,cameragain)[0] # shcameragain        1,   2,   5,  10
-	
-			ampgain = fid.read(2)		    # amp gain            1,   4,  10,  16,
-							    #                     40,  64, 100, 160,
-							    #                     400,1000
-
-			header['ampgain'] = unpack(self.h,ampgain)[0]
-
-			samplingrate = fid.read(2)	    # sampling rate (1/x)
-							    #                     1,   2,   4,   8,
-							    #                     16,  32,  64, 128,
-							    #                     256, 512,1024,2048
-			header['samplingrate'] = unpack(self.h,samplingrate)[0]
-
-			average = fid.read(2)		    # average             1,   2,   4,   8,
-							    #                    16,  32,  64, 128
-			header['average'] = unpack(self.h,average)[0]
-
-			exposuretime = fid.read(2)	    # exposure time       1,   2,   4,   8,
-							    #                     16,  32,  64, 128,
-							    #                     256, 512,1024,2048
-			header['exposuretime'] = unpack(self.h,exposuretime)[0]
-
-			samplingaverage = fid.read(2)	    # sampling average    1,   2,   4,   8,
-							    #                     16,  32,  64, 128
-			header['samplingaverage'] = unpack(self.h,samplingaverage)[0]
-
-			presentaverage = fid.read(2)
-			header['presentaverage'] = unpack(self.h,presentaverage)[0]
-
-			framesperstim = fid.read(2)
-			header['framesperstim'] = unpack(self.h,framesperstim)[0]
-
-			trialsperblock = fid.read(2)
-			header['trialsperblock'] = unpack(self.h,trialsperblock)[0]
-
-			sizeofanalogbufferinframes = fid.read(2)
-			header['sizeofanalogbufferinframes'] = unpack(self.h,sizeofanalogbufferinframes)[0]
-
-			cameratrials = fid.read(2)
-			header['cameratrials'] = unpack(self.h,cameratrials)[0]
-
-			header['filler'] = fid.read(106)
-
-			header['dyedaqreserved'] = fid.read(256)
-
-		else:
-			# it's not dyedaq specific
-			includesrefframe = fid.read(4)
-			header['includesrefframe'] = unpack(self.i,includesrefframe)[0]
-
-			header['listofstimuli'] = fid.read(256)
-
-			nvideoframesperdataframe = fid.read(4)
-			header['nvideoframesperdataframe'] = unpack(self.i,nvideoframesperdataframe)[0]
-
-			ntrials = fid.read(4)
-			header['ntrials'] = unpack(self.i,ntrials)[0]
-
-			scalefactor = fid.read(4)
-			header['scalefactor'] = unpack(self.i,scalefactor)[0]
-
-			meanampgain = fid.read(4)
-			header['meanampgain'] = unpack(self.i,meanampgain)[0]
-
-			meanampdc = fid.read(4)
-			header['meanampdc'] = unpack(self.i,meanampdc)[0]
-
-			header['vdaqreserved'] = fid.read(256)
-
-		header['user'] = fid.read(256)
-
-		header['comment'] = fid.read(256)
-
-		refscalefactor =fid.read(4)
-		header['refscalefactor'] = unpack(self.i,refscalefactor)[0]
-        		  # bin * trials for reference
-
-		## End definitions of variables
-		header['headersize']=fid.tell()
-		fid.seek(0,2) # go to EOF
-		header['actuallength'] = fid.tell() # report where EOF is in bytes
-
-		fid.close()
-		return header
+		return BlkHeader(self.filename)
 
 	def get_data(self):
 		"""Reads the data contained in the BLK file
+		The payload, starting at header['lenheader'], is memory mapped with the sample type given by
+		header['datatype']: the output is a read-only 1D view on the file, pages are loaded on access.
+		If the file content was given as buffer, the output is a view on it.
 		Returns
 		-------
-		data : numpy array
+		data : numpy.memmap
 		    The data included in BLK file
-		Raises
-		------
-		ValueError
-		    If the headersize damaged
-		RunTimeError
-		    If data can't be read (the file is damaged)
+		None
+		    If the file can't be mapped (missing file, damaged headersize)
 		"""
-		from struct import unpack
 		#global_timer = datetime.datetime.now().replace(microsecond=0)
 		filesize = self.header['filesize'] # Filesize extraction
 		headersize = self.header['lenheader'] # Headersize extraction
-
-		try:
-			fid = open(self.filename,'rb') # Opening data file
-		except:
-			print('Cannot open file: ', self.filename) # If file can't be read
-			return
-
-		try:
-			a=fid.seek(headersize,0) # go to data
-		except ValueError:
-			print('Cannot seek to byte: ', headersize)
-			return
-
+		dtype = get_datatype(self.header) # Sample type, from the datatype header field
+		n_samples = (filesize-headersize)//dtype.itemsize
+
+		if self.buffer is not None:
+			# The file is already in memory -see BlkPrefetcher-: a view on the buffer, no copy
+			try:
+				return np.frombuffer(self.buffer, dtype=dtype, count=n_samples, offset=headersize)
+			except ValueError:
+				print('Cannot read data of file: ', self.filename, ' from byte: ', headersize)
+				return
 		try:
-			data_in=fid.read() # Data recuperation
-			format_string = str(int(self.H[0:-1])*(filesize-headersize)//2)+self.H[-1]
-			data=unpack(format_string,data_in)
-
-		except RuntimeError:
-			print('Cannot read data')
+			# The payload is mapped, not read: no copy and no python object per sample
+			data = np.memmap(self.filename, dtype=dtype, mode='r', offset=headersize, shape=(n_samples,))
+		except (OSError, ValueError):
+			print('Cannot map data of file: ', self.filename, ' from byte: ', headersize)
 			return
 
-		fid.close()
 		#print('Data extraction time: ',str(datetime.datetime.now().replace(microsecond=0)-global_timer))
 		return data
 
 	def get_time_frames_error(self):
 		# Added by Isabelle Racicot on 25/08/2020. Problems with VDAQ saving data
-		self.get_data()
 		t_size=self.header['nframesperstim']
 		filesize = self.header['filesize']
 		framesize = self.header['framesize']
@@ -443,9 +492,38 @@ class BlkFile:
 		f = t_size_header/t_size
 		return f
 
+	def get_t_size(self):
+		"""Number of frames of the BLK: nframesperstim, or the one consistent with the file size if they differ
+		"""
+		t_size = self.header['nframesperstim']
+		t_size_header = int(round(float(self.header['filesize']-self.header['headersize'])/float(self.header['framesize']),0))
+		if  t_size_header!=t_size:
+			return t_size_header
+		return t_size
+
+	def get_window(self):
+		"""Frame and spatial window of the signal, clipped on the BLK size
+		Returns
+		-------
+		window : tuple
+		    (t0, t1, y0, y1, x0, x1) slices bounds of the read signal
+		"""
+		t0, t1 = (0, self.get_t_size()) if self.frames is None else slice(*self.frames).indices(self.get_t_size())[:2]
+		y0, y1, x0, x1 = (0, self.header['frameheight'], 0, self.header['framewidth']) if self.crop is None else self.crop
+		y0, y1 = slice(y0, y1).indices(self.header['frameheight'])[:2]
+		x0, x1 = slice(x0, x1).indices(self.header['framewidth'])[:2]
+		return t0, max(t0, t1), y0, max(y0, y1), x0, max(x0, x1)
+
+	def get_binned_shape(self):
+		"""Shape of binned_signal, computed from the header only
+		"""
+		t0, t1, y0, y1, x0, x1 = self.get_window()
+		return (int(np.ceil((t1-t0)/self.temporal_binning)), (y1-y0)//self.spatial_binning, (x1-x0)//self.spatial_binning)
+
 	def get_signal(self):
 		"""Transformation of data linear bitstream to a regular image 2D + time data.
 		It substitues old methods get_3d_image and get_4d_image.
+		If frames or crop are set, only the window is returned: see read_window.
 		Parameters
 		----------
 		self object
@@ -461,74 +539,95 @@ class BlkFile:
 		y_size=self.header['frameheight']
 		z_size=1
 		t_size=self.header['nframesperstim']
-		filesize = self.header['filesize']
-		framesize = self.header['framesize']
-		headersize = self.header['headersize']
 
 		# Check on time dimension aka number of frames
-		t_size_header = int(round(float(filesize-headersize)/float(framesize),0))
+		t_size_header = self.get_t_size()
 		if  t_size_header!=t_size:
 			f = t_size_header/t_size
 			print('Number of time frames does not correspond to file size by a factor ',f)
 			t_size = t_size_header
-		a = self.data
+		# Detrending works on the whole bitstream: the window is cut afterwards
+		# Without a buffer in memory, only the window is read from disk
+		if ((self.frames is not None) or (self.crop is not None)) and (not self.detrend_switch) and (self.buffer is None):
+			with timing.span('read') as s:
+				a = self.read_window()
+				s.add(nbytes = a.nbytes)
+			return a
+		# The payload is mapped: the pages are read on access, while binning. The span times only the mapping
+		with timing.span('map'):
+			a = self.data
 		# Detrending
 		if self.detrend_switch:
-			a = np.asarray(a)
-			a = correction_windowframe(a, 0, a.shape[0])
+			with timing.span('detrend') as s:
+				a = np.asarray(a)
+				s.add(nbytes = a.nbytes)
+				a = correction_windowframe(a, 0, a.shape[0])
 		a = np.reshape(a,(t_size,z_size,y_size,x_size)) # Transformation of data linear bitstream to a regular image 2D + time data
 		a = np.reshape(a[:,0,:,:], (t_size, y_size,x_size))
+		if (self.frames is not None) or (self.crop is not None):
+			t0, t1, y0, y1, x0, x1 = self.get_window()
+			a = a[t0:t1, y0:y1, x0:x1]
 		return a
-        
+
+	def read_window(self):
+		"""Reads from disk only the frames and the rows of the window.
+		Frame t starts at lenheader + t*framesize: for each frame the rows y0:y1 are one contiguous block,
+		read straight in the output and cropped on x afterwards. Without crop on y, all the frames are one read.
+		Returns
+		-------
+		image : numpy array
+		    The (t1-t0, y1-y0, x1-x0) window of the signal
+		"""
+		t0, t1, y0, y1, x0, x1 = self.get_window()
+		dtype = get_datatype(self.header)
+		x_size = self.header['framewidth']
+		framesize = self.header['framesize']
+		rowsize = x_size*dtype.itemsize
+		a = np.zeros((t1-t0, y1-y0, x_size), dtype=dtype)
+		with io.open(self.filename, 'rb') as fid:
+			if (y0 == 0) and (y1 == self.header['frameheight']) and (framesize == rowsize*(y1-y0)):
+				fid.seek(self.header['lenheader'] + t0*framesize)
+				self.read_exactly(fid, a)
+			else:
+				for i, t in enumerate(range(t0, t1)):
+					fid.seek(self.header['lenheader'] + t*framesize + y0*rowsize)
+					self.read_exactly(fid, a[i])
+		if (x0 == 0) and (x1 == x_size):
+			return a
+		return a[:, :, x0:x1]
+
+	def read_exactly(self, fid, a):
+		"""Reads a.nbytes bytes from the current position of fid straight in a. A short read -the file is truncated, 
+		or still being written- is an error: the rest of a would be left as zeros.
+		"""
+		n = fid.readinto(memoryview(a).cast('B'))
+		if n != a.nbytes:
+			raise ValueError(f'{self.filename} truncated: {n} of {a.nbytes} bytes read from byte {fid.tell()-n}')
 
 	def bin_signal(self):
 		"""
 		Binning image method. It partially reproduces the old get_3d_image and get_4d_image methods
 		-for the temporal binning side- but introduce a resizing with interpolation for spatial binning.
 		MATLAB interpolation is bicubic: in this version linear is used for fastness and performance showed.
+		The whole (T, Y, X) stack is binned at once by utils.binning: see bin_mode for block mean instead of linear.
 		Parameters
 		----------
-		x_size: int 
-			width of frame
-		y_size: int
-			height of frame
 		temporal_binning : int
 			Number of consecutive temporal samples to be averaged into the imported file
 		spatial_binning : int
 			Size (in pixels) of square window to be averaged into one pixel of the imported file
-		vsdi_signal : BLKFile.image np.array (70, 1000, 1300)
+		bin_mode : str
+			'linear' interpolation (default) or 'area' block mean, for spatial binning
+		dtype : str
+			Precision of the output, 'float64' (default) or 'float32'
 		Returns
 		-------
 		image : numpy array
 			The 2D + time data image resized
 		"""
-		#global_timer = datetime.datetime.now().replace(microsecond=0)
-		x_size = self.header['framewidth']
-		y_size = self.header['frameheight']
-		t_size = self.header['nframesperstim']
-		b = self.signal
-		if self.temporal_binning > 1:
-			t_size_binned = int( np.ceil( float(t_size) / self.temporal_binning ) )
-			# print 't_size_binned if: ', t_size_binned
-			# b = np.zeros( [ t_size_binned, a.shape[1], a.shape[2] ] )
-			b = np.zeros((t_size_binned, y_size, x_size), dtype='float64')
-			for t in range(t_size_binned):
-				ind_min = t*self.temporal_binning
-				ind_max = min((t+1)*self.temporal_binning, t_size )
-				b[t,:,:] = self.image[ind_min:ind_max,:,:].mean(0).astype('float64')
-		else:
-			t_size_binned = t_size
-
-		if self.spatial_binning > 1:
-			x_bnnd_size = x_size//self.spatial_binning 
-			y_bnnd_size = y_size//self.spatial_binning
-			tmp = np.zeros((t_size_binned, y_bnnd_size, x_bnnd_size))
-			for i in range(t_size_binned):
-				tmp[i, :, :] = cv.resize(np.array(b[i, :, :], dtype='float64'), (x_bnnd_size, y_bnnd_size), interpolation=cv.INTER_LINEAR)
-				#tmp[i, :, :] = cv.resize(b[i, :, :], (x_bnnd_size, y_bnnd_size), interpolation=cv.INTER_CUBIC)
-			b = tmp
-		#print('binning time: ',str(datetime.datetime.now().replace(microsecond=0)-global_timer))
-		return b.astype('float64')
+		signal = self.signal
+		with timing.span('bin', nbytes = signal.nbytes, trials = 1):
+			return utils.binning(signal, self.spatial_binning, self.temporal_binning, mode = self.bin_mode, dtype = self.dtype)
 
 
 	def motion_index(self):
@@ -572,9 +671,14 @@ def circular_mask_roi(new_width, new_height):
 	Returns
 	-----------
 	roi_mask: numpy.array (width/spatial_binning, height/spatial_binning)
+	The mask is memoized and read only: it is shared by all the calls with the same size.
 	Author: Kevin Blaize
 	Matlab2Python conversion: Salvatore Giancani
 	"""
+	return [cached_circular_mask(int(new_width), int(new_height))] # binned_x, binned_y
+
+@functools.lru_cache(maxsize = 32)
+def cached_circular_mask(new_width, new_height):
 	#global_timer = datetime.datetime.now().replace(microsecond=0)
 	#new_width = (self.header['framewidth']//self.spatial_binning)
 	#new_height = (self.header['frameheight']//self.spatial_binning)
@@ -582,7 +686,8 @@ def circular_mask_roi(new_width, new_height):
 	y = np.linspace(-1, 1, new_height)
 	xv, yv = np.meshgrid(x, y)
 	bnw = np.sqrt((np.square(xv)+np.square(yv))<0.5)
-	mask=[~(bnw>0)]
+	mask = ~(bnw>0)
+	mask.setflags(write = False)
 	#print('mask roi building time: ',str(datetime.datetime.now().replace(microsecond=0)-global_timer))
-	return mask # binned_x, binned_y
+	return mask
 
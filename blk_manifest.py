@@ -0,0 +1,173 @@
+import blk_file
+import datetime
+import json
+import os
+import utils
+
+MANIFEST_NAME = 'blk_manifest.json'
+SCHEMA_VERSION = 1
+# Header fields kept in the manifest: enough for the session hyperparameters, without opening a BLK
+HEADER_SUMMARY = ['nframesperstim', 'frameheight', 'framewidth', 'framesize', 'datatype', 'lenheader', 'headersize', 'filesize']
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+class BlkManifest:
+    '''
+    Index of the BLK files of a session rawdata folder, stored as a JSON sidecar in derivatives/blk_manifest.json.
+    For each BLK it records condition id, acquisition timestamp, file size and modification time, a header summary
+    and the trial order -position in the list sorted by timestamp-.
+    The index is refreshed incrementally: each refresh lists rawdata once, and only new or changed files -by mtime 
+    and size: e.g. a BLK rewritten, or still being written- are parsed again, and only their header is read.
+    The sidecar also records the modification time of rawdata at the last refresh.
+    The sidecar is written only if store is True -the Session setup-: readers can index a read-only session.
+    '''
+    def __init__(self, path_session, filename_particle = 'vsd_C', store = True):
+        self.path_session = path_session
+        self.path_rawdata = os.path.join(path_session, 'rawdata')
+        self.path_manifest = os.path.join(path_session, 'derivatives', MANIFEST_NAME)
+        self.filename_particle = filename_particle
+        self.entries = dict()
+        # Modification time of rawdata at the last refresh, and changes not stored yet
+        self.rawdata_mtime_ns = None
+        self.dirty = False
+        self.load()
+        self.refresh()
+        if store and self.dirty:
+            self.store()
+
+    def load(self):
+        '''
+        Loads the sidecar, if it exists and it is compatible. Otherwise the manifest starts empty.
+        '''
+        try:
+            with open(self.path_manifest) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return
+        if manifest.get('schema_version') != SCHEMA_VERSION:
+            return
+        self.entries = manifest.get('blks', dict())
+        self.rawdata_mtime_ns = manifest.get('rawdata_mtime_ns')
+        # Conditions depend on the particle: names are parsed again, headers are kept
+        if manifest.get('filename_particle') != self.filename_particle:
+            for name, entry in self.entries.items():
+                entry['condition'] = utils.parse_blk_name(name, self.filename_particle)[0]
+
+    def refresh(self):
+        '''
+        Scans rawdata once, and updates the entries of new, changed and deleted BLKs. The modification time of rawdata
+        is not enough: a BLK rewritten in place, or growing, does not change it.
+        Returns True if the entries changed.
+        '''
+        try:
+            mtime_ns = os.stat(self.path_rawdata).st_mtime_ns
+            files = [f for f in os.scandir(self.path_rawdata) if (f.is_file()) and (f.name.endswith(".BLK"))]
+        except OSError:
+            print('Check the path: ' + self.path_rawdata + ' not found')
+            mtime_ns = None
+            files = list()
+        if mtime_ns != self.rawdata_mtime_ns:
+            self.rawdata_mtime_ns = mtime_ns
+            self.dirty = True
+        changed = False
+        found = set()
+        for f in files:
+            found.add(f.name)
+            st = f.stat()
+            entry = self.entries.get(f.name)
+            if (entry is not None) and (entry['mtime_ns'] == st.st_mtime_ns) and (entry['size'] == st.st_size):
+                continue
+            self.entries[f.name] = self.get_entry(f.name, st)
+            changed = True
+        for name in list(self.entries):
+            if name not in found:
+                del self.entries[name]
+                changed = True
+        if changed:
+            self.set_order()
+            self.dirty = True
+        return changed
+
+    def get_entry(self, name, st):
+        condition, timestamp = utils.parse_blk_name(name, self.filename_particle)
+        try:
+            header = blk_file.BlkHeader(os.path.join(self.path_rawdata, name))
+            summary = {k: header[k] for k in HEADER_SUMMARY}
+        except (OSError, ValueError):
+            print('Cannot read the header of file: ', name)
+            summary = None
+        return {'condition': condition,
+                'timestamp': None if timestamp is None else timestamp.strftime(TIME_FORMAT),
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'header': summary,
+                'order': None}
+
+    def set_order(self):
+        '''
+        Trial order: by acquisition timestamp if all the names carry it, by name otherwise.
+        '''
+        names = sorted(self.entries)
+        if all(self.entries[n]['timestamp'] is not None for n in names):
+            names = sorted(names, key=lambda n: self.entries[n]['timestamp'])
+        for i, n in enumerate(names):
+            self.entries[n]['order'] = i
+
+    def store(self):
+        '''
+        Writes the sidecar atomically. A read-only session is not an error: the manifest is only kept in memory.
+        '''
+        manifest = {'schema_version': SCHEMA_VERSION,
+                    'filename_particle': self.filename_particle,
+                    'updated': datetime.datetime.now().strftime(TIME_FORMAT),
+                    'rawdata_mtime_ns': self.rawdata_mtime_ns,
+                    'blks': self.entries}
+        tmp = self.path_manifest + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path_manifest), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f)
+            os.replace(tmp, self.path_manifest)
+            self.dirty = False
+        except OSError:
+            print('BLK manifest not stored in ' + self.path_manifest)
+
+    def blks(self, sort = True, conditions = None):
+        '''
+        BLK filenames, sorted by trial order -sort True- or by name, optionally only for the conditions ids listed.
+        '''
+        names = [n for n, e in self.entries.items() if (conditions is None) or (e['condition'] in conditions)]
+        if sort:
+            return sorted(names, key=lambda n: self.entries[n]['order'])
+        return sorted(names)
+
+    def condition_ids(self):
+        '''
+        Sorted list of the condition ids of the session.
+        '''
+        return sorted(set(e['condition'] for e in self.entries.values() if e['condition'] is not None))
+
+    def condition(self, blk_name):
+        return self.entries[blk_name]['condition']
+
+    def header(self, blk_name):
+        '''
+        Header summary of a BLK -see HEADER_SUMMARY-: None if the header could not be read.
+        '''
+        return self.entries[blk_name]['header']
+
+# Manifests already built in this process, by session path and particle
+manifests = dict()
+
+def get_manifest(path_session, filename_particle = 'vsd_C', store = False):
+    '''
+    The manifest of the session: built once per process, then only refreshed. The sidecar is written only with
+    store True.
+    '''
+    key = (os.path.abspath(path_session), filename_particle)
+    if key not in manifests:
+        manifests[key] = BlkManifest(path_session, filename_particle = filename_particle, store = store)
+    else:
+        manifests[key].refresh()
+        if store and manifests[key].dirty:
+            manifests[key].store()
+    return manifests[key]
@@ -0,0 +1,21 @@
+import middle_process as md
+import argparse
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Converting the md_data pickles to the columnar Condition format')
+
+    parser.add_argument('--path_md',
+                        dest='path_md',
+                        type=str,
+                        required=True,
+                        help='The md_data folder path')
+
+    parser.add_argument('--remove',
+                        dest='remove',
+                        action='store_true',
+                        help='Delete the pickles after conversion')
+    parser.set_defaults(remove=False)
+
+    args = parser.parse_args()
+    converted = md.convert_md_data(args.path_md, remove = args.remove)
+    print(f'{len(converted)} conditions converted')
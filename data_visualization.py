@@ -1,3 +1,4 @@
+import cv2 as cv
 import datetime, utils
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import AxesGrid
@@ -16,6 +17,20 @@ STORAGE_PATH = '/envau/work/neopto/USERS/GIANCANI/Analysis/'
 
 COLORS_7 = ['crimson', 'tomato', 'magenta', 'darkorange', 'burlywood', 'palevioletred', 'chocolate', 'black', 'white', 'gray']
 
+# Raster mosaics -see raster_mosaic-: OpenCV colors are BGR
+RASTER_FONT = cv.FONT_HERSHEY_SIMPLEX
+RASTER_BACKGROUND = (255, 255, 255)
+RASTER_TEXT = (0, 0, 0)
+RASTER_CENTROID = (0, 0, 255)
+# black, purple and aqua, as colors_centr of whole_time_sequence
+RASTER_COLORS_CENTR = [(0, 0, 0), (128, 0, 128), (255, 255, 0)]
+# Colormaps sampled by get_lut
+LUTS = dict()
+# Fast PNG compression: the mosaics are large
+RASTER_PNG_PARAMS = [cv.IMWRITE_PNG_COMPRESSION, 1]
+# Values sampled from the trials for the color limits of the activity maps -8 MB in float64-: see get_color_limits
+COLOR_LIMITS_SAMPLES = 2**20
+
 def set_storage_folder(storage_path = STORAGE_PATH, name_analysis = 'prova'):    
     folder_path = os.path.join(storage_path, name_analysis)               
     if not os.path.exists(folder_path):
@@ -62,22 +77,46 @@ def latency_error_bars(a, title, name_anls, labels = None, store_path = STORAGE_
     plt.close('all')
     return
 
-def time_sequence_visualization(start_frame, n_frames_showed, end_frame, data, titles, title_to_print, header, path_, c_ax_= None, circular_mask = True, log_ = None, max_trials = 15):
+def get_session_name(path_session):
+    '''
+    sub-exp_ses name of the figures: e.g. Bretz-AM3_20220101 for .../exp-AM3/sub-Bretz/ses-20220101.
+    '''
+    comp = os.path.normpath(path_session).split(os.sep)
+    return comp[-2].split('sub-')[1]+'-'+comp[-3].split('exp-')[1] + '_' + comp[-1].split('-')[1]
+
+def get_color_limits(data, percentiles = (10, 85), n_samples = COLOR_LIMITS_SAMPLES):
+    '''
+    Color limits of the activity maps of the trials in data -(N, T, Y, X), an array or an out of memory trials tensor-:
+    the percentiles of an evenly strided sample of each trial, read one at a time. Exact up to n_samples values.
+    '''
+    step = max(1, int(np.ceil(np.prod(data.shape)/n_samples)))
+    sample = np.concatenate([np.asarray(data[i]).ravel()[::step] for i in range(len(data))])
+    return tuple(np.nanpercentile(sample, percentiles))
+
+def get_considered_frames(start_frame, n_frames_showed, end_frame):
+    '''
+    Indeces of the frames shown by time_sequence_visualization: it starts from the last considered zero_frames.
+    '''
+    return np.round(np.linspace(start_frame-1, end_frame-1, n_frames_showed))
+
+def time_sequence_visualization(start_frame, n_frames_showed, end_frame, data, titles, title_to_print, header, path_, c_ax_= None, circular_mask = True, log_ = None, max_trials = 15, sliced = False):
+    '''
+    If sliced is True, data holds only the considered frames of each trial -see get_considered_frames-: e.g. the 
+    slices sent to a render_queue.RenderQueue. c_ax_ should be given then, computed on all the frames.
+    '''
     start_time = datetime.datetime.now().replace(microsecond=0)
     #session_name = header['path_session'].split('/')[-2]+'-'+header['path_session'].split('/')[-3].split('-')[1]
-    comp = os.path.normpath(header['path_session']).split(os.sep)
-    session_name = comp[-2].split('sub-')[1]+'-'+comp[-3].split('exp-')[1] + '_' + comp[-1].split('-')[1]    
+    session_name = get_session_name(header['path_session'])
     # Array with indeces of considered frames: it starts from the last considerd zero_frames
-    considered_frames = np.round(np.linspace(start_frame-1, end_frame-1, n_frames_showed))
+    considered_frames = np.arange(n_frames_showed) if sliced else get_considered_frames(start_frame, n_frames_showed, end_frame)
     # Borders for caxis
     if c_ax_ is None:
-        max_bord = np.nanpercentile(data, 85)
-        min_bord = np.nanpercentile(data, 10)
+        min_bord, max_bord = get_color_limits(data)
     elif c_ax_ is not None:
         max_bord = c_ax_[1]
         min_bord = c_ax_[0]
         
-    if log_ is not None:
+    if log_ is None:
         print(f'Start frame {start_frame}, {n_frames_showed} frames showed and end frame {end_frame}')
         print(f'Max value heatmap: {max_bord}')
         print(f'Min value heatmap: {min_bord}')
@@ -92,19 +131,23 @@ def time_sequence_visualization(start_frame, n_frames_showed, end_frame, data, t
     count = 0
     for i, n in enumerate(separators):
         if i != 0:
-            fig = plt.figure(constrained_layout=True, figsize = (n_frames_showed-2, len(data[separators[i-1]:n, :, :, :])), dpi = 80)
+            trials = range(separators[i-1], n)
+            fig = plt.figure(constrained_layout=True, figsize = (n_frames_showed-2, len(trials)), dpi = 80)
             fig.suptitle(f'Session {session_name}')# Session name
-            subfigs = fig.subfigures(nrows=len(data[separators[i-1]:n, :, :, :]), ncols=1)
-            for sequence, subfig in zip(data[separators[i-1]:n, :, :, :], subfigs):
+            subfigs = fig.subfigures(nrows=len(trials), ncols=1, squeeze=False)[:, 0]
+            # One trial at a time: data can be an out of memory trials tensor
+            for t, subfig in zip(trials, subfigs):
+                sequence = np.asarray(data[t])
                 subfig.suptitle(f'{titles[count]}')
                 axs = subfig.subplots(nrows=1, ncols=n_frames_showed)
 
                 # Showing each frame
                 for df_id, ax in zip(considered_frames, axs):
-                    Y = sequence[int(df_id), :, :]
+                    # A copy: the mask must not write in the trials
+                    Y = np.array(sequence[int(df_id), :, :], dtype='float64')
                     if circular_mask:
-                        mask = utils.sector_mask(Y.shape, (Y.shape[0]//2, Y.shape[1]//2), (np.min(np.shape(Y)))*0.40, (0,360) )
-                        Y[~mask] = np.NAN
+                        mask = utils.get_sector_mask(Y.shape, (Y.shape[0]//2, Y.shape[1]//2), (np.min(np.shape(Y)))*0.40, (0,360) )
+                        Y[~mask] = np.nan
                     ax.axis('off')
                     pc = ax.pcolormesh(Y, vmin=min_bord, vmax=max_bord, cmap=utils.PARULA_MAP)
                     del Y
@@ -124,6 +167,73 @@ def time_sequence_visualization(start_frame, n_frames_showed, end_frame, data, t
         print('Plotting heatmaps time: ' +str(datetime.datetime.now().replace(microsecond=0)-start_time))
     return  
 
+def time_course_visualization(cd_i, sig, mask, blks, blank_sign, n_frames, title, session_name, path_):
+    '''
+    Time courses of the trials of condition cd_i, selected -blue- and not selected -red-, with their averages and
+    the blank one: stored in path_/time_course. See middle_process.Session.roi_plots.
+    '''
+    cdi_select = np.where(mask==1)
+    cdi_select = cdi_select[0].tolist()
+    cdi_unselect = np.where(mask==0)
+    cdi_unselect = cdi_unselect[0].tolist()
+    # Number of possible columns
+    b = [4,5,6]
+    a = [len(mask)%i for i in b]
+    columns = b[a.index(min(a))]
+
+    fig = plt.figure(constrained_layout=True, figsize = (columns*4, int(np.ceil(len(mask)/columns)+1)*2), dpi = 80)
+    fig.suptitle(title)# Session name
+    # Height_ratios logic implementation
+    rat = [1]*(int(np.ceil(len(mask)/columns))+1)
+    rat[-1] = 3
+    subfigs = fig.subfigures(nrows=int(np.ceil(len(mask)/columns))+1, ncols=1, height_ratios=rat)
+    for row, subfig in enumerate(subfigs):
+        #subfig.suptitle('Bottom title')
+        axs = subfig.subplots(nrows=1, ncols=columns, sharex=True, sharey=True)
+        x = np.arange(0, n_frames)
+        for i, ax in enumerate(axs):
+            count = row*columns + i
+            if count < len(mask):
+                ax.set_ylim(np.nanmin(sig[cdi_select, :]) - (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005, 
+                            np.nanmax(sig[cdi_select, :]) + (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005)
+                if mask[count]==1:
+                    color = 'b'
+                else:
+                    color = 'r'
+                ax.plot(sig[count, :], color)
+                ax.set_title(blks[count])
+                ax.errorbar(x, np.nanmean(sig[cdi_select, :], axis = 0), yerr=(np.nanstd(sig[cdi_select, :], axis = 0)/np.sqrt(len(cdi_select))), 
+                            fmt='--', color = 'k', elinewidth = 0.5)
+                ax.ticklabel_format(axis='both', style='sci', scilimits=(-3,3))
+                #ax.set_ylim(-0.002,0.002)
+            if row<len(subfigs)-2:
+                ax.get_xaxis().set_visible(False)
+            elif row<len(subfigs)-1:
+                ax.get_xaxis().set_visible(True)
+            elif row == len(subfigs)-1:
+                ax.axis('off')
+                ax_ = subfig.subplots(1, 1)
+                ax_.set_ylim(np.nanmin(sig[cdi_select, :]) - (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005, 
+                             np.nanmax(sig[cdi_select, :]) + (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005)
+                for i in sig[cdi_select[:-1], :]:
+                    ax_.plot(x, i, 'gray', linewidth = 0.5)
+                ax_.plot(x, sig[cdi_select[-1], :], 'gray', linewidth = 0.5, label = 'Trials')
+                ax_.plot(x, np.nanmean(sig[cdi_select, :], axis=0), 'k', label = 'Average Selected trials', linewidth = 2)
+                ax_.plot(x, np.nanmean(sig[cdi_unselect, :], axis=0), 'crimson', label = 'Average Unselected trials', linewidth = 2)
+                ax_.plot(x, np.nanmean(sig, axis=0), 'green', label = 'Average All trials Cond. ' + str(cd_i), linewidth = 2)
+                ax_.plot(x, blank_sign, color='m', label = 'Average Blank Signal' ,linewidth = 2)
+                #ax_.plot(list(range(0,np.shape(sig)[1])), blank_sign, color='m', label = 'Average Blank Signal' ,linewidth = 5)
+                ax_.legend(loc="upper left")                
+                ax_.ticklabel_format(axis='both', style='sci', scilimits=(-3,3))
+            
+    tmp = path_
+    if not os.path.exists(os.path.join(tmp,'time_course')):
+        os.makedirs(os.path.join(tmp,'time_course'))
+    plt.savefig(os.path.join(tmp,'time_course', session_name+'_tc_0'+str(cd_i)+'.png'))
+    #plt.savefig((path_session+'/'session_name +'/'+ session_name+'_roi_0'+str(cd_i)+'.png')
+    plt.close('all')
+    return
+
 def chunk_distribution_visualization(coords, m_norm, l, cd_i, header, tc, indeces_select, mask_array, path):
     strategy = header['strategy']
     #session_name = header['path_session'].split('/')[-2]+'-'+header['path_session'].split('/')[-3].split('-')[1]
@@ -334,6 +444,65 @@ def retino_pos_visualization(x, y, center, titles, green, name = 'Prova', ext =
     plt.close('all')
     return
 
+def get_blobs(data, mask, handle_lims_blobs = ((97.72, 100)), manual_thresh = None, flag_simple_thres = False):
+    '''
+    Blobs and their centroids -inside mask- for each frame of data, as shown by whole_time_sequence. With 
+    flag_simple_thres they are computed frame by frame on the shown map -see simple_threshold_blob-: 
+    it returns an empty list of centroids and None blobs.
+    '''
+    # Significant threshold for blob thresholding
+    bottom_limit = np.nanpercentile(data, 80)
+    upper_limit = np.nanpercentile(data, 100)
+    # Significant threshold for blob thresholding
+    ad_t = False
+
+    if manual_thresh is None:
+        manual_th = handle_lims_blobs[0]
+        _, centroids, blobs = process.detection_blob(data,
+                                                     min_lim = bottom_limit,
+                                                     max_lim = upper_limit,
+                                                     min_2_lim = manual_th, 
+                                                     max_2_lim = handle_lims_blobs[1],  
+                                                     adaptive_thresh = ad_t)
+        
+    elif (manual_thresh is not None) and (not flag_simple_thres):
+        a = [process.manual_thresholding(i, manual_thresh) for i in data]
+        centroids = list(zip(*a))[1]
+        blobs = list(zip(*a))[2]
+
+    elif (manual_thresh is not None) and (flag_simple_thres):
+        centroids = []
+        blobs = None    
+        
+    if len(centroids)>0:
+        new_centroids = []
+
+        for c in centroids:
+            cntrds = []
+
+            if len(c)>0:
+                for x,y, in c:
+                    if mask[y, x]:
+                        cntrds.append((x,y))
+
+            new_centroids.append(cntrds)
+        centroids = new_centroids
+    return centroids, blobs
+
+def simple_threshold_blob(blurred, mask, manual_thresh):
+    '''
+    Blob over manual_thresh of the map blurred, and its centroid: the center of the area with highest sum.
+    '''
+    blobs_ = np.zeros(blurred.shape, dtype = bool)
+    blobs_[np.where(blurred>manual_thresh)] = 1
+    # If there is a mask, it looks for maximi inside the blob
+    if (mask is not None) and (np.sum(blobs_) > 20).all():
+        blobs_ = blobs_*mask
+    if np.nansum(blobs_)>0:
+        (x_, y_) = process.find_highest_sum_area(blurred*blobs_, 20)
+        return blobs_, [(y_, x_)]
+    return blobs_, []
+
 def whole_time_sequence(data, 
                         global_cntrds = None, 
                         colors_centr = ['black', 'purple', 'aqua'], 
@@ -393,44 +562,7 @@ def whole_time_sequence(data,
 
     # If centroids and blobs are provided, it avoids this computation
     if (cntrds is None) and (blbs is None):# and (mask is not None):
-        # Significant threshold for blob thresholding
-        bottom_limit = np.nanpercentile(data, 80)
-        upper_limit = np.nanpercentile(data, 100)
-        # Significant threshold for blob thresholding
-        ad_t = False
-
-        if manual_thresh is None:
-            manual_th = handle_lims_blobs[0]
-            _, centroids, blobs = process.detection_blob(data,
-                                                         min_lim = bottom_limit,
-                                                         max_lim = upper_limit,
-                                                         min_2_lim = manual_th, 
-                                                         max_2_lim = handle_lims_blobs[1],  
-                                                         adaptive_thresh = ad_t)
-            
-        elif (manual_thresh is not None) and (not flag_simple_thres):
-            a = [process.manual_thresholding(i, manual_thresh) for i in data]
-            centroids = list(zip(*a))[1]
-            blobs = list(zip(*a))[2]
-
-        elif (manual_thresh is not None) and (flag_simple_thres):
-            centroids = []
-            blobs = None    
-            
-        if len(centroids)>0:
-            new_centroids = []
-
-            for c in centroids:
-                cntrds = []
-
-                if len(c)>0:
-                    for x,y, in c:
-                        if mask[y, x]:
-                            cntrds.append((x,y))
-
-                new_centroids.append(cntrds)
-            centroids = new_centroids
-            
+        centroids, blobs = get_blobs(data, mask, handle_lims_blobs = handle_lims_blobs, manual_thresh = manual_thresh, flag_simple_thres = flag_simple_thres)
     else:
         centroids = cntrds
         blobs = blbs
@@ -449,7 +581,7 @@ def whole_time_sequence(data,
             blurred = l
 
         if mask is not None:
-            blurred[~mask] = np.NAN
+            blurred[~mask] = np.nan
         
         p=ax.pcolor(blurred, vmin=min_bord,vmax=max_bord, cmap=mappa)
 
@@ -467,16 +599,8 @@ def whole_time_sequence(data,
         ax.set_title("")  # Remove the default title
 
         if (manual_thresh is not None) and (flag_simple_thres) and (blobs is None):
-            blobs_ = np.zeros(blurred.shape, dtype = bool)
-            blobs_[np.where(blurred>manual_thresh)] = 1
-            # If there is a mask, it looks for maximi inside the blob
-            if (mask is not None) and (np.sum(blobs_) > 20).all():
-                blobs_ = blobs_*mask
-            if np.nansum(blobs_)>0:
-                (x_, y_) = process.find_highest_sum_area(blurred*blobs_, 20)
-                centroids.append([(y_, x_)])
-            else:
-                centroids.append([])
+            blobs_, c = simple_threshold_blob(blurred, mask, manual_thresh)
+            centroids.append(c)
 
         elif blobs is not None:
             if mask is not None:
@@ -495,7 +619,7 @@ def whole_time_sequence(data,
             for k, cc in zip(global_cntrds, colors_centr):
                 # ax.vlines(i[0], 0, blurred.shape[0], color = cc, lw= 1.5)
                 if centroids_labeling == 'dotted circles':
-                    mask_single_dot = utils.sector_mask(l.shape, 
+                    mask_single_dot = utils.get_sector_mask(l.shape, 
                                                         (k[1], k[0]), 
                                                         25, 
                                                         (0,360))
@@ -549,6 +673,182 @@ def whole_time_sequence(data,
     return
 
 
+def get_lut(cmap):
+    '''
+    The colors of the matplotlib colormap cmap -e.g. utils.PARULA_MAP, utils.nonlinear_custom_map()- as a (N, 3) 
+    uint8 BGR lookup table. Cached by name and size.
+    '''
+    key = (cmap.name, cmap.N)
+    if key not in LUTS:
+        LUTS[key] = np.round(cmap(np.arange(cmap.N))[:, 2::-1]*255).astype(np.uint8)
+    return LUTS[key]
+
+def apply_lut(data, vmin, vmax, lut, nan_color = RASTER_BACKGROUND):
+    '''
+    Maps data -any shape- through lut between vmin and vmax, as pcolormesh does: values out of the limits get the 
+    first and last color, NaNs nan_color. Returns a uint8 BGR array, with a last axis of 3.
+    '''
+    data = np.asarray(data, dtype = np.float32)
+    n = len(lut)
+    scale = n/(vmax - vmin) if vmax > vmin else 0
+    idx = (data - np.float32(vmin))*np.float32(scale)
+    nans = np.isnan(idx)
+    idx[nans] = 0
+    np.clip(idx, 0, n-1, out = idx)
+    img = lut[idx.astype(np.intp)]
+    img[nans] = nan_color
+    return img
+
+def colorbar_raster(height, vmin, vmax, lut, width = 16, font_scale = .4):
+    '''
+    Vertical colorbar of lut, height pixels high, with the vmax and vmin labels on its right.
+    '''
+    labels = [f'{vmax:.3g}', f'{vmin:.3g}']
+    (w, h), _ = cv.getTextSize(max(labels, key = len), RASTER_FONT, font_scale, 1)
+    bar = np.full((height, width + w + 8, 3), RASTER_BACKGROUND, dtype = np.uint8)
+    bar[:, :width] = lut[np.linspace(len(lut)-1, 0, height).astype(np.intp)][:, np.newaxis]
+    cv.putText(bar, labels[0], (width + 4, h + 2), RASTER_FONT, font_scale, RASTER_TEXT, 1, cv.LINE_AA)
+    cv.putText(bar, labels[1], (width + 4, height - 4), RASTER_FONT, font_scale, RASTER_TEXT, 1, cv.LINE_AA)
+    return bar
+
+def raster_mosaic(frames, vmin, vmax, cmap = utils.PARULA_MAP, n_columns = 10, titles = None, mask = None, 
+                  centroids = None, blobs = None, global_cntrds = None, colors_centr = RASTER_COLORS_CENTR, 
+                  title = None, scale = 2, padding = 4, font_scale = None, colorbar = True, origin = 'lower'):
+    '''
+    Fast alternative to the pcolormesh grids: the (n, Y, X) frames are mapped through the LUT of cmap, between vmin
+    and vmax, and tiled n_columns per row, each frame upscaled by scale -nearest-. Titles -one for each frame, on 
+    top of it-, mask -pixels out of it are background-, blob contours, centroids -(x, y) for each frame- and 
+    global centroids -circles- are drawn by OpenCV. With origin 'lower' the first row of the frames is at the bottom, 
+    as in pcolormesh. font_scale follows the tile width, by default. Returns the uint8 BGR image, for cv.imwrite.
+    '''
+    frames = np.asarray(frames)
+    n, h, w = frames.shape
+    if font_scale is None:
+        font_scale = float(np.clip(w*scale/250, .4, 1.5))
+    n_columns = min(n_columns, n)
+    n_rows = int(np.ceil(n/n_columns))
+    img = apply_lut(frames, vmin, vmax, get_lut(cmap))
+    if mask is not None:
+        img[:, ~np.asarray(mask, dtype = bool)] = RASTER_BACKGROUND
+    th, tw = h*scale, w*scale
+    text_h = cv.getTextSize('Ag', RASTER_FONT, font_scale, 1)[0][1] + 6 if titles is not None else 0
+    title_h = cv.getTextSize('Ag', RASTER_FONT, font_scale*1.5, 1)[0][1] + 12 if title is not None else 0
+    grid_h = n_rows*(th + text_h + padding)
+    grid = np.full((grid_h, n_columns*(tw + padding), 3), RASTER_BACKGROUND, dtype = np.uint8)
+    for i in range(n):
+        y0 = (i//n_columns)*(th + text_h + padding) + text_h
+        x0 = (i%n_columns)*(tw + padding)
+        tile = grid[y0:y0+th, x0:x0+tw]
+        tile[:] = img[i].repeat(scale, axis = 0).repeat(scale, axis = 1)
+        if (blobs is not None) and (blobs[i] is not None):
+            contours, _ = cv.findContours(np.asarray(blobs[i], dtype = np.uint8), cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+            cv.drawContours(tile, [c*scale + scale//2 for c in contours], -1, RASTER_TEXT, 1)
+        if (centroids is not None) and (i < len(centroids)):
+            for x, y in centroids[i]:
+                cv.drawMarker(tile, (int(x*scale + scale//2), int(y*scale + scale//2)), RASTER_CENTROID, cv.MARKER_TILTED_CROSS, 2*scale + 4, 2)
+        if global_cntrds is not None:
+            for (x, y), cc in zip(global_cntrds, colors_centr):
+                cv.ellipse(tile, (int(x*scale), int(y*scale)), (25*scale, 25*scale), 0, 0, 360, cc, 1, cv.LINE_AA)
+        if origin == 'lower':
+            tile[:] = tile[::-1].copy()
+        if titles is not None and titles[i]:
+            cv.putText(grid, str(titles[i]), (x0, y0 - 4), RASTER_FONT, font_scale, RASTER_TEXT, 1, cv.LINE_AA)
+    if colorbar:
+        grid = np.hstack([grid, colorbar_raster(grid_h, vmin, vmax, get_lut(cmap), font_scale = font_scale)])
+    if title is not None:
+        band = np.full((title_h, grid.shape[1], 3), RASTER_BACKGROUND, dtype = np.uint8)
+        cv.putText(band, str(title), (padding, title_h - 6), RASTER_FONT, font_scale*1.5, RASTER_TEXT, 1, cv.LINE_AA)
+        grid = np.vstack([band, grid])
+    return grid
+
+def write_raster(path, img):
+    if not cv.imwrite(path, img, RASTER_PNG_PARAMS if path.lower().endswith('.png') else []):
+        print('Failed storing ' + path)
+        return False
+    return True
+
+def time_sequence_raster(start_frame, n_frames_showed, end_frame, data, titles, title_to_print, header, path_, c_ax_= None, circular_mask = True, log_ = None, max_trials = 15, sliced = False, scale = 2):
+    '''
+    time_sequence_visualization as raster mosaics -see raster_mosaic-: same frames, color limits and files, 
+    one row for each trial, with its title on the first frame.
+    '''
+    start_time = datetime.datetime.now()
+    session_name = get_session_name(header['path_session'])
+    considered_frames = (np.arange(n_frames_showed) if sliced else get_considered_frames(start_frame, n_frames_showed, end_frame)).astype(int)
+    if c_ax_ is None:
+        c_ax_ = get_color_limits(data)
+    mask = None
+    if circular_mask:
+        shape = np.shape(data)[-2:]
+        mask = utils.get_sector_mask(shape, (shape[0]//2, shape[1]//2), (np.min(shape))*0.40, (0,360))
+    if not os.path.exists(os.path.join(path_,'activity_maps')):
+        os.makedirs(os.path.join(path_,'activity_maps'))
+    pieces = int(np.ceil(len(data)/max_trials))
+    separators = np.linspace(0, len(data), pieces+1, endpoint=True, dtype=int)
+    for i, n in enumerate(separators):
+        if i != 0:
+            frames = np.concatenate([np.asarray(data[t])[considered_frames] for t in range(separators[i-1], n)])
+            frame_titles = [titles[t] if f == 0 else '' for t in range(separators[i-1], n) for f in range(n_frames_showed)]
+            img = raster_mosaic(frames, c_ax_[0], c_ax_[1], n_columns = n_frames_showed, titles = frame_titles, mask = mask, 
+                                title = f'Session {session_name}', scale = scale)
+            write_raster(os.path.join(path_,'activity_maps', session_name+'_piece0'+str(i)+'_'+str(title_to_print)+'.png'), img)
+    message = 'Plotting heatmaps time: ' +str(datetime.datetime.now()-start_time)
+    if log_ is not None:
+        log_.info(message)
+    else:
+        print(message)
+    return
+
+def whole_time_sequence_raster(data, 
+                               global_cntrds = None, 
+                               colors_centr = RASTER_COLORS_CENTR, 
+                               cntrds = None, 
+                               blbs = None, 
+                               max=80, min=10, 
+                               mask = None, 
+                               name = None, 
+                               blur = True, 
+                               n_columns = 10, 
+                               store_path = STORAGE_PATH,
+                               handle_lims_blobs = ((97.72, 100)), 
+                               name_analysis_ = 'RetinotopicPositions',
+                               max_bord = None,
+                               min_bord = None,
+                               ext= 'png',
+                               mappa = utils.PARULA_MAP,
+                               titles = None,
+                               kern_median = 5,
+                               manual_thresh = None,
+                               flag_simple_thres = False,
+                               scale = 4):
+    '''
+    whole_time_sequence as a raster mosaic -see raster_mosaic-: same blurring, limits, blobs and centroids, 
+    with a single colorbar. The matplotlib version stays for the publication figures. Returns the image.
+    '''
+    data = np.asarray(data)
+    if (max_bord is None) or (min_bord is None):
+        min_bord, max_bord = np.nanpercentile(data, [min, max])
+    if (cntrds is None) and (blbs is None):
+        centroids, blobs = get_blobs(data, mask, handle_lims_blobs = handle_lims_blobs, manual_thresh = manual_thresh, flag_simple_thres = flag_simple_thres)
+    else:
+        centroids, blobs = cntrds, blbs
+    if blur:
+        blurred = np.array([median_filter(np.nan_to_num(l, nan=np.nanmin(l)), (kern_median,kern_median)) for l in data])
+    else:
+        blurred = data
+    if (manual_thresh is not None) and (flag_simple_thres) and (blobs is None):
+        blobs, centroids = map(list, zip(*[simple_threshold_blob(l, mask, manual_thresh) for l in blurred]))
+    elif (blobs is not None) and (mask is not None):
+        blobs = [b*mask for b in blobs]
+    img = raster_mosaic(blurred, min_bord, max_bord, cmap = mappa, n_columns = n_columns, titles = titles, mask = mask, 
+                        centroids = centroids, blobs = blobs, global_cntrds = global_cntrds, colors_centr = colors_centr, scale = scale)
+    print(f'Limits values for heatmaps: {max_bord} - {min_bord}')   
+    if name is not None:
+        tmp = set_storage_folder(storage_path = store_path, name_analysis = name_analysis_)
+        if write_raster(os.path.join(tmp, name + '.'+ext), img):
+            print(name + ext+ ' stored successfully!')
+    return img
+
 def plot_retinotopic_positions(dictionar, titles = ['Inferred centroids', 'Single stroke centroids'], distribution_shown = False, name = None, name_analysis_ = 'RetinotopicPositions', store_path = STORAGE_PATH, ext = '.svg'):#, labs = [ 'Single trial retinotopy', 'Averaged retinotopy']):
     # 
     fig, axs = plt.subplots(1,len(list(dictionar.keys())), figsize=(10*len(list(dictionar.keys())),7))
@@ -1,5 +1,6 @@
 import datetime
 import numpy as np
+import timing
 from scipy.interpolate import interp1d
 
 
@@ -121,6 +122,7 @@ def get_trajectory(xs, ys, limits):
     return xs_to_fit, ys_to_fit
 
 
+@timing.timed('detrend')
 def get_template(detrended_data, 
                  data_heart_beat, 
                  data_sampling_rate = 100, 
@@ -1,4 +1,5 @@
-import argparse, blk_file, datetime, utils
+import argparse, binned_cache, blk_file, blk_manifest, concurrent.futures, datetime, json, render_queue, shutil, timing, trial_store, utils
+from multiprocessing import shared_memory
 import process_vsdi as process
 import data_visualization as dv
 import ana_logs as al
@@ -8,6 +9,14 @@ import os
 from scipy import signal
 
 LABEL_CONDS_PATH = 'metadata/labelConds.txt' 
+# Columnar storage of a Condition: one .npy per array field, memory mapped on access
+CONDITION_SCHEMA_VERSION = 2
+CONDITION_META = 'meta.json'
+CONDITION_OBJECTS = 'objects'
+CONDITION_ARRAYS = ['binned_data', 'df_fz', 'time_course', 'averaged_df', 'averaged_timecourse', 'autoselection', 'z_score']
+# Trials tensors, stored as trial_store.TrialStore with the chunked format
+CONDITION_TRIALS = ['binned_data', 'df_fz']
+STORAGE_FORMATS = ['columnar', 'chunked', 'legacy']
 
 class Condition:
     """
@@ -41,6 +50,12 @@ class Condition:
         The id number for the condition. None as default
     session_header: dict
         The header of the corresponding session: it is useful for instancing important parameters.
+
+    A Condition stored with the columnar format -default- is a folder md_data_cond_name, with a .npy file for each 
+    array field, listed in CONDITION_ARRAYS. Loading it, the arrays are opened lazily: each one is memory mapped 
+    -copy on write- at its first access. The chunked format stores the trials tensors, CONDITION_TRIALS, as 
+    compressed trial_store.TrialStore folders instead: they are read trial by trial, on indexing.
+    The legacy pickle md_data_cond_name.pickle is still loaded.
     """
     def __init__(self, condition_name = None, condition_numb = None, session_header = None):
         self.session_header = session_header
@@ -60,21 +75,92 @@ class Condition:
         self.blk_names = None
         self.trials = None
         self.z_score = None
+        # Array fields not loaded yet, with the path of their .npy file
+        self.lazy_fields = dict()
+
+    def __getattr__(self, name):
+        # Called only for missing attributes: the lazy array fields of a columnar Condition
+        lazy = self.__dict__.get('lazy_fields')
+        if (lazy is None) or (name not in lazy):
+            raise AttributeError(name)
+        path = lazy.pop(name)
+        if os.path.isdir(path):
+            value = trial_store.TrialStore(path)
+        else:
+            value = np.load(path, mmap_mode = 'c', allow_pickle = False)
+        setattr(self, name, value)
+        return value
     
-    def store_cond(self, t):
+    def store_cond(self, t, storage_format = 'columnar', n_workers = 1):
         '''
-        Storing method. All the parameters are wrapped within a list.
-        Built-in storage folder md_data within derivatives. The pickle file takes the name md_data_cond_name
+        Storing method. Built-in storage folder md_data within derivatives. storage_format among STORAGE_FORMATS:
+        columnar: the folder md_data_cond_name, with meta.json, a .npy file for each array field and the 
+        session header and the trials in a small pickle. It is written in a temporary folder and then renamed.
+        chunked: as columnar, but the trials tensors are compressed trial_store.TrialStore folders -n_workers threads-.
+        legacy: all the parameters are wrapped within a list, in the pickle file md_data_cond_name. Out of memory
+        trials tensors -trial_store.DiskTrials, TrialStore or SelectedTrials- are loaded in memory to be pickled.
         '''
-        tp = [self.session_header, self.session_name, self.cond_name, self.cond_id, self.binned_data, self.df_fz, self.time_course, self.averaged_df, self.averaged_timecourse, self.autoselection, self.blk_names, self.trials, self.z_score]
-        utils.inputs_save(tp, os.path.join(t,'md_data','md_data_'+self.cond_name))
+        if storage_format not in STORAGE_FORMATS:
+            raise ValueError(f'Storage format {storage_format} not available: choose among {STORAGE_FORMATS}')
+        path = os.path.join(t,'md_data','md_data_'+self.cond_name)
+        if storage_format == 'legacy':
+            binned_data, df_fz = [v if (v is None) or isinstance(v, np.ndarray) else np.asarray(v) for v in (self.binned_data, self.df_fz)]
+            tp = [self.session_header, self.session_name, self.cond_name, self.cond_id, binned_data, df_fz, self.time_course, self.averaged_df, self.averaged_timecourse, self.autoselection, self.blk_names, self.trials, self.z_score]
+            utils.inputs_save(tp, path)
+            return
+        self.store_columnar(path, chunked = storage_format == 'chunked', n_workers = n_workers)
+        return
+
+    def store_columnar(self, path, chunked = False, n_workers = 1):
+        tmp = path + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        arrays = list()
+        trials = list()
+        for field in CONDITION_ARRAYS:
+            value = getattr(self, field)
+            if value is None:
+                continue
+            if chunked and (field in CONDITION_TRIALS):
+                store = trial_store.TrialStore(os.path.join(tmp, field), mode = 'w', codec = trial_store.best_codec(), n_workers = n_workers)
+                # n_workers trials at once, compressed in parallel: a TrialStore being converted is never read all together
+                step = max(1, n_workers)
+                for i in range(0, len(value), step):
+                    store.append(value[i:i+step], names = None if self.blk_names is None else list(self.blk_names[i:i+step]))
+                trials.append(field)
+            elif (field in CONDITION_TRIALS) and (not isinstance(value, np.ndarray)):
+                # Out of memory trials tensors are written trial by trial
+                trial_store.save_npy(os.path.join(tmp, field + '.npy'), value)
+                arrays.append(field)
+            else:
+                np.save(os.path.join(tmp, field + '.npy'), np.asarray(value), allow_pickle = False)
+                arrays.append(field)
+        utils.inputs_save([self.session_header, self.trials], os.path.join(tmp, CONDITION_OBJECTS))
+        meta = {'schema_version': CONDITION_SCHEMA_VERSION,
+                'session_name': self.session_name,
+                'cond_name': self.cond_name,
+                'cond_id': None if self.cond_id is None else int(self.cond_id),
+                'blk_names': None if self.blk_names is None else [str(b) for b in self.blk_names],
+                'arrays': arrays,
+                'trial_stores': trials}
+        with open(os.path.join(tmp, CONDITION_META), 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
         return
     
     def load_cond(self, path):
         '''
-        Loading method. All the parameters are unwrapped from a list.
-        It can be problematic from versioning.
+        Loading method. path is the condition path without extension: md_data/md_data_cond_name.
+        If the columnar folder exists, meta.json and the pickled header and trials are read, and the arrays are 
+        memory mapped at their first access. Otherwise the legacy pickle is loaded, and all the parameters are 
+        unwrapped from a list.
         '''
+        if os.path.isdir(path):
+            self.load_columnar(path)
+            return
         tp = utils.inputs_load(path)
         self.session_header = tp[0]
         self.session_name = tp[1]
@@ -93,6 +179,30 @@ class Condition:
         except:
             print('z_score attribute not found')
         return
+
+    def load_columnar(self, path):
+        with open(os.path.join(path, CONDITION_META)) as f:
+            meta = json.load(f)
+        version = meta.get('schema_version')
+        # Version 1 had no trial stores
+        if version not in (1, CONDITION_SCHEMA_VERSION):
+            raise ValueError(f'Condition schema version {version} not supported: {path}')
+        self.session_header, self.trials = utils.inputs_load(os.path.join(path, CONDITION_OBJECTS))
+        self.session_name = meta['session_name']
+        self.cond_name = meta['cond_name']
+        self.cond_id = meta['cond_id']
+        self.blk_names = meta['blk_names']
+        self.lazy_fields = dict()
+        for field in CONDITION_ARRAYS:
+            # Removed from the instance: __getattr__ loads it at the first access
+            self.__dict__.pop(field, None)
+            if field in meta['arrays']:
+                self.lazy_fields[field] = os.path.join(path, field + '.npy')
+            elif field in meta.get('trial_stores', list()):
+                self.lazy_fields[field] = os.path.join(path, field)
+            else:
+                setattr(self, field, None)
+        return
     
     def get_behav_latency(self, blank_id):
         '''
@@ -117,6 +227,167 @@ class Condition:
         return (([trial.orientation for trial in self.trials.values()], [trial.orientation_outcome for trial in self.trials.values()]))
 
 
+class TrialAccumulator:
+    '''
+    Streaming statistics over the trials blks of a condition: a process.Welford accumulator of dF/F0 and, if zero_of_cond 
+    is given, one of F/F0 normalized on the zero_of_cond frames -for the z-score-.
+    update has the signal_extraction on_trial signature. Binned signal and dF/F0 of each trial are written, by trial 
+    index, in the raws and delta_f trials tensors: arrays if they fit in header['max_memory'] GB, otherwise -and 
+    without max_memory- trial_store.DiskTrials in the derivatives folder. remove_trials takes the discarded trials 
+    out of the accumulators reading them back, at binned size, instead of the BLKs.
+    '''
+    def __init__(self, blks, header, zero_of_cond = None, log = None):
+        self.index = {blk_name: i for i, blk_name in enumerate(blks)}
+        self.header = header
+        self.zero_of_cond = zero_of_cond
+        self.log = log
+        self.df_f0 = None
+        self.f_f0 = None
+        self.raws = None
+        self.delta_f = None
+
+    def allocate(self, shape):
+        # Streaming does not hold the trials in memory, unless a budget allows it
+        header = dict(self.header, max_memory = self.header.get('max_memory', None) or 0)
+        shape = (len(self.index),) + shape
+        self.raws = allocate_trials(shape, header, log = self.log)
+        self.delta_f = allocate_trials(shape, header)
+        self.df_f0 = process.Welford(shape[1:])
+        if self.zero_of_cond is not None:
+            self.f_f0 = process.Welford(shape[1:])
+
+    def get_f_f0(self, binned_signal):
+        return process.deltaf_up_fzero(binned_signal, self.zero_of_cond, deblank = True, blank_sign = None)
+
+    def update(self, blk_name, binned_signal, df_f0):
+        if self.df_f0 is None:
+            self.allocate(df_f0.shape)
+        i = self.index[blk_name]
+        self.raws[i] = binned_signal
+        self.delta_f[i] = df_f0
+        self.df_f0.update(df_f0)
+        if self.zero_of_cond is not None:
+            self.f_f0.update(self.get_f_f0(binned_signal))
+
+    def remove_trials(self, indeces):
+        for i in indeces:
+            self.df_f0.remove(self.delta_f[i])
+            if self.zero_of_cond is not None:
+                self.f_f0.remove(self.get_f_f0(self.raws[i]))
+
+    def close(self):
+        if isinstance(self.raws, trial_store.DiskTrials):
+            self.raws.close()
+            self.delta_f.close()
+
+# Name of the incremental state file, in the md folder of the session
+INCREMENTAL_STATE = 'incremental_state'
+# Folder of the incremental trial stores, in the md folder of the session: a subfolder for condition id
+INCREMENTAL_TRIALS = 'incremental_trials'
+# Header fields the incremental state depends on: if one changes, the state is discarded
+INCREMENTAL_SIGNATURE = ['spatial_bin', 'temporal_bin', 'bin_mode', 'dtype', 'frame_window', 'crop', 'detrend_switch', 'deblank_switch', 'strategy', 'chunks', 'tolerance', 'zero_frames']
+
+class IncrementalCondition:
+    '''
+    Persistent state of a condition, for the incremental processing -see Session.get_signal_incremental-:
+    the BLKs processed, their zero frames, time courses and Trial objects, the pairwise loss matrix of the 
+    autoselection, the selection mask and a process.Welford accumulator of the F/F0 -normalized on the zero frames
+    of each trial, not deblanked- of the selected trials. Deblanking and z-score are applied to the averages, with 
+    the current blank statistics. The time courses keep the blank of when their trials were processed.
+    Binned signal and dF/F0 of the trials are appended to two trial_store.TrialStore -see open_trials-, in the 
+    processing order and named by BLK: they are not pickled with the state. keep has the signal_extraction on_trial 
+    signature; add and remove read the trial back from the store.
+    '''
+    def __init__(self):
+        self.blks = list()
+        self.zeros = dict()
+        self.conditions = list()
+        self.trials = None
+        self.sig = None
+        self.losses = None
+        self.mask = np.zeros(0, dtype=int)
+        self.acc = None
+        # F/F0 of the trials just loaded, until the selection: not stored
+        self.pending = dict()
+        self.raws = None
+        self.delta_f = None
+        self.shift = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pending'] = dict()
+        state['raws'] = None
+        state['delta_f'] = None
+        return state
+
+    def open_trials(self, path, mode = 'a', shift = 0, n_workers = 1):
+        '''
+        Opens the trial stores binned_data and df_fz in the folder path. shift is subtracted from the dF/F0 appended
+        -1 for the blank, stored as dF/F0 as in get_signal-.
+        Returns False if the stores do not hold the trials of the state -e.g. a run interrupted before storing it-.
+        '''
+        self.shift = shift
+        self.raws = trial_store.TrialStore(os.path.join(path, 'binned_data'), mode = mode, codec = trial_store.best_codec(), n_workers = n_workers)
+        self.delta_f = trial_store.TrialStore(os.path.join(path, 'df_fz'), mode = mode, codec = trial_store.best_codec(), n_workers = n_workers)
+        return sorted(self.raws.names) == sorted(self.delta_f.names) == sorted(self.blks)
+
+    def get_trials(self, store):
+        '''
+        The trials of store in the order of blks, read lazily.
+        '''
+        index = {blk_name: i for i, blk_name in enumerate(store.names)}
+        return SelectedTrials(store, [index[blk_name] for blk_name in self.blks])
+
+    def get_f_f0(self, blk_name, binned_signal):
+        return process.deltaf_up_fzero(binned_signal, self.zeros[blk_name], deblank = True, blank_sign = None)
+
+    def keep(self, blk_name, binned_signal, df_f0):
+        self.raws.append(binned_signal, names = [blk_name])
+        self.delta_f.append(df_f0 - self.shift, names = [blk_name])
+        self.pending[blk_name] = self.get_f_f0(blk_name, binned_signal)
+
+    def add(self, blk_name):
+        f_f0 = self.get_f_f0(blk_name, self.raws[self.raws.names.index(blk_name)])
+        if self.acc is None:
+            self.acc = process.Welford(f_f0.shape)
+        self.acc.update(f_f0)
+
+    def remove(self, blk_name):
+        self.acc.remove(self.get_f_f0(blk_name, self.raws[self.raws.names.index(blk_name)]))
+
+# I/O, precision and parallelism options of a Session, with their defaults: see Session and get_session_options
+SESSION_OPTIONS = {'bin_mode': 'linear',
+                   'dtype': 'float64',
+                   'frame_window': None,
+                   'crop': None,
+                   'n_workers': 1,
+                   'pool': 'thread',
+                   'max_in_flight': None,
+                   'prefetch': 0,
+                   'streaming': False,
+                   'storage_format': 'columnar',
+                   'cache_gb': 0,
+                   'cond_workers': 1,
+                   'max_memory': None,
+                   'incremental': False,
+                   'profile': False,
+                   'render_workers': 0,
+                   'renderer': 'matplotlib'}
+
+def get_session_options(options = None, **kwargs):
+    '''
+    The SESSION_OPTIONS defaults, updated with the options dict and then with the keyword arguments named as an 
+    option -e.g. the parsed command line-. The other keyword arguments are ignored.
+    '''
+    session_options = dict(SESSION_OPTIONS)
+    if options is not None:
+        unknown = [k for k in options if k not in SESSION_OPTIONS]
+        if len(unknown) > 0:
+            raise ValueError(f'Session options {unknown} not available: choose among {list(SESSION_OPTIONS)}')
+        session_options.update(options)
+    session_options.update({k: v for k, v in kwargs.items() if k in SESSION_OPTIONS})
+    return session_options
+
 # Inserting inside the class variables and features useful for one session: we needs an object at this level for
 # keeping track of conditions, filenames, selected or not flag for each trial.
 class Session:
@@ -141,6 +412,7 @@ class Session:
                  data_vis_switch = True, 
                  end_frame = None,
                  filename_particle = 'vsd_C', 
+                 options = None,
                  **kwargs):
         """
         Initializes attributes
@@ -222,33 +494,89 @@ class Session:
             Switch for storing of figures of processing and preprocessing.
         end_frame: int
             The index of the considered ending frame. None by defaults
+        options: dict
+            I/O, precision and parallelism options, copied in the header. The keys are the ones of SESSION_OPTIONS, 
+            with their defaults. Each option can be given as keyword argument too -e.g. n_workers = 4, as the command 
+            line does-: see get_session_options.
+            bin_mode: str
+                Spatial binning mode: 'linear' interpolation or 'area' block mean. linear by default
+            dtype: str
+                Precision of binned signals, dF/F0, time courses, z-scores and stored conditions: 'float64' or 'float32'.
+                Averages are accumulated in float64 anyway. float64 by default
+            frame_window: tuple
+                (start, stop) frames read from each BLK: e.g. (0, ending frame) for zero frames plus frames of interest. 
+                zero_frames and ending_frame count from start. None by default: all the frames
+            crop: tuple
+                (y0, y1, x0, x1) field of view read from each BLK, in pixels of the raw frame. None by default: the whole frame
+            n_workers: int
+                Number of workers loading the trials of a condition concurrently. 1 by default: serial loading
+            pool: str
+                Kind of workers: 'thread' -BLK decoding and binning release the GIL- or 'process'. thread by default
+            max_in_flight: int
+                Maximum number of trials loaded at the same time, for bounding the memory. None by default: 2*n_workers
+            prefetch: int
+                Number of BLKs read ahead in background, with serial loading: each one is held in memory. 0 by default: no readahead
+            streaming: bool
+                Switch for streaming processing: averages and standard errors are accumulated trial by trial, without holding
+                all the trials of a condition in memory. See get_signal_streaming. False by default
+            storage_format: str
+                Storage format of the Conditions, among STORAGE_FORMATS: see Condition.store_cond. columnar by default
+            cache_gb: float
+                Size in GB of the session cache of the binned signals -see binned_cache-, reused by the next runs. 0 by default: 
+                no cache
+            cond_workers: int
+                Number of processes computing the conditions after the blank one, in get_session. 1 by default: serial
+            max_memory: float
+                Memory budget in GB of the trials tensors of a condition: over it they are stored on disk, and processed 
+                trial by trial. None by default: no budget
+            incremental: bool
+                Switch for incremental processing: the state of each condition is kept in the md folder, and a new run 
+                processes only the BLKs arrived in rawdata since the previous one. See get_signal_incremental. False by default
+            profile: bool
+                Switch for the timings of the run: each stage -header, read, map, bin, detrend, dF/F0, ROI, selection, z-score, 
+                store, plot- is written as JSON lines in derivatives/profiles. See timing. False by default
+            render_workers: int
+                Number of processes rendering the figures in background, while the computation goes on -see render_queue-.
+                0 by default: the figures are rendered in place
+            renderer: str
+                'matplotlib' -by default- or 'raster': the activity maps as colormap lookups in a raster mosaic, written 
+                by OpenCV -see data_visualization.raster_mosaic-. Much faster, the matplotlib figures are for publication
         """
+        start_header = timing.now()
         if logger is None:
             self.log = utils.setup_custom_logger('myapp')
         else:
             self.log = logger
         self.detrend_switch = detrend_switch              
         self.cond_names = None
-        self.header = self.get_session_header(path_session, spatial_bin, temporal_bin, tolerance, mov_switch, deblank_switch, conditions_id, chunks, strategy, logs_switch)
-        self.all_blks = get_all_blks(self.header['path_session'], sort = True) # all the blks, sorted by creation date -written on the filename-.
+        self.header = self.get_session_header(path_session, spatial_bin, temporal_bin, tolerance, mov_switch, deblank_switch, conditions_id, chunks, strategy, logs_switch, options = get_session_options(options, **kwargs))
+        self.filename_particle = filename_particle
+        # Timings of the run: the spans of all the stages, and of the workers, are recorded in it
+        self.profile = None
+        if self.header['profile']:
+            run = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+            self.profile = timing.Profile(timing.get_profile_path(self.header['path_session'], run), run = run)
+        timing.set_profile(self.profile)
+        # Index of rawdata: names, conditions, timestamps and header summaries, refreshed only for new BLKs. Stored in derivatives
+        self.manifest = blk_manifest.get_manifest(self.header['path_session'], filename_particle = self.filename_particle, store = True)
+        self.all_blks = self.manifest.blks(sort = True) # all the blks, sorted by creation date -written on the filename-.
         if len(self.all_blks) == 0:
             print('Check the path: no blks found')
         self.cond_dict = self.get_condition_name()
         self.cond_names = list(self.cond_dict.values())
         self.blank_id = get_blank_id(self.cond_names, cond_id=condid)
-        self.filename_particle = filename_particle
 
         # This can be automatized, with zero_frames, extracting parameters from BaseReport
         # Avoiding to load a BLK file
-        # A blk loaded for useful hyperparameters
-        blk = blk_file.BlkFile(os.path.join(self.header['path_session'],'rawdata', self.all_blks[np.random.randint(len(self.all_blks)-1)]), 
-                               self.header['spatial_bin'], 
-                               self.header['temporal_bin'],
-                               detrend_switch    = self.detrend_switch,
-                               filename_particle = self.filename_particle)
-        self.header['n_frames'] = blk.header['nframesperstim']
-        self.header['original_height'] = blk.header['frameheight']
-        self.header['original_width'] = blk.header['framewidth']
+        # The header summary of a BLK, from the manifest, for useful hyperparameters: no BLK is opened
+        self.header_cache = blk_file.HeaderCache()
+        blk_name = self.all_blks[np.random.randint(len(self.all_blks)-1)]
+        blk_header = self.manifest.header(blk_name)
+        if blk_header is None:
+            blk_header = self.header_cache.get(os.path.join(self.header['path_session'],'rawdata', blk_name))
+        self.header['n_frames'] = blk_header['nframesperstim']
+        self.header['original_height'] = blk_header['frameheight']
+        self.header['original_width'] = blk_header['framewidth']
         
         # Setting key frames
         if end_frame is None:
@@ -264,7 +592,7 @@ class Session:
         # If considered conditions are not explicitly indicated, then all the conditions are considered
         # The adjustment of conditions_id set has to be done ALWAYS before the session_blks extraction       
         if self.header['conditions_id'] is None:
-            self.header['conditions_id'] = get_condition_ids(self.all_blks, filename_particle = self.filename_particle)
+            self.header['conditions_id'] = self.manifest.condition_ids()
         else:
             self.header['conditions_id'] = list(set(self.header['conditions_id']+[self.blank_id]))
         # only the used blks for the selection
@@ -288,7 +616,7 @@ class Session:
         # Loading the BaseReport and SignalData in case of logs_switch
         if self.header['logs_switch']:
             try:
-                start_time = datetime.datetime.now().replace(microsecond=0)
+                start_time = timing.now()
                 self.log.info(f'Length of all_blks list: {len(self.all_blks)}')
                 base_report, _ = al.get_basereport(self.header['path_session'], self.all_blks, name_report = base_report_name, header_dimension = base_head_dim)
                 # Separator converter processing: , -string- to . -float-.
@@ -311,27 +639,33 @@ class Session:
                     self.log.info(f'Length of all_blks list after popping off from get_basereport: {len(self.all_blks)}')
 
                 self.log.info('BaseReport properly loaded!')
-                self.log.info('BaseReport loading time: ' +str(datetime.datetime.now().replace(microsecond=0)-start_time))
-                start_time = datetime.datetime.now().replace(microsecond=0)
+                self.log.info(f'BaseReport loading time: {(timing.now()-start_time)/1e9:.3f} s')
+                start_time = timing.now()
                 self.time_stamp, self.piezo, self.heart_beat, self.toogle, self.triginstim, ((self.starting_times, self.ending_times)), self.affidability = al.get_analog_signal(self.header['path_session'], self.base_report, name_report = 'SignalData.csv')
                 self.log.info('Piezo and Heart Beat signals properly loaded!')
-                self.log.info('Analogic signals loading time: ' +str(datetime.datetime.now().replace(microsecond=0)-start_time))
+                self.log.info(f'Analogic signals loading time: {(timing.now()-start_time)/1e9:.3f} s')
                 self.base_report = self.base_report.loc[(self.base_report['Preceding Event IT'] == 'FixCorrect')] 
             except:
                 self.log.info('Something went wrong loading the BaseReport or SignalData')
                 self.base_report, self.time_stamp, self.piezo, self.heart_beat,   = None, None, None, None
-                self.toogle, self.triginstim, ((self.starting_times, self.ending_times)), self.affidability  = None, None, None, None
+                self.toogle, self.triginstim, ((self.starting_times, self.ending_times)), self.affidability  = None, None, (None, None), None
             #try:
             #    path_trackreport = utils.find_thing('TrackerLog.csv', self.header['path_session'])
             #except:
             #    self.log('Something went wrong loading the TrackerLog')
         else:
             self.base_report, self.time_stamp, self.piezo, self.heart_beat  = None, None, None, None
-            self.toogle, self.triginstim, ((self.starting_times, self.ending_times)), self.affidability  = None, None, None, None
+            self.toogle, self.triginstim, ((self.starting_times, self.ending_times)), self.affidability  = None, None, (None, None), None
+
+        timing.record('header', start_header, trials = len(self.all_blks))
 
         self.time_course_blank = None
         self.f_f0_blank = None
         self.stde_f_f0_blank = None
+        # Loaded at the first incremental get_signal
+        self.incremental_state = None
+        # Started at the first figure, with render_workers > 0
+        self.render_queue = None
         if self.header['deblank_switch']:
         # TO NOTICE: deblank_switch add roi_signals, df_fz, auto_selected, conditions, counter_blank and overwrites the session_blks
             # Calling get_signal in the instantiation of Session allows to obtain the blank signal immediately.
@@ -360,16 +694,22 @@ class Session:
                 appended to existing class attributes. Visualization and storage are handled in the same way.
             Various data and variables are deleted from memory to free up resources.
             The method returns a binary mask based on a selection criterion for trials.
+            Averages and standard deviations over the selected trials are computed one trial at a time 
+            -process.trials_nanmean_std-: with header['max_memory'] the trials tensors can be trial_store.DiskTrials.
             
         '''
+        if self.header.get('incremental', False):
+            return self.get_signal_incremental(condition)
+        if self.header.get('streaming', False):
+            return self.get_signal_streaming(condition)
         # All the blank blks
-        blks = [f for f in self.all_blks if (int(f.split(self.filename_particle)[1][0:2])==condition)]
+        blks = [f for f in self.all_blks if self.manifest.condition(f) == condition]
         zero_of_cond = self.header['zero_frames']
         end_of_cond = self.header['ending_frame']
         # Blank signal extraction
         self.log.info(f'Trials of condition {condition} loading starts:')
         if condition == self.blank_id:
-            sig, df_f0, conditions, raws, trials = signal_extraction(self.header, blks, None, self.header['deblank_switch'], self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat, detrend = self.detrend_switch, filename_particle = self.filename_particle)
+            sig, df_f0, conditions, raws, trials = signal_extraction(self.header, blks, None, self.header['deblank_switch'], self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat, detrend = self.detrend_switch, filename_particle = self.filename_particle, header_cache = self.header_cache)
             size_df_f0 = np.shape(df_f0)
             # For sake of storing coherently, the F/F0 has to be demeaned: dF/F0. 
             # But the one for normalization is kept without demean
@@ -382,19 +722,19 @@ class Session:
             indeces_select = np.where(self.auto_selected==1)
             indeces_select = indeces_select[0].tolist()      
             # In this order for deblank signal
-            tmp = np.nanmean(df_f0[indeces_select, :, :, :], axis=0)
-            tmp_std = np.nanstd(df_f0[indeces_select, :, :, :], axis=0)
+            tmp, tmp_std = process.trials_nanmean_std(df_f0, indeces_select, std = True)
             self.f_f0_blank = tmp
             self.stde_f_f0_blank = tmp_std/np.sqrt(len(indeces_select))
-            z = process.zeta_score(df_f0[indeces_select, :, :, :], self.f_f0_blank, self.stde_f_f0_blank)
+            z = process.zeta_score(tmp, self.f_f0_blank, self.stde_f_f0_blank, full_seq = True)
             # Signal for zscore: it is the raw signal binned, only normalized for the average frame among the zero frames.
             print(f'Shape z_score {z.shape}')
             self.z_score = np.reshape(z, (1, tmp.shape[0], tmp.shape[1], tmp.shape[2]))
-            # Subtraction for 1 equivalent to deblanking (F0) -dF/F0-
-            df_f0 = df_f0 - 1
-            self.avrgd_df_fz = np.reshape(np.nanmean(df_f0[indeces_select, :, :, :], axis=0), (1, tmp.shape[0], tmp.shape[1], tmp.shape[2]))
+            # Subtraction for 1 equivalent to deblanking (F0) -dF/F0-. Trial by trial, in place: no copy of the tensor
+            for i in range(len(df_f0)):
+                df_f0[i] -= 1
+            self.avrgd_df_fz = np.reshape(process.trials_nanmean_std(df_f0, indeces_select), (1, tmp.shape[0], tmp.shape[1], tmp.shape[2]))
             # Average time course over the condition
-            tmp_ = np.nanmean(sig[indeces_select, :], axis=0)
+            tmp_ = process.precise_nanmean(sig[indeces_select, :], axis=0)
             self.avrgd_time_courses = np.reshape(tmp_, (1, tmp.shape[0]))
             # It's important that 1 is not subtracted to this blank_df: it is the actual blank signal
             # employed for normalize the signal             
@@ -402,7 +742,7 @@ class Session:
             self.log.info('Blank signal computed')
                         
         else:
-            sig, df_f0, conditions, raws, trials = signal_extraction(self.header, blks, self.f_f0_blank, self.header['deblank_switch'], self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat, detrend= self.detrend_switch, filename_particle = self.filename_particle)
+            sig, df_f0, conditions, raws, trials = signal_extraction(self.header, blks, self.f_f0_blank, self.header['deblank_switch'], self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat, detrend= self.detrend_switch, filename_particle = self.filename_particle, header_cache = self.header_cache)
             mask = self.get_selection_trials(condition, sig)
             self.conditions = self.conditions + conditions
             self.auto_selected = np.array(self.auto_selected.tolist() + mask.tolist(), dtype=int)
@@ -410,10 +750,10 @@ class Session:
             indeces_select = np.where(np.array(mask)==1)
             indeces_select = indeces_select[0].tolist()
             #df_f0 = df_f0.reshape(1, df_f0.shape[1], df_f0.shape[2], df_f0.shape[3] ) 
-            t =  np.nanmean(df_f0[indeces_select, :, :, :], axis=0)
+            t =  process.trials_nanmean_std(df_f0, indeces_select)
             self.avrgd_df_fz = np.concatenate((self.avrgd_df_fz, t.reshape(1, t.shape[0], t.shape[1], t.shape[2])), axis=0) 
             self.log.info(f'Shape averaged dF/F0: {np.shape(self.avrgd_df_fz )}')
-            t_ =  np.nanmean(sig[indeces_select, :], axis=0)
+            t_ =  process.precise_nanmean(sig[indeces_select, :], axis=0)
             self.avrgd_time_courses = np.concatenate((self.avrgd_time_courses,  t_.reshape(1,  t_.shape[0])), axis=0) 
             self.log.info(f'Shape averaged tc: {np.shape(self.avrgd_time_courses )}')
             if self.base_report is not None:
@@ -422,10 +762,10 @@ class Session:
                 print('Average Prestimulus time: ') 
                 print(np.nanmean([v.onset_stim - v.start_stim for v in trials.values()]))
                 end_of_cond = zero_of_cond + foi_of_cond
-            temp_raw = raws[indeces_select, :, :, :]
-            t_ = np.array([process.deltaf_up_fzero(i, zero_of_cond, deblank = True, blank_sign=None) for i in temp_raw])
+            # Average F/F0 of the selected raw trials, normalized on their zero frames
+            t_ = process.trials_nanmean_std(raws, indeces_select, transform = lambda i: process.deltaf_up_fzero(i, zero_of_cond, deblank = True, blank_sign=None))
             #z = process.zeta_score(self.avrgd_df_fz[-1, :, :, :], None, None, full_seq = True)
-            z = process.zeta_score(t_, self.f_f0_blank, self.stde_f_f0_blank)
+            z = process.zeta_score(t_, self.f_f0_blank, self.stde_f_f0_blank, full_seq = True)
              #def zeta_score(sig_cond, sig_blank, std_blank, zero_frames = 20):
 
             self.z_score = np.concatenate((self.z_score, z.reshape(1, z.shape[0], z.shape[1], z.shape[2])), axis=0) 
@@ -434,11 +774,12 @@ class Session:
         if self.visualization_switch:
             self.roi_plots(condition, sig, mask, blks)
             self.log.info(f'Zero frames {zero_of_cond}, n° of considered frames {20} and end of frames {int((end_of_cond))}')
-            dv.time_sequence_visualization(zero_of_cond, 20, end_of_cond, df_f0[indeces_select, :, :, :], np.array(blks)[indeces_select], 'cond'+str(condition), self.header, self.set_md_folder(), log_ = self.log, max_trials = 20)
+            with timing.span('plot', condition = condition):
+                self.render_time_sequence(zero_of_cond, end_of_cond, SelectedTrials(df_f0, indeces_select), np.array(blks)[indeces_select], 'cond'+str(condition))
 
         # If storage switch True, than a Condition object is instantiate and stored
         if self.storage_switch:
-            start_time = datetime.datetime.now().replace(microsecond=0)
+            start_time = timing.now()
             cond = Condition(self.cond_dict[condition], condition, self.header)
             cond.binned_data = raws
             cond.df_fz = df_f0
@@ -454,15 +795,279 @@ class Session:
             t = self.set_md_folder()
             if not os.path.exists(os.path.join(t,'md_data')):
                 os.makedirs(os.path.join(t,'md_data'))
-            cond.store_cond(t)
+            cond.store_cond(t, storage_format = self.header.get('storage_format', 'columnar'), n_workers = self.header.get('n_workers', 1))
             del cond
-            self.log.info('Storing condition time: ' +str(datetime.datetime.now().replace(microsecond=0)-start_time))                
+            self.log.info(f"Storing condition time: {timing.record('store', start_time, condition = condition)/1e9:.3f} s")                
+        if isinstance(raws, trial_store.DiskTrials):
+            raws.close()
+            df_f0.close()
         del df_f0
         del raws
         del sig
         del trials
         return mask
 
+    def get_signal_streaming(self, condition):
+        '''
+        Streaming version of get_signal, used if header['streaming'] is True. The outcome -averages, standard errors, 
+        z-scores, time courses, autoselection and stored Condition- is the same, but the trials are never held all 
+        together: each loaded trial updates the process.Welford accumulators of a TrialAccumulator, and it is written 
+        on disk -see TrialAccumulator-. The memory does not grow with the number of trials.
+        The autoselection needs only the time courses: the discarded trials are read back from the TrialAccumulator,
+        not from the BLKs, and removed from the accumulators.
+        '''
+        blks = [f for f in self.all_blks if self.manifest.condition(f) == condition]
+        zero_of_cond = self.header['zero_frames']
+        end_of_cond = self.header['ending_frame']
+        self.log.info(f'Trials of condition {condition} streaming starts:')
+        trials, zeros = resolve_trials(self.header, blks, self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat, log = self.log, filename_particle = self.filename_particle)
+        if condition == self.blank_id:
+            blank_s = None
+            acc = TrialAccumulator(blks, self.header, log = self.log)
+        else:
+            blank_s = self.f_f0_blank
+            # The zero frames of the condition are known from the trials, before loading: F/F0 for the z-score is streamed too
+            if self.base_report is not None:
+                zero_of_cond = int(np.nanmean([v.zero_frames for v in trials.values()]))
+                foi_of_cond = int(np.nanmean([v.FOI for v in trials.values()]))
+                print('Average Prestimulus time: ') 
+                print(np.nanmean([v.onset_stim - v.start_stim for v in trials.values()]))
+                end_of_cond = zero_of_cond + foi_of_cond
+            acc = TrialAccumulator(blks, self.header, zero_of_cond = zero_of_cond, log = self.log)
+        extraction_args = (blank_s, self.header['deblank_switch'], self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat)
+        extraction_kwargs = dict(detrend = self.detrend_switch, filename_particle = self.filename_particle, header_cache = self.header_cache)
+        sig, _, conditions, _, _ = signal_extraction(self.header, blks, *extraction_args, resolved = (trials, zeros), on_trial = acc.update, **extraction_kwargs)
+        if condition == self.blank_id:
+            sig = sig - 1
+            self.counter_blank = len(blks)
+        mask = self.get_selection_trials(condition, sig)
+        # Autoselection: the discarded trials are read back, and removed from the accumulators
+        discarded = [i for i, m in enumerate(mask) if m == 0]
+        if len(discarded) > 0:
+            self.log.info(f'{len(discarded)} discarded trials removed from the averages')
+            acc.remove_trials(discarded)
+        indeces_select = np.where(np.array(mask)==1)[0].tolist()
+        dtype = self.header.get('dtype', 'float64')
+        mean_df_f0 = acc.df_f0.mean(dtype = dtype)
+
+        if condition == self.blank_id:
+            self.conditions = conditions
+            self.auto_selected = mask
+            self.session_blks = blks
+            # In this order for deblank signal
+            self.f_f0_blank = mean_df_f0
+            self.stde_f_f0_blank = acc.df_f0.std(dtype = dtype)/np.sqrt(len(indeces_select))
+            z = process.zeta_score(mean_df_f0, self.f_f0_blank, self.stde_f_f0_blank, full_seq = True)
+            print(f'Shape z_score {z.shape}')
+            self.z_score = np.reshape(z, (1,) + z.shape)
+            # Subtraction for 1 equivalent to deblanking (F0) -dF/F0-
+            self.avrgd_df_fz = np.reshape(mean_df_f0 - 1, (1,) + mean_df_f0.shape)
+            # The stored blank trials are dF/F0, as in get_signal
+            for i in range(len(acc.delta_f)):
+                acc.delta_f[i] = acc.delta_f[i] - 1
+            tmp_ = process.precise_nanmean(sig[indeces_select, :], axis=0)
+            self.avrgd_time_courses = np.reshape(tmp_, (1, tmp_.shape[0]))
+            self.time_course_blank = tmp_
+            self.log.info('Blank signal computed')
+        else:
+            self.conditions = self.conditions + conditions
+            self.auto_selected = np.array(self.auto_selected.tolist() + mask.tolist(), dtype=int)
+            self.session_blks = self.session_blks + blks
+            self.avrgd_df_fz = np.concatenate((self.avrgd_df_fz, np.reshape(mean_df_f0, (1,) + mean_df_f0.shape)), axis=0) 
+            self.log.info(f'Shape averaged dF/F0: {np.shape(self.avrgd_df_fz )}')
+            t_ =  process.precise_nanmean(sig[indeces_select, :], axis=0)
+            self.avrgd_time_courses = np.concatenate((self.avrgd_time_courses,  t_.reshape(1,  t_.shape[0])), axis=0) 
+            self.log.info(f'Shape averaged tc: {np.shape(self.avrgd_time_courses )}')
+            z = process.zeta_score(acc.f_f0.mean(dtype = dtype), self.f_f0_blank, self.stde_f_f0_blank, full_seq = True)
+            self.z_score = np.concatenate((self.z_score, z.reshape(1, z.shape[0], z.shape[1], z.shape[2])), axis=0) 
+
+        if self.visualization_switch:
+            self.roi_plots(condition, sig, mask, blks)
+            self.log.info(f'Zero frames {zero_of_cond}, n° of considered frames {20} and end of frames {int((end_of_cond))}')
+            with timing.span('plot', condition = condition):
+                self.render_time_sequence(zero_of_cond, end_of_cond, SelectedTrials(acc.delta_f, indeces_select), np.array(blks)[indeces_select], 'cond'+str(condition))
+
+        # If storage switch True, than a Condition object is instantiate and stored
+        if self.storage_switch:
+            start_time = timing.now()
+            cond = Condition(self.cond_dict[condition], condition, self.header)
+            cond.binned_data = acc.raws
+            cond.df_fz = acc.delta_f
+            cond.time_course = sig
+            cond.autoselection = mask
+            cond.blk_names = blks
+            cond.averaged_df = self.avrgd_df_fz[-1, :, :, :]
+            cond.z_score = self.z_score[-1, :, :, :]
+            cond.averaged_timecourse = self.avrgd_time_courses[-1, :]
+            if self.base_report is not None:
+                cond.trials = trials
+            #Storing folder
+            t = self.set_md_folder()
+            if not os.path.exists(os.path.join(t,'md_data')):
+                os.makedirs(os.path.join(t,'md_data'))
+            cond.store_cond(t, storage_format = self.header.get('storage_format', 'columnar'), n_workers = self.header.get('n_workers', 1))
+            del cond
+            self.log.info(f"Storing condition time: {timing.record('store', start_time, condition = condition)/1e9:.3f} s")                
+        acc.close()
+        del acc
+        return mask
+
+    def get_signal_incremental(self, condition):
+        '''
+        Incremental version of get_signal, used if header['incremental'] is True. The IncrementalCondition state of 
+        the condition is loaded from the md folder -get_incremental_state-, and only the BLKs not processed yet are 
+        loaded. Their time courses are appended, and the pairwise loss matrix of the mae and mse strategies is 
+        extended only with the rows of the new trials. The autoselection runs again on all the time courses: the new 
+        selected trials are added to the accumulator, and the old trials whose selection changed are read back from the
+        trial stores of the condition -in INCREMENTAL_TRIALS- and added or removed. Averages and z-scores are computed 
+        from the accumulators, the session attributes are updated as get_signal does, and the state is stored. 
+        The cost scales with the new trials, not with the session. Without a BaseReport the outcome is the one of 
+        get_signal up to float rounding, except for time courses and dF/F0 of old trials, computed with the blank of 
+        their run. The stored Condition reads binned_data and df_fz from the trial stores.
+        '''
+        states = self.get_incremental_state()
+        st = states.setdefault(condition, IncrementalCondition())
+        blks = [f for f in self.all_blks if self.manifest.condition(f) == condition]
+        if any(b not in blks for b in st.blks):
+            self.log.info(f'BLKs of condition {condition} removed from rawdata: the condition is processed again')
+            st = states[condition] = IncrementalCondition()
+        path_trials = os.path.join(self.set_md_folder(), INCREMENTAL_TRIALS, str(condition))
+        shift = 1 if condition == self.blank_id else 0
+        if not st.open_trials(path_trials, shift = shift, n_workers = self.header.get('n_workers', 1)):
+            self.log.info(f'Trial stores of condition {condition} not matching its state: the condition is processed again')
+            st = states[condition] = IncrementalCondition()
+            st.open_trials(path_trials, mode = 'w', shift = shift, n_workers = self.header.get('n_workers', 1))
+        new = [b for b in blks if b not in st.blks]
+        self.log.info(f'Condition {condition}: {len(st.blks)} trials already processed, {len(new)} new')
+        blank_s = None if condition == self.blank_id else self.f_f0_blank
+        extraction_args = (blank_s, self.header['deblank_switch'], self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat)
+        extraction_kwargs = dict(detrend = self.detrend_switch, filename_particle = self.filename_particle, header_cache = self.header_cache)
+        n_old = len(st.blks)
+        old_mask = st.mask
+        if len(new) > 0:
+            trials, zeros = resolve_trials(self.header, new, self.base_report, self.blank_id, self.time_stamp, self.piezo, self.heart_beat, log = self.log, filename_particle = self.filename_particle)
+            st.zeros.update(zip(new, zeros))
+            sig, _, conditions, _, _ = signal_extraction(self.header, new, *extraction_args, resolved = (trials, zeros), on_trial = st.keep, **extraction_kwargs)
+            if sig is not None:
+                if condition == self.blank_id:
+                    sig = sig - 1
+                st.sig = sig if st.sig is None else np.concatenate((st.sig, sig), axis=0)
+                st.blks = st.blks + new
+                st.conditions = st.conditions + conditions
+                if trials is not None:
+                    st.trials = dict() if st.trials is None else st.trials
+                    st.trials.update(trials)
+                if self.header['strategy'] in ['mse', 'mae']:
+                    st.losses = update_pairwise_loss(st.losses, split_chunks(st.sig, self.get_n_chunks()), n_old, self.header['strategy'])
+                # Trials in the rawdata order, as get_signal
+                order = np.argsort([blks.index(b) for b in st.blks], kind='stable')
+                old_mask = np.concatenate((old_mask, np.zeros(len(order) - len(old_mask), dtype=int)))[order]
+                st.blks = [st.blks[i] for i in order]
+                st.conditions = [st.conditions[i] for i in order]
+                st.sig = st.sig[order, :]
+                if st.losses is not None:
+                    st.losses = st.losses[:, order, :][:, :, order]
+
+        mask = np.asarray(self.get_selection_trials(condition, st.sig, losses = st.losses), dtype=int)
+        # New selected trials: already loaded
+        for i, blk_name in enumerate(st.blks):
+            if (blk_name in st.pending) and (mask[i] == 1):
+                st.acc = st.acc if st.acc is not None else process.Welford(st.pending[blk_name].shape)
+                st.acc.update(st.pending[blk_name])
+        # Old trials whose selection changed: read back from the trial store
+        for value, update in [(1, st.add), (0, st.remove)]:
+            changed = [b for i, b in enumerate(st.blks) if (b not in st.pending) and (mask[i] == value) and (old_mask[i] != value)]
+            if len(changed) > 0:
+                self.log.info(f'{len(changed)} trials {"added to" if value else "removed from"} the selection of condition {condition}')
+                for blk_name in changed:
+                    update(blk_name)
+        st.pending = dict()
+        st.mask = mask
+
+        indeces_select = np.where(mask==1)[0].tolist()
+        dtype = self.header.get('dtype', 'float64')
+        mean_f_f0 = st.acc.mean(dtype = dtype)
+        tc = process.precise_nanmean(st.sig[indeces_select, :], axis=0)
+        if condition == self.blank_id:
+            self.conditions = list(st.conditions)
+            self.auto_selected = mask
+            self.session_blks = list(st.blks)
+            self.counter_blank = len(st.blks)
+            self.f_f0_blank = mean_f_f0
+            self.stde_f_f0_blank = st.acc.std(dtype = dtype)/np.sqrt(len(indeces_select))
+            z = process.zeta_score(mean_f_f0, self.f_f0_blank, self.stde_f_f0_blank, full_seq = True)
+            self.z_score = np.reshape(z, (1,) + z.shape)
+            self.avrgd_df_fz = np.reshape(mean_f_f0 - 1, (1,) + mean_f_f0.shape)
+            self.avrgd_time_courses = np.reshape(tc, (1, tc.shape[0]))
+            self.time_course_blank = tc
+            self.log.info('Blank signal computed')
+        else:
+            # Deblanking of the average: the mean of F/F0/blank is the mean of F/F0, over the blank
+            if self.header['deblank_switch'] and (self.f_f0_blank is not None):
+                df = (mean_f_f0/self.f_f0_blank - 1).astype(dtype, copy = False)
+            else:
+                df = mean_f_f0 - 1
+            self.conditions = self.conditions + st.conditions
+            self.auto_selected = np.array(self.auto_selected.tolist() + mask.tolist(), dtype=int)
+            self.session_blks = self.session_blks + st.blks
+            self.avrgd_df_fz = np.concatenate((self.avrgd_df_fz, np.reshape(df, (1,) + df.shape)), axis=0)
+            self.avrgd_time_courses = np.concatenate((self.avrgd_time_courses, tc.reshape(1, tc.shape[0])), axis=0)
+            z = process.zeta_score(mean_f_f0, self.f_f0_blank, self.stde_f_f0_blank, full_seq = True)
+            self.z_score = np.concatenate((self.z_score, z.reshape(1, z.shape[0], z.shape[1], z.shape[2])), axis=0)
+
+        if self.visualization_switch:
+            self.roi_plots(condition, st.sig, mask, st.blks)
+
+        if self.storage_switch:
+            start_time = timing.now()
+            cond = Condition(self.cond_dict[condition], condition, self.header)
+            cond.binned_data = st.get_trials(st.raws)
+            cond.df_fz = st.get_trials(st.delta_f)
+            cond.time_course = st.sig
+            cond.autoselection = mask
+            cond.blk_names = list(st.blks)
+            cond.averaged_df = self.avrgd_df_fz[-1, :, :, :]
+            cond.z_score = self.z_score[-1, :, :, :]
+            cond.averaged_timecourse = self.avrgd_time_courses[-1, :]
+            cond.trials = st.trials
+            t = self.set_md_folder()
+            if not os.path.exists(os.path.join(t,'md_data')):
+                os.makedirs(os.path.join(t,'md_data'))
+            cond.store_cond(t, storage_format = self.header.get('storage_format', 'columnar'), n_workers = self.header.get('n_workers', 1))
+            del cond
+            self.log.info(f"Storing condition time: {timing.record('store', start_time, condition = condition)/1e9:.3f} s")
+        self.store_incremental_state()
+        return mask
+
+    def get_incremental_state(self):
+        '''
+        The IncrementalCondition states by condition id: loaded once from the md folder, if stored with the same
+        INCREMENTAL_SIGNATURE header fields, empty otherwise.
+        '''
+        if self.incremental_state is None:
+            signature = {k: self.header.get(k) for k in INCREMENTAL_SIGNATURE}
+            self.incremental_state = {'signature': signature, 'conditions': dict()}
+            try:
+                state = utils.inputs_load(os.path.join(self.set_md_folder(), INCREMENTAL_STATE))
+            except (OSError, EOFError):
+                state = None
+            if (state is not None) and (state.get('signature') == signature):
+                self.incremental_state = state
+            elif state is not None:
+                self.log.info('Incremental state of different parameters: the session is processed again')
+        return self.incremental_state['conditions']
+
+    def store_incremental_state(self):
+        utils.inputs_save(self.incremental_state, os.path.join(self.set_md_folder(), INCREMENTAL_STATE))
+
+    def get_n_chunks(self):
+        '''
+        Number of chunks of the mse and mae strategies: header['chunks'] if it divides the frames, 1 otherwise.
+        '''
+        if self.header['n_frames']%self.header['chunks']==0:
+            return self.header['chunks']
+        return 1
+
     def get_blks(self):
         '''
         The .BLKs filenames corresponding to the choosen id conditions, from the considered path_session, are picked.        
@@ -474,13 +1079,8 @@ class Session:
             return self.all_blks
         else:
             self.log.info('BLKs for conditions ' + str(self.header['conditions_id']) + 'sorted by time creation')
-            tmp = [f for f in self.all_blks if (int(f.split(self.filename_particle)[1][0:2]) in self.header['conditions_id'])]
-            try:
-                a = sorted(tmp, key=lambda t: datetime.datetime.strptime(t.split('_')[2] + t.split('_')[3], '%d%m%y%H%M%S'))
-            except:
-                self.log.info('Warning: sorting BLK filenames was not performed')
-                a = tmp
-            return a 
+            # all_blks is already sorted, and without the BLKs popped off by the BaseReport check
+            return [f for f in self.all_blks if self.manifest.condition(f) in self.header['conditions_id']]
         
     def get_condition_name(self):
         '''
@@ -501,7 +1101,7 @@ class Session:
             # If also with find_thing there is no labelConds.txt file, than loaded as name Condition n#
             if len(tmp) == 0:
                 self.log.info('Check the labelConds.txt presence inside the session folder and subfolders')
-                cds = get_condition_ids(self.all_blks, filename_particle = self.filename_particle)
+                cds = self.manifest.condition_ids()
                 return {j+1:'Condition ' + str(c) for j, c in enumerate(cds)}
             # else, load the labelConds from the alternative path
             else :
@@ -509,7 +1109,7 @@ class Session:
                     contents = f.readlines()
                 return  {j+1:i.split('\n')[0] for j, i in enumerate(contents) if len(i.split('\n')[0])>0}
 
-    def get_session_header(self, path_session, spatial_bin, temporal_bin, tolerance, mov_switch, deblank_switch, conditions_id, chunks, strategy, logs_switch):
+    def get_session_header(self, path_session, spatial_bin, temporal_bin, tolerance, mov_switch, deblank_switch, conditions_id, chunks, strategy, logs_switch, options = None):
         header = {}
         header['path_session'] = path_session
         header['spatial_bin'] = spatial_bin
@@ -522,6 +1122,8 @@ class Session:
         header['chunks'] = chunks
         header['strategy'] = strategy
         header['logs_switch'] = logs_switch
+        # The Session options -see SESSION_OPTIONS-
+        header.update(get_session_options(options))
         return header
     
     def get_session(self):
@@ -537,7 +1139,8 @@ class Session:
             the method iterates through each condition (denoted as 'cd').
             For each condition, it logs the start of the loading procedure and the condition name.
             It then calls the get_signal method for the current condition, which is responsible for signal 
-            extraction and related processing. 
+            extraction and related processing. With header['cond_workers'] > 1 and the blank signal already computed, 
+            the conditions are processed by a pool of processes instead -see get_signals_parallel-.
             After processing, it logs the number of trials selected for the condition.
             The method keeps track of the total number of trials selected across all conditions.
             It also constructs an array of trial names based on the selected trials.
@@ -546,25 +1149,35 @@ class Session:
             The method returns without any explicit return value.        
         '''
         if len(self.header['conditions_id']) > 1:
-            for cd in self.header['conditions_id']:
-                c_name = self.cond_dict[cd]
-                if cd != self.blank_id:
+            conds = [cd for cd in self.header['conditions_id'] if cd != self.blank_id]
+            # The incremental state is updated in this process: no condition workers
+            if (self.header.get('cond_workers', 1) > 1) and (self.f_f0_blank is not None) and (len(conds) > 1) and (not self.header.get('incremental', False)):
+                for cd in conds:
+                    self.log.info('Procedure for loading BLKs of condition ' +str(cd)+' starts')
+                    self.log.info('Condition name: ' + self.cond_dict[cd])
+                masks = self.get_signals_parallel(conds)
+            else:
+                masks = list()
+                for cd in conds:
                     self.log.info('Procedure for loading BLKs of condition ' +str(cd)+' starts')
-                    self.log.info('Condition name: ' + c_name)                        
-                    tmp = self.get_signal(cd)
-                    self.log.info(str(int(sum(tmp))) + '/' + str(len(tmp)) +' trials have been selected for condition '+str(c_name))
+                    self.log.info('Condition name: ' + self.cond_dict[cd])                        
+                    masks.append(self.get_signal(cd))
+            for cd, tmp in zip(conds, masks):
+                self.log.info(str(int(sum(tmp))) + '/' + str(len(tmp)) +' trials have been selected for condition '+str(self.cond_dict[cd]))
                     
             self.log.info('Globally ' + str(int(sum(self.auto_selected))) + '/' + str(len(self.session_blks)) +' trials have been selected!')
             session_blks = np.array(self.session_blks)
             self.trials_name = session_blks[self.auto_selected]
 
         if self.visualization_switch:
+            start_time = timing.now()
             # zero_frames and ending_frames have to be recovered by trials
             # titles gets the name of blank condition as first, since it was stored first
+            whole_time_sequence = dv.whole_time_sequence_raster if self.header.get('renderer') == 'raster' else dv.whole_time_sequence
             for i, j in enumerate(self.avrgd_df_fz):
                 print(j.shape)
                 # dF/F0
-                dv.whole_time_sequence(j, 
+                self.render(whole_time_sequence, j, 
                                        mask = np.ones((j[0, :, :].shape), dtype=bool),
                                        name=f'df_average_cond{i+1}', 
                                        max=80, min=20,
@@ -575,7 +1188,7 @@ class Session:
                                        ext='png',
                                        name_analysis_= os.path.join(self.set_md_folder(), 'activity_maps'))
 
-                dv.whole_time_sequence(self.z_score[i], 
+                self.render(whole_time_sequence, self.z_score[i], 
                                        mask = np.ones((j[0, :, :].shape), dtype=bool),
                                        name=f'zscore_cond{i+1}', 
                                        max=80, min=20,
@@ -594,12 +1207,102 @@ class Session:
                 # #def time_sequence_visualization(start_frame, n_frames_showed, end_frame, data, titles, title_to_print, header, path_, circular_mask = True, log_ = None, max_trials = 20):
                 # # Double deblanking: further blank subtraction here
                 # dv.time_sequence_visualization(self.header['zero_frames'], 20, self.header['ending_frame'], self.z_score, [self.cond_dict[self.blank_id]]+[self.cond_dict[c] for c in self.header['conditions_id'] if c!=self.blank_id] , 'zscores', self.header, self.set_md_folder(), c_ax_ = (np.nanpercentile(self.z_score, 15), np.nanpercentile(self.z_score, 90)), log_ = self.log)
+            timing.record('plot', start_time)
 
         else:
             self.log.info('No visualization charts.')
+        self.close_render_queue()
+        self.log_profile()
         return
 
-    def get_selection_trials(self, condition, time_course):
+    def render(self, func, *args, **kwargs):
+        '''
+        Renders a figure with the plotting function func, module level -e.g. of data_visualization-: in background, 
+        by the render queue, if header['render_workers'] > 0, otherwise in place. The arguments should not be 
+        changed afterwards.
+        '''
+        if self.header.get('render_workers', 0) > 0:
+            if self.render_queue is None:
+                self.render_queue = render_queue.RenderQueue(self.header['render_workers'], log = self.log)
+            self.render_queue.submit(func, *args, **kwargs)
+        else:
+            func(*args, **kwargs)
+
+    def render_time_sequence(self, zero_of_cond, end_of_cond, data, titles, title_to_print, n_frames_showed = 20):
+        '''
+        dv.time_sequence_visualization -or dv.time_sequence_raster- of the trials in data. In background, only the shown frames of each trial 
+        are queued, with the color limits computed here on all the frames -see dv.get_color_limits-. data is read one trial at a time.
+        '''
+        time_sequence = dv.time_sequence_raster if self.header.get('renderer') == 'raster' else dv.time_sequence_visualization
+        if self.header.get('render_workers', 0) == 0:
+            time_sequence(zero_of_cond, n_frames_showed, end_of_cond, data, titles, title_to_print, self.header, self.set_md_folder(), log_ = self.log, max_trials = 20)
+            return
+        frames = dv.get_considered_frames(zero_of_cond, n_frames_showed, end_of_cond).astype(int)
+        c_ax_ = dv.get_color_limits(data)
+        sliced = np.array([np.asarray(data[i])[frames] for i in range(len(data))])
+        self.render(time_sequence, zero_of_cond, n_frames_showed, end_of_cond, sliced, titles, title_to_print, self.header, self.set_md_folder(), c_ax_ = c_ax_, max_trials = 20, sliced = True)
+
+    def close_render_queue(self):
+        '''
+        Waits for the figures queued, and stops the render workers.
+        '''
+        if self.render_queue is not None:
+            self.log.info('Waiting for the figures rendering')
+            self.render_queue.close()
+            self.render_queue = None
+
+    def log_profile(self):
+        '''
+        Logs the time, the bytes and the trials of each stage of the run, from its profile -see timing.summarize-.
+        '''
+        if (self.profile is None) or (not os.path.exists(self.profile.path)):
+            return
+        self.profile.close()
+        self.log.info(f'Profile of the run: {self.profile.path}')
+        for stage, total in timing.summarize(self.profile.path).items():
+            self.log.info(f"{stage}: {total['seconds']:.3f} s, {total['count']} spans, {total['bytes']/2**20:.1f} MB, {total['trials']} trials")
+
+    def get_signals_parallel(self, conditions):
+        '''
+        Runs get_signal for the conditions -not the blank one- in a pool of header['cond_workers'] processes.
+        Each condition depends only on the blank statistics: f_f0_blank, stde_f_f0_blank and time_course_blank are
+        shared read only with the workers through shared memory, and the rest of the session is sent once to each 
+        worker. Each worker returns mask, trials and averages of its condition -storage and visualization happen in
+        the worker-. They are assembled in the conditions order, as the serial loop would do.
+        Returns the list of masks.
+        '''
+        shms = list()
+        shared = dict()
+        for name in SHARED_BLANK:
+            value = getattr(self, name)
+            if value is not None:
+                shm, shared[name] = share_array(value)
+                shms.append(shm)
+        state = {k: v for k, v in self.__dict__.items() if k not in shared}
+        # The condition workers render their figures in place
+        state['render_queue'] = None
+        state['header'] = dict(self.header, render_workers = 0)
+        n_workers = min(self.header['cond_workers'], len(conditions))
+        self.log.info(f'{len(conditions)} conditions processed by {n_workers} workers')
+        try:
+            with concurrent.futures.ProcessPoolExecutor(n_workers, initializer = init_condition_worker, initargs = (state, shared)) as executor:
+                results = list(executor.map(process_condition, conditions))
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+        masks = list()
+        for mask, conditions_, blks, avrgd_df_fz, avrgd_time_course, z_score in results:
+            self.conditions = self.conditions + conditions_
+            self.auto_selected = np.array(self.auto_selected.tolist() + mask.tolist(), dtype=int)
+            self.session_blks = self.session_blks + blks
+            self.avrgd_df_fz = np.concatenate((self.avrgd_df_fz, avrgd_df_fz[np.newaxis]), axis=0)
+            self.avrgd_time_courses = np.concatenate((self.avrgd_time_courses, avrgd_time_course[np.newaxis]), axis=0)
+            self.z_score = np.concatenate((self.z_score, z_score[np.newaxis]), axis=0)
+            masks.append(mask)
+        return masks
+
+    def get_selection_trials(self, condition, time_course, losses = None):
         '''
         Parameters:
             self: This parameter represents the instance of the class Session and is used to access instance variables and methods.
@@ -619,13 +1322,14 @@ class Session:
                 + 'statistic', 'statistical', or 'quartiles': A statistical strategy based on statistical measures is used 
                    to select trials.
             The selected trials are stored in the tmp variable.
+            losses is the pairwise loss matrix of the mse and mae strategies, if already computed -see pairwise_loss-.
             The method logs the time it took for the autoselection process for the given condition.
             It returns the selected trials (tmp) as the result of the method.        
         '''
         strategy = self.header['strategy']
         n_frames = self.header['n_frames']
 
-        start_time = datetime.datetime.now().replace(microsecond=0)
+        start_time = timing.now()
         self.log.info(f'Autoselection for Condition: {condition}')
         if strategy in ['mse', 'mae']:
             self.log.info('Chunks division strategy choosen')
@@ -638,7 +1342,7 @@ class Session:
             #tmp = np.zeros(np.shape(time_course)[0], dtype=int)
             #self.log.info(np.array(self.session_blks)[indeces.tolist()])
             #self.log.info(indeces)
-            _, tmp, _, _, _  = overlap_strategy(time_course, condition, self.set_md_folder(), self.header,  switch_vis = self.visualization_switch, n_chunks=nch, loss = strategy)
+            _, tmp, _, _, _  = overlap_strategy(time_course, condition, self.set_md_folder(), self.header,  switch_vis = self.visualization_switch, n_chunks=nch, loss = strategy, losses = losses)
             #indeces = np.arange(0, np.shape(time_course)[0], dtype=int)
 
         elif strategy in ['roi', 'roi_signals', 'ROI']:
@@ -649,80 +1353,21 @@ class Session:
 
         #self.log.info(np.array(self.conditions)[self.auto_selected])
         #self.log.info(self.trials_name)
-        self.log.info('Autoselection loop time for condition ' +str(condition)+ ': ' +str(datetime.datetime.now().replace(microsecond=0)-start_time))
+        self.log.info(f"Autoselection loop time for condition {condition}: {timing.record('selection', start_time, trials = len(time_course), condition = condition)/1e9:.3f} s")
         return tmp
 
+    @timing.timed('plot')
     def roi_plots(self, cd_i, sig, mask, blks):
         #session_name = self.header['path_session'].split('/')[-2]+'-'+self.header['path_session'].split('/')[-3].split('-')[1]
         comp = os.path.normpath(self.header['path_session']).split(os.sep)
         session_name = comp[-2].split('sub-')[1]+'-'+comp[-3].split('exp-')[1] + '_' + comp[-1].split('-')[1] 
-        blank_sign = self.time_course_blank
-        cdi_select = np.where(mask==1)
-        cdi_select = cdi_select[0].tolist()
-        cdi_unselect = np.where(mask==0)
-        cdi_unselect = cdi_unselect[0].tolist()
-        # Number of possible columns
-        b = [4,5,6]
-        a = [len(mask)%i for i in b]
-        columns = b[a.index(min(a))]
-
-        fig = plt.figure(constrained_layout=True, figsize = (columns*4, int(np.ceil(len(mask)/columns)+1)*2), dpi = 80)
         title = f'Condition #{cd_i}' 
         try:
             if self.cond_names is not None:
                 title = title + ': ' + self.cond_names[cd_i-1]
         except:
             None
-        fig.suptitle(title)# Session name
-        # Height_ratios logic implementation
-        rat = [1]*(int(np.ceil(len(mask)/columns))+1)
-        rat[-1] = 3
-        subfigs = fig.subfigures(nrows=int(np.ceil(len(mask)/columns))+1, ncols=1, height_ratios=rat)
-        for row, subfig in enumerate(subfigs):
-            #subfig.suptitle('Bottom title')
-            axs = subfig.subplots(nrows=1, ncols=columns, sharex=True, sharey=True)
-            x = np.arange(0, self.header['n_frames'])
-            for i, ax in enumerate(axs):
-                count = row*columns + i
-                if count < len(mask):
-                    ax.set_ylim(np.nanmin(sig[cdi_select, :]) - (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005, 
-                                np.nanmax(sig[cdi_select, :]) + (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005)
-                    if mask[count]==1:
-                        color = 'b'
-                    else:
-                        color = 'r'
-                    ax.plot(sig[count, :], color)
-                    ax.set_title(blks[count])
-                    ax.errorbar(x, np.nanmean(sig[cdi_select, :], axis = 0), yerr=(np.nanstd(sig[cdi_select, :], axis = 0)/np.sqrt(len(cdi_select))), 
-                                fmt='--', color = 'k', elinewidth = 0.5)
-                    ax.ticklabel_format(axis='both', style='sci', scilimits=(-3,3))
-                    #ax.set_ylim(-0.002,0.002)
-                if row<len(subfigs)-2:
-                    ax.get_xaxis().set_visible(False)
-                elif row<len(subfigs)-1:
-                    ax.get_xaxis().set_visible(True)
-                elif row == len(subfigs)-1:
-                    ax.axis('off')
-                    ax_ = subfig.subplots(1, 1)
-                    ax_.set_ylim(np.nanmin(sig[cdi_select, :]) - (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005, 
-                                 np.nanmax(sig[cdi_select, :]) + (np.nanmax(sig[cdi_select]) - np.nanmin(sig[cdi_select]))*0.005)
-                    for i in sig[cdi_select[:-1], :]:
-                        ax_.plot(x, i, 'gray', linewidth = 0.5)
-                    ax_.plot(x, sig[cdi_select[-1], :], 'gray', linewidth = 0.5, label = 'Trials')
-                    ax_.plot(x, np.nanmean(sig[cdi_select, :], axis=0), 'k', label = 'Average Selected trials', linewidth = 2)
-                    ax_.plot(x, np.nanmean(sig[cdi_unselect, :], axis=0), 'crimson', label = 'Average Unselected trials', linewidth = 2)
-                    ax_.plot(x, np.nanmean(sig, axis=0), 'green', label = 'Average All trials Cond. ' + str(cd_i), linewidth = 2)
-                    ax_.plot(x, blank_sign, color='m', label = 'Average Blank Signal' ,linewidth = 2)
-                    #ax_.plot(list(range(0,np.shape(sig)[1])), blank_sign, color='m', label = 'Average Blank Signal' ,linewidth = 5)
-                    ax_.legend(loc="upper left")                
-                    ax_.ticklabel_format(axis='both', style='sci', scilimits=(-3,3))
-                
-        tmp = self.set_md_folder()
-        if not os.path.exists(os.path.join(tmp,'time_course')):
-            os.makedirs(os.path.join(tmp,'time_course'))
-        plt.savefig(os.path.join(tmp,'time_course', session_name+'_tc_0'+str(cd_i)+'.png'))
-        #plt.savefig((path_session+'/'session_name +'/'+ session_name+'_roi_0'+str(cd_i)+'.png')
-        plt.close('all')
+        self.render(dv.time_course_visualization, cd_i, np.asarray(sig), np.asarray(mask), list(blks), self.time_course_blank, self.header['n_frames'], title, session_name, self.set_md_folder())
         return
 
     def set_md_folder(self):
@@ -741,6 +1386,15 @@ class Session:
             + '_mov' + str(self.header['mov_switch'])\
             + '_dtrend' + str(self.detrend_switch)\
             + '_deblank' + str(self.header['deblank_switch'])
+        # The default binning, precision and field of view keep the historical folder name
+        if self.header.get('bin_mode', 'linear') != 'linear':
+            folder_name = folder_name + '_binmode' + str(self.header['bin_mode'])
+        if self.header.get('dtype', 'float64') != 'float64':
+            folder_name = folder_name + '_dtype' + str(self.header['dtype'])
+        if self.header.get('frame_window', None) is not None:
+            folder_name = folder_name + '_frames' + '-'.join(str(i) for i in self.header['frame_window'])
+        if self.header.get('crop', None) is not None:
+            folder_name = folder_name + '_crop' + '-'.join(str(i) for i in self.header['crop'])
         
         folder_path = os.path.join(session_path, 'derivatives/',folder_name)               
         if not os.path.exists(folder_path):
@@ -777,11 +1431,52 @@ class Session:
             
         return [(self.blk_names.index(i), i) for i in correct_blks_p1], [(self.blk_names.index(i), i) for i in uncorrect_blks_p1]
 
+# Blank statistics shared with the condition workers
+SHARED_BLANK = ['f_f0_blank', 'stde_f_f0_blank', 'time_course_blank']
+# Session of a condition worker process, and its attached shared memory -see init_condition_worker-
+worker_session = None
+worker_shms = list()
+
+def share_array(array):
+    '''
+    Copies array in a new shared memory block. Returns the block and the (name, shape, dtype) for attaching it.
+    '''
+    shm = shared_memory.SharedMemory(create = True, size = max(1, array.nbytes))
+    np.ndarray(array.shape, dtype = array.dtype, buffer = shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def init_condition_worker(state, shared):
+    '''
+    Initializer of a condition worker: the Session is rebuilt from its state, with the shared arrays as read only
+    views of the parent's shared memory.
+    '''
+    global worker_session
+    session = Session.__new__(Session)
+    session.__dict__.update(state)
+    for name, (shm_name, shape, dtype) in shared.items():
+        shm = shared_memory.SharedMemory(name = shm_name)
+        worker_shms.append(shm)
+        value = np.ndarray(shape, dtype = dtype, buffer = shm.buf)
+        value.flags.writeable = False
+        setattr(session, name, value)
+    timing.set_profile(session.profile)
+    worker_session = session
+
+def process_condition(condition):
+    '''
+    get_signal of the condition in a worker. Returns the mask and the entries get_signal added to the session: 
+    conditions, BLK names, averaged dF/F0, averaged time course and z-score.
+    '''
+    session = worker_session
+    n = len(session.session_blks)
+    mask = session.get_signal(condition)
+    return mask, session.conditions[n:], session.session_blks[n:], session.avrgd_df_fz[-1], session.avrgd_time_courses[-1], session.z_score[-1]
+
 def get_condition_ids(all_blks, filename_particle = 'vsd_C'):
     '''
     The method returns a list of all the condition's ids, taken from the .BLK names.
     '''
-    return list(set([int(i.split(filename_particle)[1][0:2]) for i in all_blks]))
+    return list(set([utils.parse_blk_name(i, filename_particle)[0] for i in all_blks]))
 
 def get_blank_id(cond_names, cond_id = None):
     '''
@@ -804,7 +1499,7 @@ def get_blank_id(cond_names, cond_id = None):
     else:
         return cond_id
 
-def signal_extraction(header, blks, blank_s, blnk_switch, base_report, blank_id, time, piezo, heart, detrend = False, log = None, blks_load = True, filename_particle = 'vsd_C'):
+def signal_extraction(header, blks, blank_s, blnk_switch, base_report, blank_id, time, piezo, heart, detrend = False, log = None, blks_load = True, filename_particle = 'vsd_C', header_cache = None, resolved = None, on_trial = None):
     '''
     Parameters:
         header: the Session header. A dictionary containing various parameters and metadata.
@@ -819,151 +1514,233 @@ def signal_extraction(header, blks, blank_s, blnk_switch, base_report, blank_id,
         log: A logging object for recording information (could be None).
         blks_load: A flag indicating whether to load BLK files.
         filename_particle: a string particle for distinguish between VSDI or IOI recordings.
+        header_cache: a blk_file.HeaderCache, for reusing the BLK headers already parsed (could be None).
+        resolved: the (trials_dict, zeros) output of resolve_trials, if already computed for blks (could be None).
+        on_trial: a callable on_trial(blk_name, binned_signal, df_f0), called for each loaded trial instead of storing it:
+                  raws and delta_f are not allocated, and returned as None (could be None).
 
     Function Description:
-        The function begins by initializing some variables and parameters, including trials_dict, path_rawdata, and flag_remove.
-        It determines the type of strategy for processing the trials, such as 'mse', 'mae', 'roi', 'statistic', and more, based 
-        on the strategy attribute in the header.
+        The function begins by initializing some variables and parameters, including trials_dict and path_rawdata.
+        First the trials are resolved: if a base_report is given, each BLK is matched with its Trial, and the BLKs
+        without correspondance are removed from blks -the caller's list is modified-. The zero frames of each trial 
+        are picked from the Trial, or from the header.
         If blks_load is True, it loads the trial data. For each trial in blks, it does the following:
-            Loads the trial data using the blk_file.BlkFile class and stores it in variables such as raws, delta_f, and sig.
-            The specific processing applied to the data depends on the chosen strategy. For example, if the strategy is 'mse' or 
-            'mae', the data is divided into chunks.
+            Loads the trial data using the blk_file.BlkFile class -see load_trial- and stores it, by trial index, in the 
+            preallocated raws, delta_f, and sig.
             The trial information, including condition, is stored in the conditions list.
             The function logs information about the loading process.
-            If a trial is empty, it is removed from the list of trials.
+        The trials are loaded serially, or concurrently by a pool of header['n_workers'] workers: threads -decoding and 
+        binning release the GIL- or processes, as header['pool'] says. At most header['max_in_flight'] trials are loaded 
+        at the same time, for bounding the memory.
+        With serial loading and header['prefetch'] > 0, the next header['prefetch'] BLKs are read in background, 
+        overlapping the I/O with the processing of the current trial.
+        If header['cache_gb'] > 0, the binned signals are looked up first in the session binned_cache.BinnedCache:
+        a cached BLK is not read at all, and the binned signals computed are cached.
+        If raws and delta_f exceed header['max_memory'] GB, they are trial_store.DiskTrials in the derivatives folder,
+        instead of arrays: only the trials being loaded are in memory.
         If blks_load is False, it doesn't load the trial data and only constructs the trials_dict.
         The function returns the extracted and processed data: sig (time course), delta_f (delta F/F0), conditions (conditions of 
         the trials), raws (raw data), and trials_dict (trial information).    
     '''
-    #motion_indeces, conditions = [], []
     conditions = []
     path_rawdata = os.path.join(header['path_session'],'rawdata/')
-    flag_remove = False
-    if base_report is not None:
-        trials_dict = dict()
-        greys = al.get_greys(header['path_session'], int(os.path.join(path_rawdata, blks[0]).split(filename_particle)[1][0:2]))
+    # Trials resolution: the BLKs without a Trial are popped off before any allocation
+    if resolved is None:
+        trials_dict, zeros = resolve_trials(header, blks, base_report, blank_id, time, piezo, heart, log = log, filename_particle = filename_particle)
     else:
-        trials_dict = None
-        
-    if blks_load:
+        trials_dict, zeros = resolved
+
+    if (not blks_load) or (len(blks) == 0):
+        sig, delta_f, conditions, raws = None, None, None, None
+        return sig, delta_f, conditions, raws, trials_dict
 
+    if log is None:
+        print(f'The blank_signal exist: {blank_s is not None}')
+        print(f'The blank switch is: {blnk_switch}')
+    else:
+        log.info(f'The blank_signal exist: {blank_s is not None}')
+        log.info(f'The blank switch is: {blnk_switch}')
+
+    # The header of the first BLK is used for all the trials
+    header_blk = None if header_cache is None else header_cache.get(os.path.join(path_rawdata, blks[0]))
+    blk_kwargs = dict(detrend_switch    = detrend,
+                      filename_particle = filename_particle,
+                      bin_mode          = header.get('bin_mode', 'linear'),
+                      dtype             = header.get('dtype', 'float64'),
+                      frames            = header.get('frame_window', None),
+                      crop              = header.get('crop', None))
+    BLK = blk_file.BlkFile(os.path.join(path_rawdata, blks[0]), header['spatial_bin'], header['temporal_bin'], header = header_blk, **blk_kwargs)
+    header_blk = BLK.header
+    # Output shape from the header: it accounts for binning and for the frame/crop window
+    binned_shape = BLK.get_binned_shape()
+    del BLK
+    if on_trial is None:
+        raws = allocate_trials((len(blks),) + binned_shape, header, log = log)
+        delta_f = allocate_trials((len(blks),) + binned_shape, header)
+    else:
+        raws, delta_f = None, None
+    sig = np.empty((len(blks), binned_shape[0]), dtype=header.get('dtype', 'float64'))
+    roi_mask = blk_file.circular_mask_roi(binned_shape[2], binned_shape[1])
+    conditions = [None]*len(blks)
+    cache = binned_cache.get_cache(header)
+    cache_params = binned_cache.get_params(header, detrend)
+
+    tasks = [(os.path.join(path_rawdata, blk_name), header['spatial_bin'], header['temporal_bin'], header_blk, blk_kwargs, zero, blnk_switch, blank_s, roi_mask, cache, cache_params) for blk_name, zero in zip(blks, zeros)]
+    n_workers = header.get('n_workers', 1)
+    start_time = timing.now()
+    if n_workers > 1:
+        pool = header.get('pool', 'thread')
+        max_in_flight = header.get('max_in_flight', None) or 2*n_workers
         if log is None:
-            print(f'The blank_signal exist: {blank_s is not None}')
-            print(f'The blank switch is: {blnk_switch}')
+            print(f'Trials loaded by {n_workers} {pool} workers, at most {max_in_flight} at the same time')
         else:
-            log.info(f'The blank_signal exist: {blank_s is not None}')
-            log.info(f'The blank switch is: {blnk_switch}')
-
-        for i, blk_name in enumerate(blks):
-            start_time = datetime.datetime.now().replace(microsecond=0)
-            if base_report is not None:
-                trial = al.get_trial(base_report, blk_name, time, heart, piezo, greys[1], greys[0], blank_id)
-                # If the trial is empty, likely for absence of BLK name correspondance in BaseReport, it pops out the blkname from the list
-                if trial is None:
-                    print('Empty Trial')
-                    blks.remove(blk_name)
-                    flag_remove = True
-                    if log is None:
-                        print(f'{blk_name} was popped off')
-                    else:
-                        log.info(f'{blk_name} was popped off')
-                # Otherwise store it
-                elif trial is not None:
-                    flag_remove = False
-                    trials_dict[blk_name] = trial   
-                    zero = trial.zero_frames
-            else:
-                zero = header['zero_frames']
-            print(f'Employeed zero for normalization is {zero}')
-            # If the blk name is not popped off, the blk is loaded
-            if not flag_remove:    
-                # Get BLK file
-                # If first BLK file, than the header is stored
-                if i == 0:
-                    BLK = blk_file.BlkFile(
-                        os.path.join(path_rawdata, blk_name),
-                        header['spatial_bin'],
-                        header['temporal_bin'],
-                        header = None, 
-                        detrend_switch    = detrend,
-                        filename_particle = filename_particle)
-
-                    header_blk = BLK.header
-                    raws = np.empty((len(blks), header['n_frames'], header['original_height']//header['spatial_bin'], header['original_width']//header['spatial_bin']))
-                    delta_f = np.empty((len(blks), header['n_frames'], header['original_height']//header['spatial_bin'], header['original_width']//header['spatial_bin']))
-                    sig = np.empty((len(blks), header['n_frames']))
-                    roi_mask = blk_file.circular_mask_roi(header['original_width']//header['spatial_bin'], header['original_height']//header['spatial_bin'])
-                else:
-                    BLK = blk_file.BlkFile(
-                        os.path.join(path_rawdata, blk_name), 
-                        header['spatial_bin'], 
-                        header['temporal_bin'], 
-                        header = header_blk,
-                        detrend_switch    = detrend, 
-                        filename_particle = filename_particle)
-                
-                # Log prints
-                if log is None:
-                    print(f'The blk file {blk_name} is loaded')
-                else:
-                    log.info(f'The blk file {blk_name} is loaded')
-                    
-                #at the end something like (nblks, 70, 1)         
-                conditions.append(BLK.condition)
-                BLK.binned_signal[np.where(BLK.binned_signal==0)] = np.nan
-                raws[i, :, :, :] = BLK.binned_signal 
-                delta_f[i, :, :, :] =  process.deltaf_up_fzero(BLK.binned_signal, zero, deblank=blnk_switch, blank_sign = blank_s)
-                sig[i, :] = process.time_course_signal(delta_f[i, :, :, :], roi_mask)     # Log prints
+            log.info(f'Trials loaded by {n_workers} {pool} workers, at most {max_in_flight} at the same time')
+        executor = concurrent.futures.ProcessPoolExecutor(n_workers) if pool == 'process' else concurrent.futures.ThreadPoolExecutor(n_workers)
+        with executor:
+            loaded = utils.bounded_map(executor, load_trial, tasks, max_in_flight)
+            store_trials(loaded, blks, conditions, raws, delta_f, sig, log, start_time, on_trial = on_trial)
+        if (cache is not None) and (pool == 'process'):
+            # The process workers cache without evicting: the folder is bounded here
+            cache.sync()
+    elif header.get('prefetch', 0) > 0:
+        # Serial loading, with the next BLKs read in background while the current one is processed. The cached ones are not read
+        cached = [(cache is not None) and cache.contains(task[0], cache_params) for task in tasks]
+        with blk_file.BlkPrefetcher([task[0] for task, c in zip(tasks, cached) if not c], depth = header['prefetch']) as prefetcher:
+            buffers = iter(prefetcher)
+            loaded = ((i, load_trial(*task, buffer = None if c else next(buffers)[1])) for i, (task, c) in enumerate(zip(tasks, cached)))
+            store_trials(loaded, blks, conditions, raws, delta_f, sig, log, start_time, on_trial = on_trial)
+    else:
+        loaded = ((i, load_trial(*task)) for i, task in enumerate(tasks))
+        store_trials(loaded, blks, conditions, raws, delta_f, sig, log, start_time, on_trial = on_trial)
+    return sig, delta_f, conditions, raws, trials_dict
+
+def allocate_trials(shape, header, log = None):
+    '''
+    Trials tensor of shape (Trials, Time, Y, X): an array if raws and delta_f -two of them- fit in header['max_memory'] 
+    GB -no limit if None-, otherwise a trial_store.DiskTrials in the derivatives folder.
+    '''
+    dtype = np.dtype(header.get('dtype', 'float64'))
+    max_memory = header.get('max_memory', None)
+    if (max_memory is None) or (2*int(np.prod(shape))*dtype.itemsize <= max_memory*binned_cache.GB):
+        return np.empty(shape, dtype=dtype)
+    if log is not None:
+        log.info(f'Trials tensors over the memory budget of {max_memory} GB: stored on disk')
+    return trial_store.DiskTrials(shape, dtype, folder = os.path.join(header['path_session'], 'derivatives'))
+
+class SelectedTrials:
+    '''
+    Lazy view of the trials indeces of a trials tensor: data[a:b] reads only those trials. For the visualizations,
+    and for storing the incremental trial stores in the order of the BLKs.
+    '''
+    def __init__(self, data, indeces):
+        self.data = data
+        self.indeces = list(indeces)
+
+    def __len__(self):
+        return len(self.indeces)
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.data.shape[1:])
 
-                # Trial storing
-                start_time = datetime.datetime.now().replace(microsecond=0)
+    @property
+    def dtype(self):
+        return self.data.dtype
 
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if isinstance(key[0], (int, np.integer)):
+            return np.asarray(self.data[self.indeces[key[0]]])[key[1:]]
+        return np.array([self.data[i] for i in np.array(self.indeces)[key[0]]])[(slice(None),) + key[1:]]
+
+    def __array__(self, dtype = None, copy = None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+def resolve_trials(header, blks, base_report, blank_id, time, piezo, heart, log = None, filename_particle = 'vsd_C'):
+    '''
+    Matches each BLK with its Trial in the base_report, if given. The BLKs without correspondance are removed 
+    from blks -the caller's list is modified-.
+    Returns the dictionary of Trial objects by BLK name -None without base_report- and the list of zero frames
+    of each remaining BLK: from its Trial, or header['zero_frames'].
+    '''
+    path_rawdata = os.path.join(header['path_session'],'rawdata/')
+    if (base_report is not None) and (len(blks) > 0):
+        trials_dict = dict()
+        greys = al.get_greys(header['path_session'], int(os.path.join(path_rawdata, blks[0]).split(filename_particle)[1][0:2]))
+    else:
+        trials_dict = None if base_report is None else dict()
+
+    zeros = list()
+    for blk_name in list(blks):
+        if base_report is not None:
+            trial = al.get_trial(base_report, blk_name, time, heart, piezo, greys[1], greys[0], blank_id)
+            # If the trial is empty, likely for absence of BLK name correspondance in BaseReport, it pops out the blkname from the list
+            if trial is None:
+                print('Empty Trial')
+                blks.remove(blk_name)
                 if log is None:
-                    print('Trial n. '+str(i+1)+'/'+ str(len(blks))+' loaded in ' + str(datetime.datetime.now().replace(microsecond=0)-start_time)+'!')
+                    print(f'{blk_name} was popped off')
                 else:
-                    log.info('Trial n. '+str(i+1)+'/'+ str(len(blks))+' loaded in ' + str(datetime.datetime.now().replace(microsecond=0)-start_time)+'!')
-            # If trials is discarded then parallel strategy of reshaping of output matrices
-            else:
-                if i == 0:
-                    BLK = blk_file.BlkFile(
-                        os.path.join(path_rawdata, blk_name),
-                        header['spatial_bin'],
-                        header['temporal_bin'],
-                        header = None, 
-                        detrend_switch    = detrend,
-                        filename_particle = filename_particle)
-
-                    header_blk = BLK.header
-                    raws = np.empty((len(blks-1), header['n_frames'], header['original_height']//header['spatial_bin'], header['original_width']//header['spatial_bin']))
-                    delta_f = np.empty((len(blks-1), header['n_frames'], header['original_height']//header['spatial_bin'], header['original_width']//header['spatial_bin']))
-                    sig = np.empty((len(blks-1), header['n_frames']))
-                    roi_mask = blk_file.circular_mask_roi(header['original_width']//header['spatial_bin'], header['original_height']//header['spatial_bin'])
-                else:
-                    # Discarding one element in the trial dimension, since the blk was deleted
-                    raws = raws[0:-2, :, :, :]
-                    delta_f = delta_f[0:-2, :, :, :]
-                    sig = sig[0:-2, :]
+                    log.info(f'{blk_name} was popped off')
+                continue
+            # Otherwise store it
+            trials_dict[blk_name] = trial   
+            zeros.append(trial.zero_frames)
+        else:
+            zeros.append(header['zero_frames'])
+    return trials_dict, zeros
+
+def load_trial(path_blk, spatial_bin, temporal_bin, header_blk, blk_kwargs, zero, blnk_switch, blank_s, roi_mask, cache = None, cache_params = None, buffer = None):
+    '''
+    Loads one trial: BLK decoding and binning, dF/F0 and time course over the roi_mask.
+    Module level function, so it can run in a thread or in a process worker.
+    cache is a binned_cache.BinnedCache, with the binning parameters cache_params: the binned signal is taken 
+    from it, if present, otherwise it is computed and stored in it (could be None).
+    buffer is the content of the BLK, if already read -see blk_file.BlkPrefetcher-.
+    Returns the condition, the binned signal -zeros replaced by NaN-, the dF/F0 and the time course.
+    '''
+    binned_signal = None if cache is None else cache.get(path_blk, cache_params)
+    if binned_signal is None:
+        BLK = blk_file.BlkFile(path_blk, spatial_bin, temporal_bin, header = header_blk, buffer = buffer, **blk_kwargs)
+        binned_signal = BLK.binned_signal
+        condition = BLK.condition
+        del BLK
+        if cache is not None:
+            cache.put(path_blk, cache_params, binned_signal)
     else:
-        for i, blk_name in enumerate(blks):
-            start_time = datetime.datetime.now().replace(microsecond=0)
-            if base_report is not None:
-                trial = al.get_trial(base_report, blk_name, time, heart, piezo, greys[1], greys[0], blank_id)
-                # If the trial is empty, likely for absence of BLK name correspondance in BaseReport, it pops out the blkname from the list
-                if trial is None:
-                    print('Empty Trial')
-                    blks.remove(blk_name)
-                    if log is None:
-                        print(f'{blk_name} was popped off')
-                    else:
-                        log.info(f'{blk_name} was popped off')
-                # Otherwise store it
-                elif trial is not None:
-                    trials_dict[blk_name] = trial   
-                    zero = trial.zero_frames
-            else:
-                zero = header['zero_frames']
-        sig, delta_f, conditions, raws = None, None, None, None
-    return sig, delta_f, conditions, raws, trials_dict
+        condition = utils.parse_blk_name(os.path.basename(path_blk), blk_kwargs['filename_particle'])[0]
+    binned_signal[np.where(binned_signal==0)] = np.nan
+    df_f0 = process.deltaf_up_fzero(binned_signal, zero, deblank=blnk_switch, blank_sign = blank_s)
+    time_course = process.time_course_signal(df_f0, roi_mask)
+    return condition, binned_signal, df_f0, time_course
+
+def store_trials(loaded, blks, conditions, raws, delta_f, sig, log, start_time, on_trial = None):
+    '''
+    Writes the loaded trials -(index, load_trial output) pairs, in any order- in their slots of conditions, raws, delta_f and sig.
+    If on_trial is given, binned signal and dF/F0 are passed to it instead of stored in raws and delta_f.
+    '''
+    for n, (i, (condition, binned_signal, df_f0, time_course)) in enumerate(loaded):
+        conditions[i] = condition
+        if on_trial is None:
+            raws[i, :, :, :] = binned_signal 
+            delta_f[i, :, :, :] = df_f0
+        else:
+            on_trial(blks[i], binned_signal, df_f0)
+        sig[i, :] = time_course
+        # Log prints
+        if log is None:
+            print(f'The blk file {blks[i]} is loaded')
+            print(f'Trial n. {n+1}/{len(blks)} loaded in {(timing.now()-start_time)/1e9:.3f} s!')
+        else:
+            log.info(f'The blk file {blks[i]} is loaded')
+            log.info(f'Trial n. {n+1}/{len(blks)} loaded in {(timing.now()-start_time)/1e9:.3f} s!')
+    return
     
 def roi_strategy(matrix, tolerance, zero_frames):
     '''
@@ -985,7 +1762,64 @@ def roi_strategy(matrix, tolerance, zero_frames):
     mask_array[autoselect] = 1
     return mask_array
 
-def overlap_strategy(matrix, cd_i, path, header, switch_vis = False, separators = None, n_chunks = 1, loss = 'mae', threshold = 'median'):
+# Bytes of the trials differences computed at once by pairwise_loss
+PAIRWISE_BLOCK_BYTES = 2**26
+
+def pairwise_loss(chunks, loss = 'mae', block_bytes = PAIRWISE_BLOCK_BYTES, others = None):
+    '''
+    Parameters:
+        chunks: array (n_trials, n_chunks, chunk_length) of time courses, split in chunks.
+        loss: 'mae' or 'mse'.
+        block_bytes: memory bound of the differences computed at once.
+        others: array (n_others, n_chunks, chunk_length): the loss is computed between chunks and others. 
+                None by default: chunks against itself.
+
+    Function Description:
+        NaN aware loss between each pair of trials, for all the chunks at once: the differences are broadcast
+        over blocks of rows of the trials-by-trials matrix. The reduction is the np.nanmean along the contiguous 
+        chunk axis, the same of the pair by pair computation: the values are identical.
+        Returns an array (n_chunks, n_trials, n_trials) -n_others columns, if others is given-.
+    '''
+    if loss not in ('mae', 'mse'):
+        raise ValueError(f'Loss {loss} not available: mae or mse')
+    n_trials = chunks.shape[0]
+    chunks = np.ascontiguousarray(chunks)
+    others = chunks if others is None else np.ascontiguousarray(others)
+    out = np.empty((chunks.shape[1], n_trials, others.shape[0]))
+    # Rows of the matrix computed at once
+    step = max(1, int(block_bytes // max(1, others.nbytes)))
+    for r in range(0, n_trials, step):
+        diff = np.subtract(chunks[r:r+step, np.newaxis, :, :], others[np.newaxis, :, :, :])
+        if loss == 'mae':
+            np.abs(diff, out = diff)
+        else:
+            np.square(diff, out = diff)
+        out[:, r:r+step, :] = np.moveaxis(np.nanmean(diff, axis=-1), -1, 0)
+    return out
+
+def split_chunks(matrix, n_chunks):
+    '''
+    Time courses matrix (n_trials, n_frames) split in n_chunks chunks: (n_trials, n_chunks, n_frames/n_chunks).
+    '''
+    return matrix.reshape(matrix.shape[0], n_chunks, -1)
+
+def update_pairwise_loss(losses, chunks, n_old, loss = 'mae'):
+    '''
+    Extends the pairwise loss matrix losses of the first n_old trials of chunks -None if n_old is 0- to all the 
+    trials: only the rows of the new trials are computed, and mirrored, since the loss is symmetric.
+    The values are identical to the ones of pairwise_loss on all the trials.
+    '''
+    if (losses is None) or (n_old == 0):
+        return pairwise_loss(chunks, loss = loss)
+    n = chunks.shape[0]
+    new = pairwise_loss(chunks[n_old:], loss = loss, others = chunks)
+    out = np.empty((chunks.shape[1], n, n))
+    out[:, :n_old, :n_old] = losses
+    out[:, n_old:, :] = new
+    out[:, :n_old, n_old:] = np.swapaxes(new[:, :, :n_old], 1, 2)
+    return out
+
+def overlap_strategy(matrix, cd_i, path, header, switch_vis = False, separators = None, n_chunks = 1, loss = 'mae', threshold = 'median', losses = None):
     '''
     Parameters:
         matrix: A data matrix that you want to process.
@@ -997,6 +1831,7 @@ def overlap_strategy(matrix, cd_i, path, header, switch_vis = False, separators
         n_chunks: The number of chunks to divide the data into.
         loss: The loss metric used for selecting regions (e.g., 'mae' or 'mse').
         threshold: A thresholding method for region selection (default is 'median').
+        losses: The pairwise loss matrix of the chunks, if already computed -see update_pairwise_loss- (default is None).
 
     Function Description:
         If separators is not provided, the function divides the data into n_chunks chunks -equally dimensioned chunks-
@@ -1015,23 +1850,7 @@ def overlap_strategy(matrix, cd_i, path, header, switch_vis = False, separators
     '''
     if separators is None:
         if  matrix.shape[1] % n_chunks == 0:
-            matrix_ = matrix.reshape(matrix.shape[0], n_chunks, -1)
-            tmp_m_ = np.zeros((n_chunks, matrix.shape[0], matrix.shape[0]))
-            
-            for m in range(n_chunks):
-                tmp_m = np.zeros((matrix.shape[0], matrix.shape[0]))
-
-                for n, i in enumerate(matrix_):
-                    tmp = []
-
-                    for j in matrix_:    
-                        if loss == 'mae':
-                            tmp.append(np.nanmean(np.abs(np.subtract(i[m, :], j[m, :]))))
-                        elif loss == 'mse':
-                            tmp.append(np.nanmean(np.square(np.subtract(i[m, :], j[m, :]))))
-
-                    tmp_m[n, :] = np.asarray(tmp)    
-                tmp_m_[m, :, :] = tmp_m
+            tmp_m_ = pairwise_loss(split_chunks(matrix, n_chunks), loss = loss) if losses is None else losses
             m = np.nansum(tmp_m_, axis=1)
         else:
             # This check has to be done before running the script
@@ -1051,21 +1870,9 @@ def overlap_strategy(matrix, cd_i, path, header, switch_vis = False, separators
         for i in tmp_list:
             print(i.shape)
         
-        tmp_m_ = list()
         n_chunks = len(tmp_list)
-        for m in range(n_chunks):
-            tmp_m = list()
-
-            for i in tmp_list[m]:
-                tmp = []
-                for j in tmp_list[m]:    
-                    if loss == 'mae':
-                        tmp.append(np.nanmean(np.abs(np.subtract(i[:], j[:]))))
-                    elif loss == 'mse':
-                        tmp.append(np.nanmean(np.square(np.subtract(i[:], j[:]))))
-                tmp_m.append(tmp)    
-            tmp_m_.append(tmp_m)
-            #print(np.shape(tmp_list))
+        # Chunks of different length: one call per chunk
+        tmp_m_ = np.concatenate([pairwise_loss(i[:, np.newaxis, :], loss = loss) for i in tmp_list], axis=0)
         m = np.nansum(tmp_m_, axis=1)
 
     t_whol = list()
@@ -1100,23 +1907,48 @@ def statistical_strategy(matrix, up=75, bottom=25):
     mask_array[autoselect] = 1
     return mask_array
 
-def get_all_blks(path_session, sort = True):
+def get_all_blks(path_session, sort = True, filename_particle = 'vsd_C', store = False):
     '''
     All the .BLKs filenames, from the considered path_session, are picked.
     The list can be sorted by datetime or not, with the boolean variable sort.
-    Sorted by time by default.
+    Sorted by time by default. If the names carry no datetime, they are sorted by name.
+    The names come from the session manifest -see blk_manifest-: the filesystem is only scanned for changes.
+    The manifest sidecar is written in derivatives only if store is True.
     '''
-    tmp = [f.name for f in os.scandir(os.path.join(path_session,'rawdata')) if (f.is_file()) and (f.name.endswith(".BLK"))]
-    try: 
-        _ = datetime.datetime.strptime(tmp[0].split('_')[2] + tmp[0].split('_')[3], '%d%m%y%H%M%S')
-        if sort:
-            sort = True
-    except:
-        sort = False
-    if sort:
-        return sorted(tmp, key=lambda t: datetime.datetime.strptime(t.split('_')[2] + t.split('_')[3], '%d%m%y%H%M%S'))
-    else:
-        return tmp
+    return blk_manifest.get_manifest(path_session, filename_particle = filename_particle, store = store).blks(sort = sort)
+
+def get_stored_conds(path_md):
+    '''
+    Names -md_data_cond_name- of the Conditions stored in the md_data folder path_md, in columnar or legacy format.
+    '''
+    names = set()
+    for f in os.scandir(path_md):
+        if f.is_dir() and os.path.exists(os.path.join(f.path, CONDITION_META)):
+            names.add(f.name)
+        elif f.is_file() and f.name.endswith('.pickle'):
+            names.add(f.name.split('.pickle')[0])
+    return sorted(names)
+
+def convert_md_data(path_md, remove = False):
+    '''
+    Converter of the legacy pickles of the md_data folder path_md to the columnar Condition format. 
+    The ones already converted are skipped. With remove True the pickle is deleted after conversion.
+    Returns the converted names.
+    '''
+    converted = list()
+    for name in get_stored_conds(path_md):
+        path = os.path.join(path_md, name)
+        if os.path.isdir(path) or not os.path.exists(path + '.pickle'):
+            continue
+        cd = Condition()
+        cd.load_cond(path)
+        cd.store_columnar(path)
+        del cd
+        if remove:
+            os.remove(path + '.pickle')
+        converted.append(name)
+        print(name + ' converted')
+    return converted
 
 def get_selected(matrix, autoselection):
     indeces = np.where(autoselection == 1)[0]
@@ -1254,6 +2086,135 @@ if __name__=="__main__":
                         type=int,
                         default = None,
                         required=False) 
+
+    parser.add_argument('--bin_mode', 
+                        dest='bin_mode',
+                        type=str,
+                        default = 'linear',
+                        choices = list(utils.BINNING_MODES),
+                        required=False,
+                        help='Spatial binning: linear interpolation or area -block mean-') 
+
+    parser.add_argument('--dtype', 
+                        dest='dtype',
+                        type=str,
+                        default = 'float64',
+                        choices = utils.DTYPES,
+                        required=False,
+                        help='Precision of signals and stored conditions: float32 halves memory and disk') 
+
+    parser.add_argument('--frames', 
+                        dest='frame_window',
+                        type=int,
+                        nargs=2,
+                        default = None,
+                        required=False,
+                        help='Start and stop frames read from each BLK: None by default -all the frames-') 
+
+    parser.add_argument('--crop', 
+                        dest='crop',
+                        type=int,
+                        nargs=4,
+                        default = None,
+                        required=False,
+                        help='y0 y1 x0 x1 field of view read from each BLK: None by default -the whole frame-') 
+
+    parser.add_argument('--workers', 
+                        dest='n_workers',
+                        type=int,
+                        default = 1,
+                        required=False,
+                        help='Number of workers loading the trials: 1 by default -serial-') 
+
+    parser.add_argument('--pool', 
+                        dest='pool',
+                        type=str,
+                        default = 'thread',
+                        choices = ['thread', 'process'],
+                        required=False,
+                        help='Kind of workers loading the trials') 
+
+    parser.add_argument('--max_in_flight', 
+                        dest='max_in_flight',
+                        type=int,
+                        default = None,
+                        required=False,
+                        help='Maximum number of trials loaded at the same time: 2*workers by default') 
+
+    parser.add_argument('--prefetch', 
+                        dest='prefetch',
+                        type=int,
+                        default = 0,
+                        required=False,
+                        help='Number of BLKs read ahead in background, with serial loading: 0 by default') 
+
+    parser.add_argument('--streaming', 
+                        dest='streaming',
+                        action='store_true')
+    parser.add_argument('--no-streaming', 
+                        dest='streaming', 
+                        action='store_false')
+    parser.set_defaults(streaming=False)
+
+    parser.add_argument('--storage_format', 
+                        dest='storage_format',
+                        type=str,
+                        default = 'columnar',
+                        choices = STORAGE_FORMATS,
+                        required=False,
+                        help='Storage format of the Conditions: chunked compresses the trials tensors') 
+
+    parser.add_argument('--cache_gb', 
+                        dest='cache_gb',
+                        type=float,
+                        default = 0,
+                        required=False,
+                        help='Size in GB of the cache of the binned signals, reused by the next runs: 0 by default, no cache') 
+
+    parser.add_argument('--cond_workers', 
+                        dest='cond_workers',
+                        type=int,
+                        default = 1,
+                        required=False,
+                        help='Number of processes computing the conditions after the blank: 1 by default, serial') 
+
+    parser.add_argument('--max_memory', 
+                        dest='max_memory',
+                        type=float,
+                        default = None,
+                        required=False,
+                        help='Memory budget in GB of the trials of a condition: over it they are stored on disk') 
+
+    parser.add_argument('--incremental', 
+                        dest='incremental',
+                        action='store_true')
+    parser.add_argument('--no-incremental', 
+                        dest='incremental', 
+                        action='store_false')
+    parser.set_defaults(incremental=False)
+
+    parser.add_argument('--profile', 
+                        dest='profile',
+                        action='store_true')
+    parser.add_argument('--no-profile', 
+                        dest='profile', 
+                        action='store_false')
+    parser.set_defaults(profile=False)
+
+    parser.add_argument('--render_workers', 
+                        dest='render_workers',
+                        type=int,
+                        default = 0,
+                        required=False,
+                        help='Number of processes rendering the figures in background: 0 by default, in place') 
+
+    parser.add_argument('--renderer', 
+                        dest='renderer',
+                        type=str,
+                        default = 'matplotlib',
+                        choices = ['matplotlib', 'raster'],
+                        required=False,
+                        help='Renderer of the activity maps: matplotlib, by default, or raster -fast OpenCV mosaics-') 
     
 
     logger = utils.setup_custom_logger('myapp')
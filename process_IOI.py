@@ -166,17 +166,18 @@ def get_cond(path_md, cond_name, cd_id, zero_frame = 10, selection = False, cond
     cd = md.Condition(condition_name = cond_name, condition_numb=cd_id) 
     cd.load_cond(os.path.join(path_md,'md_data_'+cond_name))
     all_raw = np.copy(cd.binned_data)
-    dfs = np.array([process.deltaf_up_fzero(i, zero_frame, deblank = True, blank_sign = None) for i in all_raw])
+    indeces_blank = np.arange(len(all_raw))
 
     if selection:
         if cond_selection is None:
             # Selection blank trials
             indeces = cd.autoselection
         else:
-            indeces = np.zeros(len(dfs))
+            indeces = np.zeros(len(all_raw))
             indeces[cond_selection] = 1
         indeces_blank = np.where(indeces == 1)[0]
-        dfs = dfs[indeces_blank, :, :, :]
+    # dF/F0 only of the selected trials
+    dfs = process.deltaf_up_fzero_batch(all_raw[indeces_blank], zero_frame, deblank = True, blank_sign = None, in_place = True)
     del cd
     return all_raw, dfs
 
@@ -1,7 +1,120 @@
 import cv2 as cv
 import numpy as np
+import timing
 from scipy.ndimage.filters import convolve, gaussian_filter, median_filter, uniform_filter1d
-from scipy import optimize
+from scipy import optimize, sparse
+
+# Bytes of the float64 frames block reduced at once by roi_time_courses
+ROI_BLOCK_BYTES = 2**26
+
+def precision_dtype(data):
+    '''
+    Precision of the computations on data: float32 data stays float32, everything else -integers included- is float64.
+    '''
+    return np.float32 if np.asarray(data).dtype == np.float32 else np.float64
+
+def precise_nanmean(data, axis = None):
+    '''
+    np.nanmean with a float64 accumulator, returned with the precision of data -see precision_dtype-.
+    '''
+    return np.nanmean(data, axis = axis, dtype = np.float64).astype(precision_dtype(data), copy = False)
+
+def precise_nanstd(data, axis = None):
+    '''
+    np.nanstd with a float64 accumulator, returned with the precision of data -see precision_dtype-.
+    '''
+    return np.nanstd(data, axis = axis, dtype = np.float64).astype(precision_dtype(data), copy = False)
+
+class Welford:
+    '''
+    Streaming, NaN-aware, per-pixel mean and variance -Welford algorithm-: samples are added, or removed, one at a time.
+    For each element it keeps the count of the non NaN samples, their mean and M2, the sum of squared deviations, 
+    all in float64. mean and std equal np.nanmean and np.nanstd over the samples added and not removed, 
+    up to float rounding.
+    Parameters
+    ----------
+    shape : tuple
+        The shape of one sample, e.g. (T, Y, X) for one trial
+    '''
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean_ = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def update(self, sample):
+        sample = np.asarray(sample, dtype=np.float64)
+        valid = ~np.isnan(sample)
+        self.count += valid
+        delta = np.where(valid, sample - self.mean_, 0)
+        self.mean_ += np.divide(delta, self.count, out=np.zeros_like(delta), where=valid)
+        self.m2 += np.where(valid, delta*(sample - self.mean_), 0)
+
+    def remove(self, sample):
+        '''
+        Removes a sample previously added: e.g. a trial discarded by the autoselection.
+        '''
+        sample = np.asarray(sample, dtype=np.float64)
+        valid = ~np.isnan(sample)
+        self.count -= valid
+        delta = np.where(valid, sample - self.mean_, 0)
+        self.mean_ -= np.divide(delta, self.count, out=np.zeros_like(delta), where=valid & (self.count > 0))
+        self.m2 -= np.where(valid, delta*(sample - self.mean_), 0)
+        # An element without samples starts again from zero
+        empty = self.count == 0
+        self.mean_[empty] = 0
+        self.m2[empty] = 0
+
+    def mean(self, dtype = np.float64):
+        '''
+        Mean over the samples: NaN where there are none.
+        '''
+        return np.where(self.count > 0, self.mean_, np.nan).astype(dtype, copy = False)
+
+    def std(self, ddof = 0, dtype = np.float64):
+        '''
+        Standard deviation over the samples: NaN where there are not more than ddof.
+        '''
+        var = np.divide(self.m2, self.count - ddof, out=np.full(self.m2.shape, np.nan), where=self.count > ddof)
+        return np.sqrt(np.maximum(var, 0)).astype(dtype, copy = False)
+
+def trials_nanmean_std(data, indeces = None, transform = None, std = False):
+    '''
+    precise_nanmean -and precise_nanstd, if std is True- over axis 0 of data[indeces], computed one trial at a time: 
+    data can be an array, a np.memmap or a trial_store.DiskTrials, and the selection is never copied as a whole.
+    transform is applied to each trial before the reduction -e.g. a dF/F0 normalization-.
+    The float64 sums follow the order of np.nanmean and np.nanstd over axis 0: the results are identical.
+    Returns the mean, or the tuple (mean, std).
+    '''
+    if indeces is None:
+        indeces = range(len(data))
+    if len(indeces) == 0:
+        raise ValueError('No trials selected')
+    def get_trial(i):
+        trial = np.asarray(data[i])
+        return trial if transform is None else transform(trial)
+    total, count = None, None
+    for i in indeces:
+        trial = get_trial(i)
+        valid = ~np.isnan(trial)
+        if total is None:
+            total = np.zeros(trial.shape, dtype=np.float64)
+            count = np.zeros(trial.shape, dtype=np.intp)
+            dtype = trial.dtype
+        total += np.where(valid, trial, 0)
+        count += valid
+    mean = total/count
+    if not std:
+        return mean.astype(precision_dtype(dtype), copy = False)
+    # Second pass: squared deviations, computed in the trial dtype as np.nanvar does
+    total_sq = np.zeros(mean.shape, dtype=np.float64)
+    for i in indeces:
+        trial = get_trial(i)
+        valid = ~np.isnan(trial)
+        dev = np.where(valid, trial, 0).astype(trial.dtype, copy = False)
+        np.subtract(dev, mean, out=dev, casting='unsafe', where=valid)
+        dev[~valid] = 0
+        total_sq += np.multiply(dev, dev, out=dev)
+    return mean.astype(precision_dtype(dtype), copy = False), np.sqrt(total_sq/count).astype(precision_dtype(dtype), copy = False)
 
 def deltaf_up_fzero(vsdi_sign, n_frames_zero, deblank = False, blank_sign = None):
     '''F/F0 computation with -or without- demean of n_frames_zero and killing of outlier 
@@ -12,26 +125,55 @@ def deltaf_up_fzero(vsdi_sign, n_frames_zero, deblank = False, blank_sign = None
                 F/mean(F[0:n_frames_zero]) if False 
 		Returns
 		-------
-		df_fz : np.array, with shape nframes, width, height
+		df_fz : np.array, with shape nframes, width, height. float32 if vsdi_sign is float32, float64 otherwise
     '''
     #mean_frames_zero = np.nanmean(vsdi_sign[:n_frames_zero, :, :], axis = 0)
     if len(vsdi_sign.shape) != 3:
         print('Data input not a 3d matrix!')
         return
+    return deltaf_up_fzero_batch(vsdi_sign[np.newaxis], n_frames_zero, deblank = deblank, blank_sign = blank_sign)[0]
 
-    mean_frames_zero = np.nanmean(vsdi_sign[:n_frames_zero, :, :], axis = 0)
+@timing.timed('df_f', measure = lambda vsdi_sign, *args, **kwargs: (vsdi_sign.nbytes, len(vsdi_sign)))
+def deltaf_up_fzero_batch(vsdi_sign, n_frames_zero, deblank = False, blank_sign = None, out = None, in_place = False):
+    '''
+    deltaf_up_fzero of a block of trials, with shape (ntrials, nframes, width, height), without temporaries: 
+    the baselines are one reduction for each distinct number of zero frames, and the ratio, the deblank and 
+    the -1 are written into the same output buffer. The results are identical to deltaf_up_fzero of each trial.
+		----------
+		vsdi_sign : np.array, with shape ntrials, nframes, width, height
+        n_frames_zero: int, or a sequence with the number of zero frames of each trial -Trial.zero_frames-
+        deblank, blank_sign: as in deltaf_up_fzero
+        out: np.array with the shape of vsdi_sign and the dtype of the result, where df_fz is written
+        in_place: bool, if True and out is None, df_fz is written into vsdi_sign, when it has the dtype of the result
+		Returns
+		-------
+		df_fz : np.array, with shape ntrials, nframes, width, height. float32 if vsdi_sign is float32, float64 otherwise
+    '''
+    if len(vsdi_sign.shape) != 4:
+        print('Data input not a 4d matrix!')
+        return
+
+    dtype = precision_dtype(vsdi_sign)
+    zeros = np.broadcast_to(np.asarray(n_frames_zero, dtype=int), (len(vsdi_sign),))
+    mean_frames_zero = np.empty((len(vsdi_sign), 1) + vsdi_sign.shape[2:], dtype=dtype)
+    for z in np.unique(zeros):
+        selected = np.where(zeros == z)[0]
+        # A view, if all the trials share the number of zero frames
+        zero_frames = vsdi_sign[:, :z] if len(selected) == len(vsdi_sign) else vsdi_sign[selected, :z]
+        mean_frames_zero[selected, 0] = np.nanmean(zero_frames, axis = 1, dtype = np.float64)
     #mean_frames_zero[np.where(mean_frames_zero==0)] = np.min(mean_frames_zero)
-    # The case for precalculating the blank signal or not deblank at all
-    if (deblank and (blank_sign is None)):
-        df_fz= (vsdi_sign/mean_frames_zero) 
-    # The case for calculating the signal deblanked
-    elif deblank and (blank_sign is not None):
-        df_fz = ((vsdi_sign/mean_frames_zero)/(blank_sign)) - 1
-    # The case without deblank
-    elif (not deblank):
-        df_fz = (vsdi_sign/mean_frames_zero) -1
 
-    return df_fz
+    result_dtype = np.result_type(vsdi_sign.dtype, dtype)
+    if out is None:
+        out = vsdi_sign if (in_place and vsdi_sign.dtype == result_dtype) else np.empty(vsdi_sign.shape, dtype=result_dtype)
+    np.divide(vsdi_sign, mean_frames_zero, out = out)
+    # The case for calculating the signal deblanked
+    if deblank and (blank_sign is not None):
+        np.divide(out, np.asarray(blank_sign, dtype = dtype), out = out)
+    # The case for precalculating the blank signal keeps F/F0, otherwise -with or without deblank- dF/F0
+    if not (deblank and (blank_sign is None)):
+        np.subtract(out, 1, out = out)
+    return out
 
 def detection_blob(averaged_zscore, min_lim=80, max_lim = 100, min_2_lim = 97, max_2_lim = 100, std = 15, adaptive_thresh = True, kind = 'zscore'):#From 90 to 99 of min_2_lim
     '''
@@ -223,12 +365,73 @@ def time_course_signal(df_fz, roi_mask):#, hand_made=False):
     -----------
         self.roi_sign: numpy.array (70,1) the signal inside the ROI, represented as a 1D array
     """
-    roi_sign = list()
-    for i in df_fz:
-        masked_array = np.ma.masked_array(i, mask = roi_mask)
-        to_app = np.nanmean(masked_array)
-        roi_sign.append(to_app)
-    return np.array(roi_sign)
+    # roi_mask is a np.ma mask: True outside the ROI
+    return roi_time_courses(df_fz, roi_mask, excluded = True)[0].astype(precision_dtype(df_fz), copy = False)
+
+def polygon_mask(points, shape):
+    '''
+    Boolean mask, True inside the polygon of vertices points -(x, y) tuples, e.g. DrawLineWidget.image_coordinates-.
+    '''
+    mask = np.zeros(shape, dtype=np.uint8)
+    cv.fillPoly(mask, [np.round(np.asarray(points)).astype(np.int32).reshape(-1, 1, 2)], 1)
+    return mask.astype(bool)
+
+def roi_weights(masks, excluded = False):
+    '''
+    Sparse pixel weight matrix of the ROIs, with shape (n_rois, height*width): one row for each mask.
+    Parameters
+    ----------
+    masks: 2D array, or list of 2D arrays with the frame shape. Boolean masks -circular ROI, handmade masks, 
+           retinotopic windows, polygon_mask- are True inside the ROI; a float mask is a weight for each pixel.
+    excluded: bool, if True the masks are np.ma masks, True outside the ROI -e.g. blk_file.circular_mask_roi-.
+    '''
+    masks = np.asarray(masks)
+    if masks.ndim == 2:
+        masks = masks[np.newaxis]
+    if excluded:
+        masks = ~masks.astype(bool)
+    return sparse.csr_matrix(masks.reshape(len(masks), -1).astype(np.float64))
+
+@timing.timed('roi', measure = lambda data, *args, **kwargs: (0, 1 if np.ndim(data) == 3 else len(data)))
+def roi_time_courses(data, masks, excluded = False, block_bytes = ROI_BLOCK_BYTES):
+    '''
+    NaN-aware weighted mean of each frame inside each ROI, for all the ROIs in one pass: the frames are flattened and 
+    multiplied by the sparse pixel weight matrix -see roi_weights-, so many ROIs cost about as much as one.
+    A boolean ROI gives np.nanmean of the masked frame, with float64 accumulator. NaN where the ROI has no valid pixel.
+    Parameters
+    ----------
+    data: array with shape (n_frames, height, width) or (n_trials, n_frames, height, width). The trials are read 
+          one at a time: data can be a np.memmap, a trial_store.TrialStore or a trial_store.DiskTrials.
+    masks: as in roi_weights, or a weight matrix returned by roi_weights -to reuse it across calls-.
+    excluded: bool, as in roi_weights.
+    block_bytes: int, float64 bytes of the frames reduced at once.
+    Returns
+    ----------
+    float64 array with shape (n_rois, n_frames), or (n_trials, n_rois, n_frames).
+    '''
+    weights = masks if sparse.issparse(masks) else roi_weights(masks, excluded = excluded)
+    single = np.ndim(data) == 3
+    trials = [data] if single else data
+    tcs = list()
+    for trial in trials:
+        trial = np.asarray(trial)
+        frames = trial.reshape(len(trial), -1)
+        if frames.shape[1] != weights.shape[1]:
+            raise ValueError(f'Frames of {frames.shape[1]} pixels and ROI masks of {weights.shape[1]} pixels')
+        tc = np.empty((weights.shape[0], len(frames)), dtype=np.float64)
+        step = max(1, block_bytes//(8*frames.shape[1]))
+        for start in range(0, len(frames), step):
+            block = frames[start:start+step].astype(np.float64)
+            valid = ~np.isnan(block)
+            if valid.all():
+                counts = np.asarray(weights.sum(axis=1))
+            else:
+                block[~valid] = 0
+                counts = weights @ valid.T.astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                tc[:, start:start+step] = (weights @ block.T)/counts
+        tcs.append(tc)
+    return tcs[0] if single else np.array(tcs)
 
 def gaussian3d(data , size = 3, std = .65):
     # Define the standard deviations for each dimension (t, y, x)
@@ -325,6 +528,7 @@ def sobel_filter(im, k, N):
     return sobel
 
 
+@timing.timed('zscore')
 def zeta_score(sig_cond, sig_blank, std_blank, full_seq = False, zero_frames = 20):
     #eps = np.nanmin(sig_cond)
     # Security check
@@ -335,22 +539,22 @@ def zeta_score(sig_cond, sig_blank, std_blank, full_seq = False, zero_frames = 2
     elif len(np.shape(sig_cond))==4:
         # Blank mean and stder computation
         if (sig_blank is None) or (std_blank is None):
-            mean_signblnk_overcond = np.nanmean(sig_cond[:, :zero_frames, :, :], axis = 0)
-            stder_signblnk_overcond = np.nanstd(sig_cond[:, :zero_frames, :, :], axis = 0)/np.sqrt(np.shape(sig_cond)[0])# Normalization of standard over all the frames, not only the zero_frames        
+            mean_signblnk_overcond = precise_nanmean(sig_cond[:, :zero_frames, :, :], axis = 0)
+            stder_signblnk_overcond = precise_nanstd(sig_cond[:, :zero_frames, :, :], axis = 0)/np.sqrt(np.shape(sig_cond)[0])# Normalization of standard over all the frames, not only the zero_frames        
         else:
             mean_signblnk_overcond = sig_blank
             stder_signblnk_overcond = std_blank#np.std(sig_blank[:, :, :], axis = 0)/np.sqrt(np.shape(sig_blank)[0])
 
         # Condition mean and stder computation
-        mean_sign_overcond = np.nanmean(sig_cond[:, :, :, :], axis = 0)
+        mean_sign_overcond = precise_nanmean(sig_cond[:, :, :, :], axis = 0)
         # stder_sign_overcond = np.nanstd(sig_cond[:, :, :, :], axis = 0)/np.sqrt(np.shape(sig_cond)[0])
 
     # Case for single trial analysis: full time sequence analysis    
     elif len(np.shape(sig_cond))==3:
         # Blank mean and stder computation
         if (sig_blank is None) or (std_blank is None):
-            mean_signblnk_overcond = np.nanmean(sig_cond[:zero_frames, :, :], axis = 0)
-            stder_signblnk_overcond = np.nanstd(sig_cond[:zero_frames, :, :], axis = 0)/np.sqrt(np.shape(sig_cond)[0])# Normalization of standard over all the frames, not only the zero_frames        
+            mean_signblnk_overcond = precise_nanmean(sig_cond[:zero_frames, :, :], axis = 0)
+            stder_signblnk_overcond = precise_nanstd(sig_cond[:zero_frames, :, :], axis = 0)/np.sqrt(np.shape(sig_cond)[0])# Normalization of standard over all the frames, not only the zero_frames        
         else:
             mean_signblnk_overcond = sig_blank
             stder_signblnk_overcond = std_blank#np.std(sig_blank[:, :, :], axis = 0)/np.sqrt(np.shape(sig_blank)[0])
@@ -361,7 +565,7 @@ def zeta_score(sig_cond, sig_blank, std_blank, full_seq = False, zero_frames = 2
             # stder_sign_overcond = 0
         else:        
             # Condition mean and stder computation
-            mean_sign_overcond = np.nanmean(sig_cond[ :, :, :], axis = 0)
+            mean_sign_overcond = precise_nanmean(sig_cond[ :, :, :], axis = 0)
             # stder_sign_overcond = np.nanstd(sig_cond[ :, :, :], axis = 0)/np.sqrt(np.shape(sig_cond)[0])
     
     # Try to fix the zscore defected for Hip AM3Strokes second session.
@@ -370,6 +574,6 @@ def zeta_score(sig_cond, sig_blank, std_blank, full_seq = False, zero_frames = 2
     A = mean_sign_overcond-mean_signblnk_overcond
     B = stder_signblnk_overcond
     # B = np.sqrt(stder_signblnk_overcond**2 + stder_sign_overcond**2)
-    zscore = A/B
+    zscore = (A/B).astype(precision_dtype(sig_cond), copy = False)
     return zscore
 
@@ -0,0 +1,92 @@
+import concurrent.futures
+import numpy as np
+import traceback
+
+# Bytes of the figure jobs queued, and not rendered yet, by default
+MAX_QUEUED_BYTES = 2**30
+
+def init_render_worker():
+    '''
+    Initializer of a render worker: non interactive backend, before pyplot is used.
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+
+def render(func, args, kwargs):
+    '''
+    Runs the plotting function in the worker, closing its figures. Returns the traceback if it fails, None otherwise.
+    '''
+    import matplotlib.pyplot as plt
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        plt.close('all')
+    return None
+
+def get_nbytes(obj):
+    '''
+    Bytes of the numpy arrays in obj, and in its lists, tuples and dict values.
+    '''
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (list, tuple)):
+        return sum(get_nbytes(i) for i in obj)
+    if isinstance(obj, dict):
+        return sum(get_nbytes(i) for i in obj.values())
+    return 0
+
+class RenderQueue:
+    '''
+    Background rendering of the figures: a job is a module level plotting function -e.g. of data_visualization- with
+    its arguments, data slices included, rendered by a pool of n_workers processes with the Agg backend.
+    The computation goes on while the figures are rendered. The data of the jobs not rendered yet are bounded to
+    max_bytes: over it, submit waits for the oldest jobs. A job larger than max_bytes is rendered alone.
+    wait() blocks until all the figures are rendered; use it, or close(), at the end of the session.
+    '''
+    def __init__(self, n_workers = 1, max_bytes = MAX_QUEUED_BYTES, log = None):
+        self.executor = concurrent.futures.ProcessPoolExecutor(n_workers, initializer = init_render_worker)
+        self.max_bytes = max_bytes
+        self.log = log
+        self.pending = dict()
+        self.queued_bytes = 0
+
+    def submit(self, func, *args, **kwargs):
+        nbytes = get_nbytes(args) + get_nbytes(kwargs)
+        while self.pending and (self.queued_bytes + nbytes > self.max_bytes):
+            done, _ = concurrent.futures.wait(list(self.pending), return_when = concurrent.futures.FIRST_COMPLETED)
+            self.collect(done)
+        future = self.executor.submit(render, func, args, kwargs)
+        self.pending[future] = (func.__name__, nbytes)
+        self.queued_bytes += nbytes
+        return future
+
+    def collect(self, done):
+        for future in done:
+            name, nbytes = self.pending.pop(future)
+            self.queued_bytes -= nbytes
+            error = future.exception() or future.result()
+            if error is not None:
+                message = f'Rendering of {name} failed: {error}'
+                if self.log is None:
+                    print(message)
+                else:
+                    self.log.info(message)
+
+    def wait(self):
+        '''
+        Waits for all the figures queued.
+        '''
+        done, _ = concurrent.futures.wait(list(self.pending))
+        self.collect(done)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,4 +1,4 @@
-import argparse, blk_file, datetime, json, os, utils
+import argparse, blk_file, datetime, json, os, timing, utils
 import cv2 as cv
 import data_visualization as dv
 import matplotlib.pyplot as plt
@@ -261,6 +261,7 @@ class RetinoSession(md.Session):
             return 
         
 
+        @timing.timed('retinotopy')
         def get_retinotopy(self,
                            name_cond, 
                            time_limits, 
@@ -0,0 +1,187 @@
+import argparse, blk_file, datetime, os, struct
+import numpy as np
+
+# Header length written by VDAQ: the data start right after it
+LENHEADER = 1716
+FILETYPE_RAWBLOCK = 11
+SUBTYPES = {'vdaq': 11, 'dyedaq': blk_file.FROM_DYEDAQ}
+DATATYPE_IDS = {v: k for k, v in blk_file.DATATYPES.items()}
+TIME_FORMAT = '%d%m%y_%H%M%S'
+
+def get_header(n_frames, height, width, dtype = '<u2', subtype = 'vdaq', lenheader = LENHEADER, n_stimuli = 1, date = None):
+    '''
+    Raw bytes of a BLK header with the layout parsed by blk_file.BlkHeader, for a payload of n_frames frames
+    (height, width) of samples dtype, with the VDAQ or DyeDAQ subtype. Returns lenheader bytes.
+    '''
+    dtype = np.dtype(dtype).newbyteorder('<')
+    record = np.zeros(1, dtype = blk_file.HEADER_DTYPES[subtype])
+    framesize = height*width*dtype.itemsize
+    record['filesize'] = lenheader + n_frames*framesize
+    record['lenheader'] = lenheader
+    record['versionid'] = 1.0
+    record['filetype'] = FILETYPE_RAWBLOCK
+    record['filesubtype'] = SUBTYPES[subtype]
+    record['datatype'] = DATATYPE_IDS[dtype]
+    record['sizeof'] = dtype.itemsize
+    record['framewidth'] = width
+    record['frameheight'] = height
+    record['nframesperstim'] = n_frames
+    record['nstimuli'] = n_stimuli
+    for field in ['initialxbinfactor', 'initialybinfactor', 'xbinfactor', 'ybinfactor', 'ntrials', 'scalefactor']:
+        record[field] = 1
+    record['x2roi'] = width
+    record['y2roi'] = height
+    record['framesize'] = framesize
+    date = datetime.datetime(2022, 1, 1) if date is None else date
+    record['recordingdate'] = np.void(struct.pack('16p', date.strftime('%m/%d/%y').encode()))
+    stimuli = bytes(range(1, n_stimuli+1))
+    if subtype == 'dyedaq':
+        record['temp'] = np.void(stimuli.ljust(128, b'\0'))
+        record['framesperstim'] = n_frames
+        record['trialsperblock'] = 1
+        record['samplingrate'] = 1
+    else:
+        record['listofstimuli'] = np.void(stimuli.ljust(256, b'\0'))
+    raw = record.tobytes()
+    return raw[:lenheader].ljust(lenheader, b'\0')
+
+def write_blk(path, data, subtype = 'vdaq', lenheader = LENHEADER, date = None):
+    '''
+    Writes data -(n_frames, height, width), with a dtype of blk_file.DATATYPES- as a BLK file.
+    '''
+    data = np.ascontiguousarray(data, dtype = np.dtype(data.dtype).newbyteorder('<'))
+    header = get_header(data.shape[0], data.shape[1], data.shape[2], dtype = data.dtype, subtype = subtype, lenheader = lenheader, date = date)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(data.tobytes())
+    return path
+
+def synthetic_signal(n_frames = 70, height = 100, width = 100, zero_frames = 20, dtype = '<u2', amplitude = 2e-3,
+                     center = None, sigma = None, tau = 5., drift = 0., noise = 1e-3, baseline = 10000., seed = None):
+    '''
+    Fluorescence of a synthetic trial: a vignetted baseline F0, with a gaussian blob of dF/F0 amplitude at center,
+    rising with time constant tau after zero_frames, a linear drift over the trial -relative to F0- and gaussian
+    noise. amplitude 0 gives a blank trial. center -(y, x)- is the frame center and sigma a tenth of the width, 
+    by default. For integer dtypes baseline is at most half of the range.
+    Returns the (n_frames, height, width) signal, rounded for integer dtypes.
+    '''
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui':
+        # Baseline within the range of the samples
+        baseline = min(baseline, np.iinfo(dtype).max/2)
+    y, x = np.mgrid[0:height, 0:width]
+    cy, cx = ((height-1)/2, (width-1)/2) if center is None else center
+    sigma = width/10 if sigma is None else sigma
+    r2 = ((y-(height-1)/2)/height)**2 + ((x-(width-1)/2)/width)**2
+    f0 = baseline*(1 - r2)
+    blob = np.exp(-((y-cy)**2 + (x-cx)**2)/(2*sigma**2))
+    t = np.arange(n_frames)
+    response = amplitude*np.clip(1 - np.exp(-(t-zero_frames)/tau), 0, None)
+    trend = drift*t/max(1, n_frames-1)
+    ratio = 1 + response[:, None, None]*blob + trend[:, None, None] + noise*rng.standard_normal((n_frames, height, width))
+    signal = f0*ratio
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        signal = np.clip(np.round(signal), info.min, info.max)
+    return signal.astype(dtype)
+
+def blk_name(condition, date, n, filename_particle = 'vsd_C'):
+    '''
+    BLK filename, as parsed by utils.parse_blk_name: e.g. vsd_C01_010122_101010_E1B001.BLK
+    '''
+    return f'{filename_particle}{condition:02d}_{date.strftime(TIME_FORMAT)}_E1B{n:03d}.BLK'
+
+def make_session(path_session, n_conditions = 4, n_trials = 8, n_frames = 70, height = 100, width = 100, zero_frames = 20,
+                 dtype = '<u2', subtype = 'vdaq', amplitude = 2e-3, drift = 0., noise = 1e-3, seed = 0, filename_particle = 'vsd_C'):
+    '''
+    Writes a synthetic session in path_session: rawdata with n_trials BLKs for each of n_conditions conditions,
+    interleaved and one second apart, and metadata/labelConds.txt. The last condition is the blank one, the others
+    have a blob at a different position along the horizontal axis. path_session should look like
+    .../exp-name/sub-name/ses-name, as Condition expects.
+    Returns the list of BLK names.
+    '''
+    os.makedirs(os.path.join(path_session, 'rawdata'), exist_ok = True)
+    os.makedirs(os.path.join(path_session, 'metadata'), exist_ok = True)
+    with open(os.path.join(path_session, 'metadata', 'labelConds.txt'), 'w') as f:
+        f.write('\n'.join([f'Condition {c}' for c in range(1, n_conditions)] + ['blank']) + '\n')
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2022, 1, 1, 10, 0, 0)
+    names = list()
+    for n in range(n_trials*n_conditions):
+        condition = n%n_conditions + 1
+        blank = condition == n_conditions
+        center = ((height-1)/2, (width-1)*condition/n_conditions)
+        date = start + datetime.timedelta(seconds = n)
+        data = synthetic_signal(n_frames, height, width, zero_frames, dtype = dtype, amplitude = 0 if blank else amplitude,
+                                center = center, drift = drift, noise = noise, seed = rng.integers(2**32))
+        names.append(blk_name(condition, date, n, filename_particle = filename_particle))
+        write_blk(os.path.join(path_session, 'rawdata', names[-1]), data, subtype = subtype, date = date)
+    return names
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Writing a session of synthetic BLK files')
+
+    parser.add_argument('--path_session',
+                        dest='path_session',
+                        type=str,
+                        required=True,
+                        help='The session path: exp-name/sub-name/ses-name')
+
+    parser.add_argument('--n_conditions',
+                        dest='n_conditions',
+                        type=int,
+                        default = 4,
+                        required=False,
+                        help='Number of conditions, the last one blank')
+
+    parser.add_argument('--n_trials',
+                        dest='n_trials',
+                        type=int,
+                        default = 8,
+                        required=False,
+                        help='Number of trials for each condition')
+
+    parser.add_argument('--shape',
+                        dest='shape',
+                        type=int,
+                        nargs=3,
+                        default = [70, 100, 100],
+                        required=False,
+                        help='Frames, height and width of each BLK')
+
+    parser.add_argument('--zero_frames',
+                        dest='zero_frames',
+                        type=int,
+                        default = 20,
+                        required=False,
+                        help='Frames before the response onset')
+
+    parser.add_argument('--dtype',
+                        dest='dtype',
+                        type=str,
+                        default = '<u2',
+                        choices = [d.str for d in blk_file.DATATYPES.values()],
+                        required=False,
+                        help='Samples type')
+
+    parser.add_argument('--subtype',
+                        dest='subtype',
+                        type=str,
+                        default = 'vdaq',
+                        choices = list(SUBTYPES),
+                        required=False,
+                        help='Header subtype')
+
+    parser.add_argument('--seed',
+                        dest='seed',
+                        type=int,
+                        default = 0,
+                        required=False,
+                        help='Random seed')
+
+    args = parser.parse_args()
+    names = make_session(args.path_session, n_conditions = args.n_conditions, n_trials = args.n_trials, n_frames = args.shape[0],
+                         height = args.shape[1], width = args.shape[2], zero_frames = args.zero_frames, dtype = args.dtype,
+                         subtype = args.subtype, seed = args.seed)
+    print(f'{len(names)} BLK files written in ' + os.path.join(args.path_session, 'rawdata'))
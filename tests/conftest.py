@@ -0,0 +1,38 @@
+import glob
+import logging
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import middle_process as md
+import synthetic_blk
+
+LOG = logging.getLogger('vsdi_tests')
+
+@pytest.fixture
+def path_session(tmp_path):
+    '''
+    Small synthetic session: 3 conditions -the last one blank- of 4 trials, 30 frames of 40x40 pixels.
+    '''
+    path = os.path.join(str(tmp_path), 'exp-test', 'sub-test', 'ses-test')
+    synthetic_blk.make_session(path, n_conditions = 3, n_trials = 4, n_frames = 30, height = 40, width = 40, zero_frames = 10)
+    return path
+
+def run_session(path_session, **kwargs):
+    '''
+    Runs get_session with deblank, storage and no figures. kwargs are Session options.
+    '''
+    params = dict(spatial_bin = 2, temporal_bin = 1, zero_frames = 10, tolerance = 20, mov_switch = False, deblank_switch = True,
+                  conditions_id = None, chunks = 1, strategy = 'mae', logs_switch = False, data_vis_switch = False,
+                  store_switch = True, end_frame = None, detrend_switch = False, condid = None, base_report_name = 'BaseReport.csv',
+                  base_head_dim = 19, logger = LOG, filename_particle = 'vsd_C')
+    params.update(kwargs)
+    session = md.Session(path_session, **params)
+    session.get_session()
+    return session
+
+def get_path_md(path_session):
+    return glob.glob(os.path.join(path_session, 'derivatives', '**', 'md_data'), recursive = True)[0]
@@ -0,0 +1,83 @@
+import os
+
+import batch_runner as br
+import synthetic_blk
+
+SESSION_OPTIONS = dict(spatial_bin = 2, zero_frames = 10, tolerance = 20, mov_switch = False, deblank_switch = True, chunks = 1,
+                       strategy = 'mae', logs_switch = False, data_vis_switch = False, filename_particle = 'vsd_C')
+
+def test_job_log(tmp_path, path_session):
+    # Prints and logs of the job share one handle: neither overwrites the other
+    queue = br.JobQueue(os.path.join(str(tmp_path), 'queue.sqlite'))
+    queue.add('middle_process', path_session, options = SESSION_OPTIONS)
+    job = queue.claim()
+    path_log = os.path.join(str(tmp_path), 'job.txt')
+    br.run_job(queue.path, job, path_log)
+    with open(path_log) as f:
+        text = f.read()
+    start, printed, end = text.find(f"Job {job['id']}: middle_process"), text.find('Trial n. 1/4 loaded'), text.find(f"Job {job['id']} done in")
+    assert -1 < start < printed < end
+    assert os.path.isdir(queue.jobs()[0]['output'])
+
+def make_sessions(tmp_path, n_trials):
+    # One small session for each number of trials: the cost grows with the BLKs
+    paths = list()
+    for i, n in enumerate(n_trials):
+        path = os.path.join(str(tmp_path), 'exp-test', f'sub-test{i}', 'ses-test')
+        synthetic_blk.make_session(path, n_conditions = 2, n_trials = n, n_frames = 10, height = 8, width = 8, zero_frames = 5)
+        paths.append(os.path.normpath(path))
+    return paths
+
+def test_claim_order(tmp_path):
+    small, large = make_sessions(tmp_path, [1, 3])
+    queue = br.JobQueue(os.path.join(str(tmp_path), 'queue.sqlite'))
+    # Later pipelines wait for the earlier ones of their session, whatever the cost
+    for pipeline in ['process_IOI', 'retinotopy', 'middle_process']:
+        assert queue.add(pipeline, small)
+    assert queue.add('middle_process', large)
+    assert not queue.add('middle_process', large)
+    job = queue.claim()
+    assert (job['pipeline'], job['path_session']) == ('middle_process', large)
+    job = queue.claim()
+    assert (job['pipeline'], job['path_session']) == ('middle_process', small)
+    assert queue.claim() is None
+    queue.finish(job['id'])
+    job = queue.claim()
+    assert (job['pipeline'], job['path_session']) == ('retinotopy', small)
+    assert queue.claim() is None
+    # A failed job blocks the later pipelines of its session
+    queue.finish(job['id'], error = 'Exit code 1')
+    job = queue.claim()
+    queue.finish(job['id'], error = 'Exit code 1')
+    assert queue.claim() is None
+    assert queue.summary() == {'pending': 1, 'running': 1, 'done': 1, 'failed': 1}
+
+def test_finish_resume_retry(tmp_path):
+    path, = make_sessions(tmp_path, [1])
+    queue = br.JobQueue(os.path.join(str(tmp_path), 'queue.sqlite'))
+    queue.add('middle_process', path, max_attempts = 2)
+    # Failures are pending again until max_attempts runs
+    for status in ['pending', 'failed']:
+        job = queue.claim()
+        queue.finish(job['id'], error = 'Exit code 1', log = 'log.txt')
+        job, = queue.jobs()
+        assert (job['status'], job['error'], job['log']) == (status, 'Exit code 1', 'log.txt')
+    assert queue.claim() is None
+    assert queue.retry_failed(max_attempts = 3) == 1
+    job, = queue.jobs()
+    assert (job['status'], job['attempts'], job['max_attempts']) == ('pending', 0, 3)
+    # Jobs left running by an interrupted batch are pending again, without counting the attempt
+    job = queue.claim()
+    assert queue.jobs('running')[0]['id'] == job['id']
+    assert queue.resume() == 1
+    job, = queue.jobs()
+    assert (job['status'], job['attempts'], job['started']) == ('pending', 0, None)
+    job = queue.claim()
+    queue.set_output(job['id'], 'md_data')
+    assert queue.get_output('middle_process', path) is None
+    queue.finish(job['id'])
+    job, = queue.jobs('done')
+    assert (job['attempts'], job['error']) == (1, None)
+    assert queue.get_output('middle_process', path) == 'md_data'
+    # The queue survives its connections
+    assert br.JobQueue(queue.path).summary() == {'pending': 0, 'running': 0, 'done': 1, 'failed': 0}
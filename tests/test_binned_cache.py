@@ -0,0 +1,58 @@
+import os
+import pickle
+
+import numpy as np
+
+import binned_cache
+from conftest import run_session
+
+def make_blks(folder, n):
+    paths = list()
+    for i in range(n):
+        paths.append(os.path.join(folder, f'trial_{i}.BLK'))
+        with open(paths[-1], 'wb') as f:
+            f.write(bytes([i]))
+    return paths
+
+def test_lru_eviction(tmp_path):
+    data = np.zeros(1000)
+    paths = make_blks(str(tmp_path), 4)
+    # Room for three entries: .npy header and data
+    cache = binned_cache.BinnedCache(os.path.join(str(tmp_path), 'cache'), 3*(data.nbytes + 128))
+    for path in paths[:3]:
+        cache.put(path, {}, data)
+    # The first entry becomes the most recently used: the second one is evicted
+    assert cache.get(paths[0], {}) is not None
+    cache.put(paths[3], {}, data)
+    assert [cache.contains(path, {}) for path in paths] == [True, False, True, True]
+    assert cache.total == sum(os.path.getsize(cache.entry_path(key)) for key in cache.entries)
+    assert cache.total <= cache.max_bytes
+    # A new cache on the folder reads the entries once
+    reloaded = binned_cache.BinnedCache(cache.path_cache, cache.max_bytes)
+    assert sorted(reloaded.entries) == sorted(cache.entries)
+    assert reloaded.total == cache.total
+
+def test_worker_copies(tmp_path):
+    data = np.zeros(1000)
+    paths = make_blks(str(tmp_path), 4)
+    cache = binned_cache.BinnedCache(os.path.join(str(tmp_path), 'cache'), 3*(data.nbytes + 128))
+    cache.put(paths[0], {}, data)
+    # Process workers get a copy without the index: they cache, but do not evict
+    workers = [pickle.loads(pickle.dumps(cache)) for _ in range(2)]
+    for i, path in enumerate(paths[1:]):
+        workers[i % 2].put(path, {}, data)
+    assert all(w.entries is None for w in workers)
+    assert all(cache.contains(path, {}) for path in paths)
+    # The original reads them once the pool is over, and evicts the least recently used
+    os.utime(cache.entry_path(cache.get_key(paths[0], {})), ns = (0, 0))
+    cache.sync()
+    assert [cache.contains(path, {}) for path in paths] == [False, True, True, True]
+    assert cache.total == sum(os.path.getsize(cache.entry_path(key)) for key in cache.entries)
+
+def test_process_pool(path_session):
+    # Two process workers on a cache with room for three binned signals
+    size = 30*20*20*8 + 128
+    session = run_session(path_session, n_workers = 2, pool = 'process', cache_gb = 3*size/binned_cache.GB)
+    cache = binned_cache.get_cache(session.header)
+    assert 0 < len(cache.entries) <= 3
+    assert cache.total <= cache.max_bytes
@@ -0,0 +1,38 @@
+import cv2 as cv
+import numpy as np
+import pytest
+
+import utils
+
+@pytest.mark.parametrize('mode', list(utils.BINNING_MODES))
+@pytest.mark.parametrize('dtype', utils.DTYPES)
+def test_bin_image_as_binning(mode, dtype):
+    data = np.random.default_rng(0).integers(0, 2**16, (6, 40, 60)).astype('<u2')
+    for spatial_bin in [1, 2, 3, 4]:
+        binned = utils.bin_image(data, 60//spatial_bin, 40//spatial_bin, mode = mode, dtype = dtype)
+        assert binned.dtype == np.dtype(dtype)
+        if (mode == 'linear') or (spatial_bin in [1, 2, 4]):
+            # With 'area' and a factor not dividing the frame, binning crops it first
+            assert np.array_equal(binned, utils.binning(data, spatial_bin, mode = mode, dtype = dtype))
+
+def test_bin_image_any_size():
+    # The historical per frame resize
+    data = np.random.default_rng(0).random((5, 37, 53))
+    expected = np.array([cv.resize(frame, (20, 11), interpolation=cv.INTER_LINEAR) for frame in data])
+    assert np.array_equal(utils.bin_image(data, 20, 11), expected)
+
+@pytest.mark.parametrize('dtype', utils.DTYPES)
+@pytest.mark.parametrize('temporal_bin', [1, 2, 3])
+@pytest.mark.parametrize('spatial_bin', [2, 3, 4])
+def test_area_blocks_as_resize(spatial_bin, temporal_bin, dtype):
+    # The reshaped block mean of integer factors against cv.resize on the cropped frames
+    data = np.random.default_rng(0).integers(0, 2**16, (7, 41, 62)).astype('<u2')
+    y_size, x_size = 41//spatial_bin, 62//spatial_bin
+    binned = utils.binning(data, spatial_bin, temporal_bin, mode = 'area', dtype = dtype)
+    resized = utils.binning(data[:, :y_size*spatial_bin, :x_size*spatial_bin], 1, temporal_bin, mode = 'area', dtype = dtype, size = (y_size, x_size))
+    assert binned.shape == resized.shape == (int(np.ceil(7/temporal_bin)), y_size, x_size)
+    if (temporal_bin == 1) and (spatial_bin in [2, 4]):
+        assert np.array_equal(binned, resized)
+    else:
+        # cv weights the pixels by 1/spatial_bin**2 in single precision, and frames are summed in a different order
+        assert np.allclose(binned, resized, rtol = 1e-6, atol = 0)
@@ -0,0 +1,49 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+
+import blk_file
+import synthetic_blk
+
+def consume(prefetcher, outcome):
+    try:
+        outcome['items'] = list(prefetcher)
+    except Exception as e:
+        outcome['error'] = e
+
+def test_prefetcher_error(tmp_path, monkeypatch):
+    paths = list()
+    for i in range(3):
+        paths.append(os.path.join(str(tmp_path), f'trial_{i}.BLK'))
+        with open(paths[-1], 'wb') as f:
+            f.write(bytes([i])*10)
+    # A missing file is yielded as None, any other error stops the iteration
+    with blk_file.BlkPrefetcher(paths[:1] + [os.path.join(str(tmp_path), 'missing.BLK')], depth = 1) as prefetcher:
+        assert [buffer for _, buffer in prefetcher] == [bytearray(bytes([0])*10), None]
+    def fail(*args, **kwargs):
+        raise MemoryError('no room for the buffer')
+    monkeypatch.setattr(blk_file, 'bytearray', fail, raising = False)
+    outcome = dict()
+    with blk_file.BlkPrefetcher(paths, depth = 1) as prefetcher:
+        consumer = threading.Thread(target = consume, args = (prefetcher, outcome), daemon = True)
+        consumer.start()
+        consumer.join(timeout = 10)
+        assert not consumer.is_alive()
+    assert isinstance(outcome.get('error'), MemoryError)
+
+def test_read_window_truncated(tmp_path):
+    data = np.arange(10*8*8, dtype = '<u2').reshape((10, 8, 8))
+    path = synthetic_blk.write_blk(os.path.join(str(tmp_path), 'vsd_C01_010122_100000_E1B000.BLK'), data)
+    window = [dict(frames = (2, 9)), dict(frames = (2, 9), crop = (1, 7, 2, 6))]
+    for kwargs in window:
+        blk = blk_file.BlkFile(path, 1, 1, **kwargs)
+        t0, t1, y0, y1, x0, x1 = blk.get_window()
+        assert np.array_equal(blk.read_window(), data[t0:t1, y0:y1, x0:x1])
+    # The last frames are missing: e.g. a BLK still being written
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3*data[0].nbytes)
+    for kwargs in window:
+        with pytest.raises(ValueError):
+            blk_file.BlkFile(path, 1, 1, **kwargs).read_window()
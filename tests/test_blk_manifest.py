@@ -0,0 +1,47 @@
+import json
+import os
+import shutil
+
+import blk_manifest
+import middle_process as md
+import utils
+
+def test_readers_do_not_store(path_session):
+    blks = md.get_all_blks(path_session)
+    assert len(blks) == 12
+    assert not os.path.exists(os.path.join(path_session, 'derivatives', blk_manifest.MANIFEST_NAME))
+    # The Session setup stores the manifest already built
+    blk_manifest.get_manifest(path_session, store = True)
+    assert os.path.exists(os.path.join(path_session, 'derivatives', blk_manifest.MANIFEST_NAME))
+
+def test_refresh_changed_blks(path_session, monkeypatch):
+    manifest = blk_manifest.BlkManifest(path_session, store = True)
+    with open(manifest.path_manifest) as f:
+        assert json.load(f)['rawdata_mtime_ns'] == manifest.rawdata_mtime_ns
+    parsed = list()
+    get_entry = manifest.get_entry
+    monkeypatch.setattr(manifest, 'get_entry', lambda name, st: parsed.append(name) or get_entry(name, st))
+    assert not manifest.refresh()
+    assert len(parsed) == 0
+    # A BLK still being written grows in place: the folder mtime does not change
+    path_rawdata = os.path.join(path_session, 'rawdata')
+    name = manifest.blks()[0]
+    with open(os.path.join(path_rawdata, name), 'ab') as f:
+        f.write(bytes(16))
+    os.utime(path_rawdata, ns = (0, manifest.rawdata_mtime_ns))
+    assert manifest.refresh()
+    assert parsed == [name]
+    assert manifest.entries[name]['size'] == os.path.getsize(os.path.join(path_rawdata, name))
+    # A new BLK
+    new = name.replace('E1B', 'E2B')
+    shutil.copy(os.path.join(path_rawdata, name), os.path.join(path_rawdata, new))
+    assert manifest.refresh()
+    assert parsed == [name, new]
+    assert new in manifest.blks()
+    # The stamp of the folder is stored with the entries, and loaded
+    manifest.store()
+    assert blk_manifest.BlkManifest(path_session, store = False).rawdata_mtime_ns == os.stat(path_rawdata).st_mtime_ns
+
+def test_sort_blks_list():
+    names = ['vsd_C01_020122_100000_E1B003.BLK', 'vsd_C02_010122_110000_E1B002.BLK', float('nan'), 'vsd_C01_010122_100500_E1B001.BLK']
+    assert utils.sort_blks_list(names) == [names[3], names[1], names[0]]
@@ -0,0 +1,32 @@
+import os
+
+import pytest
+
+import middle_process as md
+from conftest import run_session
+
+def test_session_options():
+    options = md.get_session_options({'n_workers': 4}, pool = 'process', spatial_bin = 2)
+    assert options == dict(md.SESSION_OPTIONS, n_workers = 4, pool = 'process')
+    with pytest.raises(ValueError):
+        md.get_session_options({'n_worker': 4})
+
+def test_options_in_header(path_session):
+    # As an options dict or as keyword arguments
+    a = run_session(path_session, store_switch = False, options = {'dtype': 'float32', 'n_workers': 2})
+    b = run_session(path_session, store_switch = False, dtype = 'float32', n_workers = 2)
+    for session in [a, b]:
+        assert {k: session.header[k] for k in md.SESSION_OPTIONS} == dict(md.SESSION_OPTIONS, dtype = 'float32', n_workers = 2)
+
+def test_md_folder(path_session):
+    # Only the non-default options add a suffix: the runs do not overwrite each other
+    session = run_session(path_session, store_switch = False)
+    default = os.path.basename(session.set_md_folder())
+    assert default == 'spcbin2_timebin1_zerofrms10_strategymae_n_chunk1_movFalse_dtrendFalse_deblankTrue'
+    options = [{'dtype': 'float32'}, {'frame_window': (0, 25)}, {'crop': (2, 38, 4, 36)}, {'bin_mode': 'area'}]
+    folders = [default]
+    for option in options:
+        session.header.update(option)
+        folders.append(os.path.basename(session.set_md_folder()))
+    assert folders[-1] == default + '_binmodearea_dtypefloat32_frames0-25_crop2-38-4-36'
+    assert len(set(folders)) == len(folders)
@@ -0,0 +1,82 @@
+import os
+import shutil
+
+import numpy as np
+
+import middle_process as md
+import process_IOI
+import synthetic_blk
+from conftest import get_path_md, run_session
+
+def load_conds(path_md):
+    conds = dict()
+    for name in md.get_stored_conds(path_md):
+        cd = md.Condition()
+        cd.load_cond(os.path.join(path_md, name))
+        conds[name] = cd
+    return conds
+
+def test_legacy_with_max_memory(path_session):
+    run_session(path_session, storage_format = 'legacy')
+    path_md = get_path_md(path_session)
+    reference = load_conds(path_md)
+    shutil.rmtree(path_md)
+    # Trials tensors over the budget are DiskTrials, loaded in memory to be pickled
+    run_session(path_session, storage_format = 'legacy', max_memory = 1e-6)
+    conds = load_conds(path_md)
+    assert sorted(conds) == sorted(reference)
+    for name, cd in conds.items():
+        assert not os.path.isdir(os.path.join(path_md, name))
+        assert isinstance(cd.binned_data, np.ndarray) and isinstance(cd.df_fz, np.ndarray)
+        for field in md.CONDITION_ARRAYS:
+            assert np.array_equal(getattr(cd, field), getattr(reference[name], field), equal_nan = True)
+        raws, _ = process_IOI.get_cond(path_md, cd.cond_name, cd.cond_id)
+        assert len(raws) == len(cd.binned_data)
+
+def test_streaming_stores_trials(path_session):
+    # With two chunks the mse strategy discards some trials: they are removed from the streaming accumulators
+    session = run_session(path_session, strategy = 'mse', chunks = 2)
+    assert 0 < np.sum(session.auto_selected) < len(session.auto_selected)
+    path_md = get_path_md(path_session)
+    reference = load_conds(path_md)
+    shutil.rmtree(path_md)
+    run_session(path_session, strategy = 'mse', chunks = 2, streaming = True)
+    conds = load_conds(path_md)
+    assert sorted(conds) == sorted(reference)
+    for name, cd in conds.items():
+        for field in ['binned_data', 'df_fz', 'time_course', 'autoselection']:
+            assert np.array_equal(getattr(cd, field), getattr(reference[name], field), equal_nan = True)
+        # Welford accumulators: equal up to float rounding
+        for field in ['averaged_df', 'averaged_timecourse', 'z_score']:
+            assert np.allclose(getattr(cd, field), getattr(reference[name], field), equal_nan = True)
+        raws, dfs = process_IOI.get_cond(path_md, cd.cond_name, cd.cond_id)
+        assert raws.shape == cd.binned_data.shape
+
+def test_incremental_stores_trials(path_session):
+    # A second run with new BLKs in rawdata appends them to the trial stores of the first one
+    names = synthetic_blk.make_session(path_session, n_conditions = 3, n_trials = 6, n_frames = 30, height = 40, width = 40, zero_frames = 10)
+    run_session(path_session, strategy = 'mse', chunks = 2)
+    path_md = get_path_md(path_session)
+    reference = load_conds(path_md)
+    shutil.rmtree(os.path.dirname(path_md))
+    # The first 4 trials of each condition, as in path_session: the others arrive later
+    path_rawdata = os.path.join(path_session, 'rawdata')
+    later = names[12:]
+    os.makedirs(os.path.join(path_session, 'later'))
+    for name in later:
+        os.rename(os.path.join(path_rawdata, name), os.path.join(path_session, 'later', name))
+    run_session(path_session, strategy = 'mse', chunks = 2, incremental = True)
+    for name in later:
+        os.rename(os.path.join(path_session, 'later', name), os.path.join(path_rawdata, name))
+    run_session(path_session, strategy = 'mse', chunks = 2, incremental = True)
+    conds = load_conds(path_md)
+    assert sorted(conds) == sorted(reference)
+    for name, cd in conds.items():
+        assert cd.blk_names == reference[name].blk_names
+        assert np.array_equal(np.asarray(cd.binned_data), reference[name].binned_data)
+        raws, dfs = process_IOI.get_cond(path_md, cd.cond_name, cd.cond_id)
+        assert np.array_equal(raws, reference[name].binned_data)
+    # The blank dF/F0 does not depend on the blank of the previous run
+    blank = [name for name, cd in conds.items() if cd.cond_name == 'blank'][0]
+    assert np.array_equal(np.asarray(conds[blank].df_fz), reference[blank].df_fz)
+    assert np.allclose(conds[blank].averaged_df, reference[blank].averaged_df)
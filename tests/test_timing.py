@@ -0,0 +1,35 @@
+import os
+import re
+
+import timing
+
+def test_profile_lines(tmp_path):
+    path = os.path.join(str(tmp_path), timing.PROFILE_FOLDER, 'profile_test.jsonl')
+    profile = timing.Profile(path, run = 'test')
+    previous = timing.set_profile(profile)
+    try:
+        for i in range(3):
+            with timing.span('read', nbytes = 10, trials = 1):
+                with timing.span('bin'):
+                    pass
+        handle = profile.file
+    finally:
+        timing.set_profile(previous)
+    # One handle for all the spans, line buffered: the lines are on disk before close
+    assert handle is profile.file
+    summary = timing.summarize(path)
+    assert summary['read'] == {'count': 3, 'seconds': summary['read']['seconds'], 'bytes': 30, 'trials': 3}
+    assert summary['bin']['count'] == 3
+    profile.close()
+    assert handle.closed
+
+def test_stages_listed():
+    # Every stage measured in the pipeline is in STAGES, so that the summaries keep their order
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    stages = set()
+    for name in os.listdir(root):
+        if name.endswith('.py'):
+            with open(os.path.join(root, name)) as f:
+                stages.update(re.findall(r"timing\.(?:span|timed|record)\('(\w+)'", f.read()))
+    assert 'map' in stages
+    assert stages <= set(timing.STAGES)
@@ -0,0 +1,45 @@
+import logging
+import os
+import shutil
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+import pytest
+
+import data_visualization as dv
+import middle_process as md
+import trial_store
+from conftest import get_path_md, run_session
+from test_storage import load_conds
+
+@pytest.mark.parametrize('log_', [None, logging.getLogger('vsdi_tests')])
+def test_time_sequence_log(tmp_path, log_):
+    # The messages go to the logger if given, to stdout otherwise
+    data = np.random.default_rng(0).random((2, 30, 20, 20))
+    header = {'path_session': os.path.join(str(tmp_path), 'exp-test', 'sub-test', 'ses-test')}
+    dv.time_sequence_visualization(10, 5, 25, data, np.array(['trial_0', 'trial_1']), 'test', header, str(tmp_path), log_ = log_)
+    assert len(os.listdir(os.path.join(str(tmp_path), 'activity_maps'))) > 0
+
+@pytest.mark.parametrize('renderer, streaming, max_memory', [('matplotlib', False, 1e-6), ('matplotlib', True, 1e-6), ('raster', False, None)])
+def test_time_sequence_max_memory(path_session, monkeypatch, renderer, streaming, max_memory):
+    # The activity maps read the trials one at a time, and leave them untouched
+    run_session(path_session, max_memory = max_memory, streaming = streaming)
+    path_md = get_path_md(path_session)
+    reference = load_conds(path_md)
+    shutil.rmtree(path_md)
+    def load_whole(self, dtype = None, copy = None):
+        raise AssertionError('Trials tensor loaded in memory')
+    monkeypatch.setattr(trial_store.DiskTrials, '__array__', load_whole)
+    monkeypatch.setattr(md.SelectedTrials, '__array__', load_whole)
+    run_session(path_session, max_memory = max_memory, streaming = streaming, data_vis_switch = True, renderer = renderer)
+    assert len(os.listdir(os.path.join(os.path.dirname(path_md), 'activity_maps'))) > 0
+    conds = load_conds(path_md)
+    for name, cd in conds.items():
+        assert np.array_equal(cd.df_fz, reference[name].df_fz, equal_nan = True)
+
+def test_color_limits():
+    data = np.random.default_rng(0).random((3, 30, 20, 20))
+    data[0, 0, 0, 0] = np.nan
+    assert np.allclose(dv.get_color_limits(data), np.nanpercentile(data, [10, 85]))
+    assert np.allclose(dv.get_color_limits(data, n_samples = 2**12), np.nanpercentile(data, [10, 85]), atol = 0.02)
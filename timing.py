@@ -0,0 +1,176 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+PROFILE_FOLDER = 'profiles'
+# Stages of the processing pipeline, in order. 'read' is the I/O of the BLKs read in memory, 'map' the memory mapping
+# of the others: their pages are read on access, within 'bin' or 'detrend'. 'retinotopy' is a whole retinotopy analysis
+STAGES = ['header', 'read', 'map', 'bin', 'detrend', 'df_f', 'roi', 'selection', 'zscore', 'store', 'plot', 'retinotopy']
+
+class Profile:
+    '''
+    Timings of a run, as JSON lines in the file path: one line for each span, with the stage name, the monotonic start
+    and the duration in nanoseconds, the bytes processed, the trials, the process id and the enclosing stage.
+    Lines are appended one write at a time, so the workers of the run -threads or forked processes- write
+    in the same file. The file is opened once for each process, line buffered, and kept open until close.
+    Without path the spans are only summed in memory.
+    '''
+    def __init__(self, path = None, run = None):
+        self.path = path
+        self.run = time.strftime('%Y%m%d_%H%M%S') if run is None else run
+        self.totals = dict()
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['file'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, stage, start_ns, duration_ns, nbytes = 0, trials = 0, parent = None, **fields):
+        entry = {'run': self.run, 'stage': stage, 'start_ns': start_ns, 'duration_ns': duration_ns,
+                 'bytes': int(nbytes), 'trials': int(trials), 'pid': os.getpid(), 'parent': parent}
+        entry.update(fields)
+        with self.lock:
+            total = self.totals.setdefault(stage, {'count': 0, 'duration_ns': 0, 'bytes': 0, 'trials': 0})
+            total['count'] += 1
+            total['duration_ns'] += duration_ns
+            total['bytes'] += int(nbytes)
+            total['trials'] += int(trials)
+            if self.path is not None:
+                try:
+                    self.get_file().write(json.dumps(entry, default = str) + '\n')
+                except OSError:
+                    print('Timing not written in ' + self.path)
+
+    def get_file(self):
+        # A forked worker inherits the handle of its parent: it opens its own
+        if (self.file is None) or (self.pid != os.getpid()):
+            self.file = open(self.path, 'a', buffering = 1)
+            self.pid = os.getpid()
+        return self.file
+
+    def close(self):
+        '''
+        Closes the file of this process. A later span opens it again.
+        '''
+        with self.lock:
+            if (self.file is not None) and (self.pid == os.getpid()):
+                self.file.close()
+            self.file = None
+
+class Span:
+    '''
+    A timed stage: bytes and trials processed are added while it runs. duration_ns is set at its end.
+    '''
+    def __init__(self, stage, nbytes = 0, trials = 0, **fields):
+        self.stage = stage
+        self.nbytes = nbytes
+        self.trials = trials
+        self.fields = fields
+        self.duration_ns = None
+
+    def add(self, nbytes = 0, trials = 0):
+        self.nbytes += nbytes
+        self.trials += trials
+
+    @property
+    def seconds(self):
+        return None if self.duration_ns is None else self.duration_ns/1e9
+
+# The profile of the current run: inherited by the threads and the forked workers
+_profile = None
+_local = threading.local()
+
+def set_profile(profile):
+    '''
+    Sets the profile where the spans are recorded -None stops the recording-. Returns the previous one.
+    '''
+    global _profile
+    previous, _profile = _profile, profile
+    return previous
+
+def get_profile():
+    return _profile
+
+def now():
+    '''
+    Monotonic time in nanoseconds.
+    '''
+    return time.perf_counter_ns()
+
+def record(stage, start_ns, nbytes = 0, trials = 0, **fields):
+    '''
+    Records the stage started at start_ns -see now()- and ending now. Returns the duration in nanoseconds.
+    '''
+    duration = now() - start_ns
+    if _profile is not None:
+        stack = getattr(_local, 'stack', [])
+        _profile.record(stage, start_ns, duration, nbytes, trials, parent = stack[-1] if stack else None, **fields)
+    return duration
+
+@contextlib.contextmanager
+def span(stage, nbytes = 0, trials = 0, **fields):
+    '''
+    Context manager timing the stage: it yields a Span, for adding bytes and trials processed.
+    Spans can be nested: the enclosing stage is recorded as parent.
+    '''
+    s = Span(stage, nbytes, trials, **fields)
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = list()
+    start = now()
+    stack.append(stage)
+    try:
+        yield s
+    finally:
+        stack.pop()
+        s.duration_ns = record(stage, start, s.nbytes, s.trials, **s.fields)
+
+def timed(stage, measure = None):
+    '''
+    Decorator timing each call of the function as a span of stage. measure, if given, is called with the arguments 
+    of the call and returns the (bytes, trials) processed.
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            nbytes, trials = (0, 0) if measure is None else measure(*args, **kwargs)
+            with span(stage, nbytes, trials):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_profile_path(path_session, run):
+    return os.path.join(path_session, 'derivatives', PROFILE_FOLDER, f'profile_{run}.jsonl')
+
+def summarize(path):
+    '''
+    Totals for each stage of a JSON lines profile -all the processes of the run-: count, seconds, bytes and trials,
+    with the stages of STAGES first.
+    '''
+    totals = dict()
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            total = totals.setdefault(entry['stage'], {'count': 0, 'seconds': 0.0, 'bytes': 0, 'trials': 0})
+            total['count'] += 1
+            total['seconds'] += entry['duration_ns']/1e9
+            total['bytes'] += entry['bytes']
+            total['trials'] += entry['trials']
+    order = {s: i for i, s in enumerate(STAGES)}
+    return dict(sorted(totals.items(), key = lambda kv: order.get(kv[0], len(STAGES))))
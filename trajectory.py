@@ -24,10 +24,8 @@ def get_mask_on_trajectory(dims, xs, ys, radius = 2):
     bottom = int(np.min(xs))
     x, y = get_trajectory(xs, ys, (bottom, up))
     xs_fit_lins = np.round(np.linspace(bottom,up,(up-bottom)*2))
-    masks_small = [utils.sector_mask(dims, (int(round(np.interp(i, x, y))), i), radius, (0,360)) for i in xs_fit_lins]
-    small_mask = sum(masks_small)
-    small_mask[np.where(small_mask>1)] = 1
-    return small_mask
+    masks_small = utils.get_sector_masks(dims, [(int(round(np.interp(i, x, y))), i) for i in xs_fit_lins], radius, (0,360))
+    return np.any(masks_small, axis = 0).astype(int)
 
 def get_rad(xs, ys):
     '''
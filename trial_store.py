@@ -0,0 +1,340 @@
+import concurrent.futures
+import json
+import numpy as np
+import os
+import tempfile
+import threading
+import zlib
+
+# Optional codecs: zlib is always available
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+STORE_NAME = 'store.json'
+SCHEMA_VERSION = 1
+CODECS = ['zlib', 'zstd', 'blosc', 'none']
+DEFAULT_LEVEL = {'zlib': 1, 'zstd': 3, 'blosc': 5, 'none': 0}
+
+def available_codec(codec):
+    '''
+    The codec, if its package is installed. Otherwise zlib, with a message.
+    '''
+    if codec not in CODECS:
+        raise ValueError(f'Codec {codec} not available: choose among {CODECS}')
+    if ((codec == 'zstd') and (zstandard is None)) or ((codec == 'blosc') and (blosc is None)):
+        print(f'{codec} package not installed: zlib codec used')
+        return 'zlib'
+    return codec
+
+def best_codec():
+    '''
+    The fastest codec installed: blosc, then zstd, then zlib.
+    '''
+    if blosc is not None:
+        return 'blosc'
+    if zstandard is not None:
+        return 'zstd'
+    return 'zlib'
+
+def shuffle(data):
+    '''
+    Byte shuffle -the bytes of the same significance stored contiguously-: float arrays compress much better.
+    '''
+    return np.ascontiguousarray(data).view(np.uint8).reshape(-1, data.dtype.itemsize).T.tobytes()
+
+def unshuffle(raw, dtype, shape):
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+def encode(data, codec, level):
+    if codec == 'blosc':
+        return blosc.compress(np.ascontiguousarray(data).tobytes(), typesize = data.dtype.itemsize, clevel = level, shuffle = blosc.SHUFFLE)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level = level).compress(shuffle(data))
+    if codec == 'zlib':
+        return zlib.compress(shuffle(data), level)
+    return np.ascontiguousarray(data).tobytes()
+
+def decode(raw, codec, dtype, shape):
+    if codec == 'blosc':
+        return np.frombuffer(blosc.decompress(raw), dtype=dtype).reshape(shape).copy()
+    if codec == 'zstd':
+        return unshuffle(zstandard.ZstdDecompressor().decompress(raw), dtype, shape)
+    if codec == 'zlib':
+        return unshuffle(zlib.decompress(raw), dtype, shape)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape).copy()
+
+class TrialStore:
+    '''
+    Chunked and compressed store of a trials tensor (Trials, Time, Y, X), in a folder: store.json describes it,
+    and each chunk -a trial, or a block of chunk_frames frames of a trial- is a compressed file.
+    Trials can be appended, and read one by one, or for a window of frames, without decompressing the others.
+    The chunks are compressed and decompressed by n_workers threads: zlib, zstd and blosc release the GIL.
+
+    Parameters
+    ----------
+    path : str
+        The folder of the store.
+    mode : str
+        'r' read only, 'a' append -the store is created if missing-, 'w' the store is created, and an existing one
+        is overwritten.
+    codec : str
+        One among CODECS, for a new store. zstd and blosc need their package, otherwise zlib is used.
+    level : int
+        Compression level, for a new store. DEFAULT_LEVEL of the codec if None.
+    chunk_frames : int
+        Frames for chunk, for a new store. None by default: one chunk for trial.
+    n_workers : int
+        Threads for compression and decompression.
+    '''
+    def __init__(self, path, mode = 'r', codec = 'zlib', level = None, chunk_frames = None, n_workers = 1):
+        self.path = path
+        self.mode = mode
+        self.n_workers = max(1, n_workers)
+        if (mode == 'r') or ((mode == 'a') and os.path.exists(os.path.join(path, STORE_NAME))):
+            with open(os.path.join(path, STORE_NAME)) as f:
+                self.meta = json.load(f)
+            if self.meta.get('schema_version') != SCHEMA_VERSION:
+                raise ValueError(f'Trial store schema version {self.meta.get("schema_version")} not supported: {path}')
+        elif mode in ('a', 'w'):
+            codec = available_codec(codec)
+            self.meta = {'schema_version': SCHEMA_VERSION,
+                         'codec': codec,
+                         'level': DEFAULT_LEVEL[codec] if level is None else level,
+                         'chunk_frames': chunk_frames,
+                         'dtype': None,
+                         'trial_shape': None,
+                         'names': list()}
+            if os.path.exists(path):
+                for f in os.scandir(path):
+                    os.remove(f.path)
+            os.makedirs(path, exist_ok=True)
+            self.store_meta()
+        else:
+            raise ValueError(f'Mode {mode} not available: r, a or w')
+
+    def store_meta(self):
+        tmp = os.path.join(self.path, STORE_NAME + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.path, STORE_NAME))
+
+    @property
+    def names(self):
+        return self.meta['names']
+
+    @property
+    def dtype(self):
+        return None if self.meta['dtype'] is None else np.dtype(self.meta['dtype'])
+
+    @property
+    def shape(self):
+        if self.meta['trial_shape'] is None:
+            return (0,)
+        return (len(self),) + tuple(self.meta['trial_shape'])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.meta['names'])
+
+    def get_blocks(self, frames = None):
+        '''
+        (block index, start frame, end frame) of the chunks of a trial which overlap the window frames (t0, t1).
+        '''
+        n_frames = self.meta['trial_shape'][0]
+        step = self.meta['chunk_frames'] or n_frames
+        t0, t1 = (0, n_frames) if frames is None else frames
+        return [(b, b*step, min((b+1)*step, n_frames)) for b in range(t0//step, -(-min(t1, n_frames)//step))]
+
+    def chunk_path(self, trial, block):
+        return os.path.join(self.path, f'{trial:06d}_{block:04d}.chunk')
+
+    def append(self, trials, names = None):
+        '''
+        Appends a trial (Time, Y, X) or a trials tensor (Trials, Time, Y, X). names are optional labels -e.g. the
+        BLK filenames-: the trial index by default.
+        '''
+        if self.mode == 'r':
+            raise ValueError('Trial store opened read only')
+        trials = np.asarray(trials)
+        if self.meta['trial_shape'] is None:
+            self.meta['trial_shape'] = list(trials.shape[-3:])
+            self.meta['dtype'] = trials.dtype.str
+        if trials.ndim == len(self.meta['trial_shape']):
+            trials = trials[np.newaxis]
+        if list(trials.shape[1:]) != self.meta['trial_shape']:
+            raise ValueError(f'Trial shape {trials.shape[1:]} different from the store one {self.meta["trial_shape"]}')
+        trials = trials.astype(self.dtype, copy=False)
+        start = len(self)
+        if names is None:
+            names = [str(start + i) for i in range(len(trials))]
+        tasks = [(start + i, b, t0, t1) for i in range(len(trials)) for b, t0, t1 in self.get_blocks()]
+
+        def write_chunk(trial, block, t0, t1):
+            with open(self.chunk_path(trial, block), 'wb') as f:
+                f.write(encode(trials[trial - start, t0:t1], self.meta['codec'], self.meta['level']))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.n_workers) as executor:
+            list(executor.map(lambda task: write_chunk(*task), tasks))
+        # The metadata is updated after the chunks: a broken append leaves the store consistent
+        self.meta['names'] = self.meta['names'] + [str(n) for n in names]
+        self.store_meta()
+
+    def read(self, trials = None, frames = None):
+        '''
+        Trials tensor of the trials indeces -an int, a list or a slice, all the trials if None- restricted to the
+        window frames (t0, t1). Only the chunks overlapping the window are decompressed.
+        '''
+        single = isinstance(trials, (int, np.integer))
+        if trials is None:
+            trials = range(len(self))
+        elif single:
+            trials = [trials]
+        elif isinstance(trials, slice):
+            trials = range(len(self))[trials]
+        trials = [int(t) + len(self) if t < 0 else int(t) for t in trials]
+        if any((t < 0) or (t >= len(self)) for t in trials):
+            raise IndexError(f'Trial index out of range: {len(self)} trials in the store')
+        n_frames = self.meta['trial_shape'][0]
+        t0, t1 = (0, n_frames) if frames is None else (max(0, frames[0]), min(n_frames, frames[1]))
+        out = np.empty((len(trials), max(0, t1 - t0)) + tuple(self.meta['trial_shape'][1:]), dtype=self.dtype)
+        tasks = [(i, trial, b, b0, b1) for i, trial in enumerate(trials) for b, b0, b1 in self.get_blocks((t0, t1))]
+
+        def read_chunk(i, trial, block, b0, b1):
+            with open(self.chunk_path(trial, block), 'rb') as f:
+                chunk = decode(f.read(), self.meta['codec'], self.dtype, (b1 - b0,) + tuple(self.meta['trial_shape'][1:]))
+            out[i, max(b0, t0) - t0:min(b1, t1) - t0] = chunk[max(b0, t0) - b0:min(b1, t1) - b0]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.n_workers) as executor:
+            list(executor.map(lambda task: read_chunk(*task), tasks))
+        return out[0] if single else out
+
+    def __getitem__(self, key):
+        '''
+        Numpy like indexing: the first index selects the trials, and a slice on the second one -time- reads
+        only the needed chunks. The other indeces are applied on the result.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        trials, rest = key[0], key[1:]
+        if isinstance(trials, np.ndarray) and trials.dtype == bool:
+            trials = np.where(trials)[0]
+        frames = None
+        if (len(rest) > 0) and isinstance(rest[0], slice) and (rest[0].step in (None, 1)):
+            start, stop, _ = rest[0].indices(self.meta['trial_shape'][0])
+            frames = (start, stop)
+            rest = (slice(None),) + rest[1:]
+        data = self.read(trials, frames = frames)
+        if isinstance(trials, (int, np.integer)):
+            return data[rest] if len(rest) > 0 else data
+        return data[(slice(None),) + rest] if len(rest) > 0 else data
+
+    def __array__(self, dtype = None, copy = None):
+        data = self.read()
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+class DiskTrials:
+    '''
+    Uncompressed trials tensor (Trials, Time, Y, X) backed by an anonymous temporary file in folder: it replaces a 
+    numpy array when the trials do not fit in memory. The trials are written and read with explicit file I/O 
+    -no memory mapping-, so only the trials being processed are in memory. The file is deleted when closed.
+    Indexing: trials[i] and trials[i, :, :, :] read or write one trial; a slice, a list or a boolean mask on the
+    first index read a tensor of the selected trials, and the other indeces are applied on the result.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape (Trials, Time, Y, X).
+    dtype : str
+        The dtype of the trials.
+    folder : str
+        Folder of the temporary file: the system one if None.
+    '''
+    def __init__(self, shape, dtype, folder = None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.trial_bytes = int(np.prod(self.shape[1:]))*self.dtype.itemsize
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+        self.file = tempfile.TemporaryFile(dir = folder)
+        self.file.truncate(self.shape[0]*self.trial_bytes)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        self.file.close()
+
+    def read_trial(self, i):
+        out = np.empty(self.shape[1:], dtype=self.dtype)
+        with self.lock:
+            self.file.seek(i*self.trial_bytes)
+            self.file.readinto(memoryview(out).cast('B'))
+        return out
+
+    def write_trial(self, i, trial):
+        trial = np.ascontiguousarray(trial, dtype=self.dtype)
+        if trial.shape != self.shape[1:]:
+            raise ValueError(f'Trial shape {trial.shape} different from {self.shape[1:]}')
+        with self.lock:
+            self.file.seek(i*self.trial_bytes)
+            self.file.write(memoryview(trial).cast('B'))
+
+    def get_index(self, i):
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if (i < 0) or (i >= len(self)):
+            raise IndexError(f'Trial index out of range: {len(self)} trials')
+        return i
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        trials, rest = key[0], key[1:]
+        if isinstance(trials, (int, np.integer)):
+            data = self.read_trial(self.get_index(trials))
+            return data[rest] if len(rest) > 0 else data
+        if isinstance(trials, slice):
+            trials = range(len(self))[trials]
+        elif isinstance(trials, np.ndarray) and trials.dtype == bool:
+            trials = np.where(trials)[0]
+        data = np.empty((len(trials),) + self.shape[1:], dtype=self.dtype)
+        for n, i in enumerate(trials):
+            data[n] = self.read_trial(self.get_index(i))
+        return data[(slice(None),) + rest] if len(rest) > 0 else data
+
+    def __setitem__(self, key, value):
+        '''
+        Only whole trials are written: trials[i] = trial, or trials[i, :, :, :] = trial.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        if (not isinstance(key[0], (int, np.integer))) or any(k != slice(None) for k in key[1:]):
+            raise IndexError('Only a whole trial can be written')
+        self.write_trial(self.get_index(key[0]), value)
+
+    def __array__(self, dtype = None, copy = None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+def save_npy(path, trials):
+    '''
+    Saves a trials tensor -a numpy array, a DiskTrials or a TrialStore- as a .npy file, writing one trial at a time.
+    '''
+    dtype = np.dtype(trials.dtype)
+    with open(path, 'wb') as f:
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': tuple(trials.shape)})
+        for i in range(len(trials)):
+            f.write(np.ascontiguousarray(trials[i], dtype=dtype).tobytes())
@@ -2,7 +2,7 @@ import cv2 as cv
 import json
 import numpy as np
 import scipy.io as scio
-import datetime, fnmatch, logging, os, pickle, sys, struct
+import concurrent.futures, datetime, fnmatch, functools, itertools, logging, os, pickle, sys, struct
 
 from matplotlib.colors import LinearSegmentedColormap
 import numpy as np
@@ -60,16 +60,64 @@ COLORS = colors_a = [  'forestgreen', 'purple', 'orange', 'blue',
 
 import cv2 as cv 
 
-def bin_image(data, x_bnnd_size, y_bnnd_size):
+# Precisions of the computed signals: float32 halves memory and storage. Reductions accumulate in float64 anyway
+DTYPES = ['float64', 'float32']
+# Spatial binning modes: linear interpolation -MATLAB like, the historical one- or block mean
+BINNING_MODES = {'linear': cv.INTER_LINEAR, 'area': cv.INTER_AREA}
+# Sector masks kept by get_sector_mask
+MASK_CACHE_SIZE = 128
+
+def bin_image(data, x_bnnd_size, y_bnnd_size, mode = 'linear', dtype = 'float64'):
+    '''
+    Spatial only binning of a (T, Y, X) stack to (T, y_bnnd_size, x_bnnd_size): see binning.
+    '''
+    return binning(data, mode = mode, dtype = dtype, size = (y_bnnd_size, x_bnnd_size))
+
+def binning(data, spatial_bin = 1, temporal_bin = 1, mode = 'linear', dtype = 'float64', size = None):
+    '''
+    Spatial and temporal binning of a (T, Y, X) stack, fused in one pass over the output frames: 
+    each binned frame is the mean of its temporal_bin input frames, resized straight into the output.
+    No intermediate stack is allocated, and the input is read once -it can be a np.memmap-.
+    Parameters:
+        data: numpy.array (T, Y, X). It is not modified
+        spatial_bin: int. Binning factor for both Y and X. The output has Y//spatial_bin, X//spatial_bin pixels
+        temporal_bin: int. Number of consecutive frames averaged together. The last block, if partial, is averaged on its frames
+        mode: str. 'linear' interpolation -the historical behaviour- or 'area' for mean over spatial_bin x spatial_bin blocks. 
+              With 'area', rows and columns exceeding the last full block are dropped, and the blocks are averaged over a reshaped view
+        dtype: str. Precision of the output: each frame is computed in float64 and then stored. float64 by default
+        size: tuple. Output frame size (Y, X), instead of the one of spatial_bin: no cropping with 'area'. None by default
+    Returns:
+        numpy.array dtype (ceil(T/temporal_bin), Y//spatial_bin, X//spatial_bin). Always a new array
+    '''
     assert len(data.shape) == 3, 'Shape of data matrix wrong'
-    time = data.shape[0]
-    b = data
-    tmp = np.zeros((time, y_bnnd_size, x_bnnd_size))
-    for i in range(time):
-        tmp[i, :, :] = cv.resize(np.array(b[i, :, :], dtype='float64'), 
-                                 (x_bnnd_size, y_bnnd_size), 
-                                 interpolation=cv.INTER_LINEAR)
-    b = tmp
+    if mode not in BINNING_MODES:
+        raise ValueError(f'Binning mode {mode} not available: choose between {list(BINNING_MODES)}')
+    t_size, y_size, x_size = data.shape
+    t_bnnd_size = int(np.ceil(t_size/temporal_bin))
+    if size is not None:
+        y_bnnd_size, x_bnnd_size = size
+    else:
+        y_bnnd_size, x_bnnd_size = y_size//spatial_bin, x_size//spatial_bin
+        if mode == 'area':
+            # Integer factors: INTER_AREA is the block mean on the cropped frame
+            data = data[:, :y_bnnd_size*spatial_bin, :x_bnnd_size*spatial_bin]
+    # Integer factors with 'area': the block mean over a reshaped view of the temporal block, without cv.resize
+    blocks = (size is None) and (mode == 'area') and (spatial_bin > 1)
+    resize = tuple(data.shape[1:]) != (y_bnnd_size, x_bnnd_size)
+    b = np.empty((t_bnnd_size, y_bnnd_size, x_bnnd_size), dtype=dtype)
+    for t in range(t_bnnd_size):
+        if blocks:
+            block = data[t*temporal_bin:(t+1)*temporal_bin, :, :].reshape(-1, y_bnnd_size, spatial_bin, x_bnnd_size, spatial_bin)
+            b[t, :, :] = block.mean(axis=(0, 2, 4), dtype='float64')
+            continue
+        if temporal_bin > 1:
+            frame = data[t*temporal_bin:(t+1)*temporal_bin, :, :].mean(axis=0, dtype='float64')
+        else:
+            frame = np.asarray(data[t, :, :], dtype='float64')
+        if resize:
+            b[t, :, :] = cv.resize(frame, (x_bnnd_size, y_bnnd_size), interpolation=BINNING_MODES[mode])
+        else:
+            b[t, :, :] = frame
     return b
 
 class DrawLineWidget(object):
@@ -223,18 +271,45 @@ def get_sessions(path_storage, exp_type = ['VSDI'], sessions = None, subs = None
 
     return exps
 
+def bounded_map(executor, fn, tasks, max_in_flight):
+    '''
+    Runs fn(*task) for each task on the executor, keeping at most max_in_flight tasks submitted: 
+    a new task is submitted only when one completes, so the memory held by the results is bounded.
+    It yields (index of the task, result) pairs in completion order.
+    '''
+    tasks = enumerate(tasks)
+    pending = {executor.submit(fn, *task): i for i, task in itertools.islice(tasks, max(1, max_in_flight))}
+    while len(pending) > 0:
+        done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            i = pending.pop(future)
+            for j, task in itertools.islice(tasks, 1):
+                pending[executor.submit(fn, *task)] = j
+            yield i, future.result()
+
+@functools.lru_cache(maxsize=None)
+def parse_blk_name(blk_name, filename_particle = 'vsd_C'):
+    '''
+    Condition id and acquisition datetime of a BLK, from its filename -e.g. vsd_C01_010122_101010_E1B001.BLK-.
+    Each name is parsed once per process. None for a field that cannot be parsed.
+    '''
+    try:
+        condition = int(blk_name.split(filename_particle)[1][0:2])
+    except (IndexError, ValueError):
+        condition = None
+    try:
+        timestamp = datetime.datetime.strptime(blk_name.split('_')[2] + blk_name.split('_')[3], '%d%m%y%H%M%S')
+    except (IndexError, ValueError):
+        timestamp = None
+    return condition, timestamp
+
 def sort_blks_list(lista):
-    tmp = {}
-    for n, i in enumerate(lista):
-        if type(i) == float:
-            pass
-        else:
-            tmp[i.split('_')[3]] = i
-    sorting_values = list(tmp.keys())
-    sorting_values.sort()
-    sorted_blks = [tmp[i] for i in sorting_values]
-    return sorted_blks
-    # return sorted(lista, key=lambda t: datetime.datetime.strptime(t.split('_')[2] + t.split('_')[3], '%d%m%y%H%M%S'))
+    '''
+    BLK filenames sorted by acquisition datetime -see parse_blk_name-. The float entries -NaN of the logs- are 
+    skipped, and a name with the datetime of a previous one replaces it.
+    '''
+    tmp = {parse_blk_name(i)[1]: i for i in lista if type(i) != float}
+    return [tmp[i] for i in sorted(tmp)]
 
 def get_stimulus_metadata(path):
     '''
@@ -366,6 +441,38 @@ def sector_mask(shape,centre,radius,angle_range):
 
     return circmask*anglemask
 
+def get_sector_mask(shape, centre, radius, angle_range = (0, 360)):
+    '''
+    sector_mask, memoized: the same (shape, centre, radius, angle_range) returns the same read only mask. 
+    Copy it before changing it.
+    '''
+    return cached_sector_mask(tuple(int(i) for i in shape), tuple(float(i) for i in centre), float(radius), tuple(float(i) for i in angle_range))
+
+@functools.lru_cache(maxsize = MASK_CACHE_SIZE)
+def cached_sector_mask(shape, centre, radius, angle_range):
+    mask = sector_mask(shape, centre, radius, angle_range)
+    mask.setflags(write = False)
+    return mask
+
+def get_sector_masks(shape, centres, radius, angle_range = (0, 360)):
+    '''
+    sector_mask for each centre of the list centres -(x, y) as in sector_mask-, computed at once. Returns a 
+    (len(centres), shape[0], shape[1]) boolean array.
+    '''
+    centres = np.asarray(centres, dtype = float).reshape(-1, 2)
+    x, y = np.ogrid[:shape[0], :shape[1]]
+    cx = centres[:, 0, np.newaxis, np.newaxis]
+    cy = centres[:, 1, np.newaxis, np.newaxis]
+    masks = (x-cx)*(x-cx) + (y-cy)*(y-cy) <= radius*radius
+    tmin, tmax = np.deg2rad(angle_range)
+    if tmax < tmin:
+        tmax += 2*np.pi
+    # The full circle needs no angular mask
+    if tmax - tmin < 2*np.pi:
+        theta = (np.arctan2(x-cx, y-cy) - tmin)%(2*np.pi)
+        masks &= theta <= (tmax-tmin)
+    return masks
+
 def socket_numpy2matlab(path, matrix, substring = ''):
     '''
     ---------------------------------------------------------------------------------------------------------
@@ -51,7 +51,7 @@ if __name__=="__main__":
     args = parser.parse_args()
     
 
-    all_conds = [f.name.split('.pickle')[0] for f in os.scandir(args.path_session) if (f.is_file()) and (f.name.endswith(".pickle"))]
+    all_conds = md.get_stored_conds(args.path_session)
     print(all_conds)
 
     dict_data = dict()
@@ -72,7 +72,7 @@ if __name__=="__main__":
 
     # BLANK EXTRACTION
     blank_raw = dict_data[args.blank_name]
-    blank_dffz = np.array([process.deltaf_up_fzero(i, zero_of_cond, deblank = True, blank_sign=None) for i in blank_raw])
+    blank_dffz = process.deltaf_up_fzero_batch(blank_raw, zero_of_cond, deblank = True, blank_sign=None)
 
     num_blank_elements = len(blank_raw)
     average_blank_df = np.nanmean(blank_dffz, axis = 0)
@@ -83,7 +83,8 @@ if __name__=="__main__":
 
     for k,v in dict_data.items():
         print(k)
-        dict_data_dffz[k] = np.array([process.deltaf_up_fzero(i, zero_of_cond, deblank = True, blank_sign=average_blank_df) for i in v])
+        # The selected binned data are a copy: dF/F0 is written over them
+        dict_data_dffz[k] = process.deltaf_up_fzero_batch(v, zero_of_cond, deblank = True, blank_sign=average_blank_df, in_place = True)
 
     ## ZERO EXTRACTION
     zeros = np.array([i[:zero_of_cond, :, :] for k, v in dict_data_dffz.items() for i in v])